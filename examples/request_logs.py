@@ -10,7 +10,8 @@ request_logs = rh.Collection(
     'log',
     'request',
     index_fields='status, uri, host',
-    json_fields='request, response, headers'
+    json_fields='request, response, headers',
+    composite_indexes='host+uri, host+status'
 )
 
 
@@ -1,3 +1,4 @@
+import random
 import bg_helper as bh
 import fs_helper as fh
 import input_helper as ih
@@ -17,6 +18,8 @@ logger = fh.get_logger(__name__)
 SETTINGS = sh.get_all_settings(__name__).get(sh.APP_ENV, {})
 REDIS_URL = SETTINGS.get('redis_url')
 REDIS = None
+REDIS_REPLICA_URLS = SETTINGS.get('redis_replica_urls', '')
+REPLICAS = []
 
 
 def zshow(key, start=0, end=-1, desc=True, withscores=True):
@@ -142,4 +145,37 @@ def connect_to_server(url=REDIS_URL, attempt_docker=True, exception=False, show=
         return (True, size)
 
 
+def connect_to_replicas(urls=REDIS_REPLICA_URLS, exception=False):
+    """Connect to read replica server(s) and set the REPLICAS variable
+
+    - urls: string of redis urls separated by any of , ; | (if no urls are
+      specified, use the redis_replica_urls from settings.ini)
+    - exception: if True and unable to connect to a replica, raise an exception
+
+    Return the number of replicas that are connected
+    """
+    global REDIS_REPLICA_URLS, REPLICAS
+    REDIS_REPLICA_URLS = urls
+    replicas = []
+    for url in ih.string_to_list(urls):
+        replica = StrictRedis.from_url(url)
+        try:
+            replica.ping()
+        except ConnectionError:
+            if exception is True:
+                raise
+            logger.warning('Unable to connect to replica {}'.format(url))
+        else:
+            replicas.append(replica)
+    REPLICAS = replicas
+    return len(REPLICAS)
+
+
+def get_reader():
+    """Return a random connection from REPLICAS (or REDIS if there are none)"""
+    if REPLICAS:
+        return random.choice(REPLICAS)
+    return REDIS
+
+
 from .collection import Collection
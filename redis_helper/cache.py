@@ -0,0 +1,113 @@
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class LRUCache(object):
+    """A bounded, thread-safe least-recently-used cache with TTL and size cap"""
+    def __init__(self, max_items=1000, ttl=60, max_bytes=0):
+        """
+        - max_items: max number of entries to keep
+        - ttl: number of seconds an entry is valid for (0 for no expiration)
+        - max_bytes: max total of the nbytes passed to 'set' for all entries
+          (0 for no limit)
+        """
+        self._max_items = max_items
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, key):
+        """Remove key (lock must already be held); return True if it existed"""
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[2]
+        return True
+
+    def get(self, key, default=None):
+        """Return the value for key (if it exists and hasn't expired)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires, _ = entry
+                if expires and expires < time():
+                    self._remove(key)
+                    self.evictions += 1
+                else:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        """Return the value for key without updating stats or recency"""
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def set(self, key, value, nbytes=0, generation=None):
+        """Set the value for key and evict least recently used entries if needed
+
+        - nbytes: size of the value (counted against max_bytes)
+        - generation: if the cache's generation is no longer equal to this
+          value (because something was invalidated since the value was
+          fetched), don't set anything
+        """
+        if self._max_bytes and nbytes > self._max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._remove(key)
+            expires = time() + self._ttl if self._ttl else 0
+            self._data[key] = (value, expires, nbytes)
+            self._bytes += nbytes
+            while len(self._data) > self._max_items or (
+                self._max_bytes and self._bytes > self._max_bytes
+            ):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def pop(self, *keys):
+        """Invalidate the entries for keys"""
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                if self._remove(key):
+                    self.invalidations += 1
+
+    def clear(self):
+        """Invalidate all entries"""
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._data)
+            self._data.clear()
+            self._bytes = 0
+
+    @property
+    def stats(self):
+        """Return a dict of hit/miss/eviction counts and current size"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'size': len(self._data),
+            'bytes': self._bytes,
+        }
@@ -1,17 +1,28 @@
+import calendar
+import os
 import pickle
 import random
 import re
+import socket
+import threading
 import warnings
 import redis_helper as rh
 import input_helper as ih
 import dt_helper as dh
-from time import sleep
+from time import sleep, time
 from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
-from itertools import chain
+from itertools import chain, islice, product, repeat
 from io import StringIO
 from pprint import pprint
-from redis import ResponseError
+from redis import ResponseError, ConnectionError
+from .cache import LRUCache
+from .writer import BufferedWriter
+from .text import ENGLISH_STOP_WORDS, TOKEN_RX, stem, tokenize
+from .stats import (
+    StatsBuffer, queue_cms_topk, hll_bucket_key, HLL_BUCKET_HOURS, HLL_BUCKET_TTL
+)
 try:
     ModuleNotFoundError
 except NameError:
@@ -25,7 +36,603 @@ except (ImportError, ModuleNotFoundError):
 
 
 META_FIELDS = {'_id', '_ts'}
+INGEST_GROUP = 'indexers'
+_RUNTIME_ATTRS = ('_cache', '_cache_pubsub', '_cache_thread', '_stats_buffer', '_trimmer')
 _CURLY_MATCHER = ih.matcher.CurlyMatcher()
+_COMPOSITE_SEP = '\x1f'
+
+# Format a value decoded by cjson as an index set value (like
+# _json_index_string does for the value decoded in Python)
+_INDEX_STRING_LUA = """
+local function index_string(v)
+    if v == nil or v == cjson.null then
+        return 'None'
+    elseif v == true then
+        return 'True'
+    elseif v == false then
+        return 'False'
+    elseif type(v) == 'table' then
+        return cjson.encode(v)
+    elseif type(v) == 'number' then
+        if v == math.floor(v) and math.abs(v) < 2^53 then
+            return string.format('%d', v)
+        end
+        return string.format('%.14g', v)
+    end
+    return tostring(v)
+end
+"""
+
+# Atomically increment a field of a hash_id (found by unique value if ARGV[1]
+# is empty) and keep its modify time, index (and any shadow index being built
+# by reindex_online), change history, change stream, and cache invalidation in
+# sync. Return {hash_id, new_value} (nil if missing)
+#
+# KEYS[1]: _ts zset, KEYS[2]: _id zset, KEYS[3]: _last_update, KEYS[4]: _changelog,
+# KEYS[5]: _reindex hash (its 'fields' are the index fields with shadow indexes)
+# ARGV: hash_id, unique_val, field, amount, 'int' or 'float', now, base_key,
+#       '1' if field is indexed, history maxlen (-1 for no history), changelog
+#       maxlen (0 for no change event), cache channel ('' for none), composite
+#       indexes that include field ('field1+field2,...' or ''), json path
+#       index fields ('json_field.key,...' or ''), then the names of all other
+#       index fields
+_INCR_LUA = _INDEX_STRING_LUA + """
+local hash_id = ARGV[1]
+local base_key = ARGV[7]
+if hash_id == '' then
+    local num = redis.call('ZSCORE', KEYS[2], ARGV[2])
+    if not num then
+        return false
+    end
+    hash_id = base_key .. ':' .. num
+end
+local old_ts = redis.call('ZSCORE', KEYS[1], hash_id)
+if not old_ts then
+    return false
+end
+local field = ARGV[3]
+local now = ARGV[6]
+local old = redis.call('HGET', hash_id, field)
+if ARGV[5] == 'float' then
+    redis.call('HINCRBYFLOAT', hash_id, field, ARGV[4])
+else
+    redis.call('HINCRBY', hash_id, field, ARGV[4])
+end
+-- The stored string is the index set value (tostring of a big integer reply
+-- would have an exponent)
+local new = redis.call('HGET', hash_id, field)
+local old_string = old or 'None'
+if ARGV[8] == '1' then
+    local index_base_key = base_key .. ':' .. field
+    redis.call('SREM', index_base_key .. ':' .. old_string, hash_id)
+    redis.call('ZINCRBY', index_base_key, -1, old_string)
+    redis.call('SADD', index_base_key .. ':' .. new, hash_id)
+    redis.call('ZINCRBY', index_base_key, 1, new)
+end
+for name in string.gmatch(ARGV[12], '[^,]+') do
+    local old_parts, new_parts = {}, {}
+    for composite_field in string.gmatch(name, '[^+]+') do
+        if composite_field == field then
+            table.insert(old_parts, old_string)
+            table.insert(new_parts, new)
+        else
+            local current = redis.call('HGET', hash_id, composite_field) or 'None'
+            table.insert(old_parts, current)
+            table.insert(new_parts, current)
+        end
+    end
+    local old_value = table.concat(old_parts, '\31')
+    local new_value = table.concat(new_parts, '\31')
+    redis.call('SREM', base_key .. ':' .. name .. ':' .. old_value, hash_id)
+    redis.call('ZINCRBY', base_key .. ':' .. name, -1, old_value)
+    redis.call('SADD', base_key .. ':' .. name .. ':' .. new_value, hash_id)
+    redis.call('ZINCRBY', base_key .. ':' .. name, 1, new_value)
+end
+local shadow_fields = redis.call('HGET', KEYS[5], 'fields')
+if shadow_fields then
+    for shadow_field in string.gmatch(shadow_fields, '[^,]+') do
+        if shadow_field == field then
+            local shadow_base_key = base_key .. ':_shadow:' .. field
+            redis.call('SREM', shadow_base_key .. ':' .. old_string, hash_id)
+            redis.call('SADD', shadow_base_key .. ':' .. new, hash_id)
+        end
+    end
+end
+redis.call('ZADD', KEYS[1], now, hash_id)
+redis.call('SET', KEYS[3], now)
+local history_maxlen = tonumber(ARGV[9])
+if history_maxlen >= 0 then
+    local args = {hash_id .. ':_history'}
+    if history_maxlen > 0 then
+        table.insert(args, 'MAXLEN')
+        table.insert(args, '~')
+        table.insert(args, history_maxlen)
+    end
+    for _, v in ipairs({'*', '_ts', old_ts, '_new_ts', now, field, old or ''}) do
+        table.insert(args, v)
+    end
+    if not old then
+        table.insert(args, '_added')
+        table.insert(args, field)
+    end
+    redis.call('XADD', unpack(args))
+end
+if ARGV[10] ~= '0' then
+    local index = {}
+    if ARGV[8] == '1' then
+        index[field] = new
+    end
+    local path_fields = {}
+    for path_field in string.gmatch(ARGV[13], '[^,]+') do
+        path_fields[path_field] = true
+    end
+    for i = 14, #ARGV do
+        if path_fields[ARGV[i]] then
+            local parts = {}
+            for part in string.gmatch(ARGV[i], '[^.]+') do
+                table.insert(parts, part)
+            end
+            local ok, value = pcall(cjson.decode, redis.call('HGET', hash_id, parts[1]) or 'null')
+            for j = 2, #parts do
+                if not ok or type(value) ~= 'table' then
+                    value = nil
+                    break
+                end
+                value = value[parts[j]]
+            end
+            index[ARGV[i]] = index_string(value)
+        else
+            index[ARGV[i]] = redis.call('HGET', hash_id, ARGV[i]) or 'None'
+        end
+    end
+    redis.call(
+        'XADD', KEYS[4], 'MAXLEN', '~', ARGV[10], '*', 'id', hash_id, 'op',
+        'update', 'fields', field, 'ts', now, 'prev_ts', old_ts, 'index',
+        cjson.encode(index)
+    )
+end
+if ARGV[11] ~= '' then
+    redis.call('PUBLISH', ARGV[11], hash_id)
+end
+return {hash_id, new}
+"""
+_incr_script = None
+
+# Insert or update records by unique value (one atomic script per batch) and
+# return a flat list of hash_id, status ('inserted', 'updated', 'unchanged')
+#
+# KEYS[1]: _ts zset, KEYS[2]: _id zset, KEYS[3]: _in zset, KEYS[4]: _next_id,
+# KEYS[5]: _last_update, KEYS[6]: _changelog, KEYS[7]: _reindex hash,
+# KEYS[8]: _exp zset, KEYS[9]: _LOCK string (nothing is written and false is
+# returned if the collection is locked)
+# ARGV: now, base_key, unique_field, '1' if insert_ts, history maxlen (-1 for
+#       no history), changelog maxlen (0 for no change events), cache channel
+#       ('' for none), expire time for inserted items ('' for none), number of
+#       index fields, index fields..., number of
+#       multi_index_fields, multi_index_fields..., number of composite
+#       indexes, composite indexes ('field1+field2')..., number of json path
+#       index fields, json path index fields ('json_field.key')..., then for
+#       each record: number of fields, field1, value1, field2, value2, ...
+_UPSERT_LUA = _INDEX_STRING_LUA + """
+if redis.call('GET', KEYS[9]) == 'True' then
+    return false
+end
+local now = ARGV[1]
+local base_key = ARGV[2]
+local unique_field = ARGV[3]
+local history_maxlen = tonumber(ARGV[5])
+local changelog_maxlen = ARGV[6]
+local channel = ARGV[7]
+local expires = ARGV[8]
+local num_index = tonumber(ARGV[9])
+local index_fields = {}
+for i = 1, num_index do
+    index_fields[ARGV[9 + i]] = true
+end
+local num_multi = tonumber(ARGV[10 + num_index])
+local multi_fields = {}
+for i = 1, num_multi do
+    multi_fields[ARGV[10 + num_index + i]] = true
+end
+local num_composite = tonumber(ARGV[11 + num_index + num_multi])
+local composites = {}
+for i = 1, num_composite do
+    local name = ARGV[11 + num_index + num_multi + i]
+    local composite_fields = {}
+    for field in string.gmatch(name, '[^+]+') do
+        table.insert(composite_fields, field)
+    end
+    composites[name] = composite_fields
+end
+local function composite_value(composite_fields, values)
+    local parts = {}
+    for _, field in ipairs(composite_fields) do
+        table.insert(parts, values[field] or 'None')
+    end
+    return table.concat(parts, '\31')
+end
+local num_path = tonumber(ARGV[12 + num_index + num_multi + num_composite])
+local path_fields = {}
+for i = 1, num_path do
+    local name = ARGV[12 + num_index + num_multi + num_composite + i]
+    local parts = {}
+    for part in string.gmatch(name, '[^.]+') do
+        table.insert(parts, part)
+    end
+    path_fields[name] = parts
+end
+local function source_field(field)
+    if path_fields[field] then
+        return path_fields[field][1]
+    end
+    return field
+end
+-- value is the value of source_field(field)
+local function index_values(field, value)
+    if path_fields[field] then
+        local ok, decoded = pcall(cjson.decode, value or 'null')
+        if not ok then
+            return {'None'}
+        end
+        for j = 2, #path_fields[field] do
+            if type(decoded) ~= 'table' then
+                return {'None'}
+            end
+            decoded = decoded[path_fields[field][j]]
+        end
+        return {index_string(decoded)}
+    end
+    if not multi_fields[field] then
+        return {value or 'None'}
+    end
+    local values = {}
+    if not value then
+        return values
+    end
+    local ok, decoded = pcall(cjson.decode, value)
+    if not ok then
+        decoded = {value}
+    elseif type(decoded) ~= 'table' then
+        decoded = {decoded}
+    end
+    local seen = {}
+    for _, v in ipairs(decoded) do
+        v = index_string(v)
+        if not seen[v] then
+            seen[v] = true
+            table.insert(values, v)
+        end
+    end
+    return values
+end
+local function index_diff(field, old, new)
+    local removed, added, old_set, new_set = {}, {}, {}, {}
+    local old_values, new_values = index_values(field, old), index_values(field, new)
+    for _, v in ipairs(old_values) do
+        old_set[v] = true
+    end
+    for _, v in ipairs(new_values) do
+        new_set[v] = true
+        if not old_set[v] then
+            table.insert(added, v)
+        end
+    end
+    for _, v in ipairs(old_values) do
+        if not new_set[v] then
+            table.insert(removed, v)
+        end
+    end
+    return removed, added
+end
+local shadow_base_keys = {}
+local shadow_fields = redis.call('HGET', KEYS[7], 'fields')
+if shadow_fields then
+    for field in string.gmatch(shadow_fields, '[^,]+') do
+        shadow_base_keys[field] = base_key .. ':_shadow:' .. field
+    end
+end
+local function change_event(hash_id, op, fields, old_ts)
+    if changelog_maxlen == '0' then
+        return
+    end
+    local index = {}
+    for field, _ in pairs(index_fields) do
+        local values = index_values(field, redis.call('HGET', hash_id, source_field(field)))
+        if multi_fields[field] then
+            index[field] = values
+        else
+            index[field] = values[1]
+        end
+    end
+    table.sort(fields)
+    local args = {
+        KEYS[6], 'MAXLEN', '~', changelog_maxlen, '*', 'id', hash_id, 'op', op,
+        'fields', table.concat(fields, ','), 'ts', now, 'index', cjson.encode(index)
+    }
+    if old_ts then
+        table.insert(args, 'prev_ts')
+        table.insert(args, old_ts)
+    end
+    redis.call('XADD', unpack(args))
+end
+-- old and new are values of source_field(field)
+local function move_index_entries(hash_id, field, old, new)
+    local removed, added_values = index_diff(field, old, new)
+    for _, v in ipairs(removed) do
+        if index_fields[field] then
+            redis.call('SREM', base_key .. ':' .. field .. ':' .. v, hash_id)
+            redis.call('ZINCRBY', base_key .. ':' .. field, -1, v)
+        end
+        if shadow_base_keys[field] then
+            redis.call('SREM', shadow_base_keys[field] .. ':' .. v, hash_id)
+        end
+    end
+    for _, v in ipairs(added_values) do
+        if index_fields[field] then
+            redis.call('SADD', base_key .. ':' .. field .. ':' .. v, hash_id)
+            redis.call('ZINCRBY', base_key .. ':' .. field, 1, v)
+        end
+        if shadow_base_keys[field] then
+            redis.call('SADD', shadow_base_keys[field] .. ':' .. v, hash_id)
+        end
+    end
+end
+local results = {}
+local changed_any = false
+local i = 13 + num_index + num_multi + num_composite + num_path
+while i <= #ARGV do
+    local n = tonumber(ARGV[i])
+    local data = {}
+    local names = {}
+    for j = 1, n do
+        local field = ARGV[i + 2 * j - 1]
+        data[field] = ARGV[i + 2 * j]
+        table.insert(names, field)
+    end
+    i = i + 1 + 2 * n
+    local unique_val = data[unique_field]
+    local num = redis.call('ZSCORE', KEYS[2], unique_val)
+    local hash_id
+    if not num then
+        redis.call('SETNX', KEYS[4], 1)
+        num = redis.call('INCR', KEYS[4]) - 1
+        hash_id = base_key .. ':' .. num
+        redis.call('ZADD', KEYS[2], num, unique_val)
+        redis.call('ZADD', KEYS[1], now, hash_id)
+        if ARGV[4] == '1' then
+            redis.call('ZADD', KEYS[3], now, hash_id)
+        end
+        if expires ~= '' then
+            redis.call('ZADD', KEYS[8], expires, hash_id)
+        end
+        local mapping = {}
+        for _, field in ipairs(names) do
+            table.insert(mapping, field)
+            table.insert(mapping, data[field])
+        end
+        redis.call('HSET', hash_id, unpack(mapping))
+        for field, _ in pairs(index_fields) do
+            for _, value in ipairs(index_values(field, data[source_field(field)])) do
+                redis.call('SADD', base_key .. ':' .. field .. ':' .. value, hash_id)
+                redis.call('ZINCRBY', base_key .. ':' .. field, 1, value)
+            end
+        end
+        for field, shadow_base_key in pairs(shadow_base_keys) do
+            for _, value in ipairs(index_values(field, data[source_field(field)])) do
+                redis.call('SADD', shadow_base_key .. ':' .. value, hash_id)
+            end
+        end
+        for name, composite_fields in pairs(composites) do
+            local value = composite_value(composite_fields, data)
+            redis.call('SADD', base_key .. ':' .. name .. ':' .. value, hash_id)
+            redis.call('ZINCRBY', base_key .. ':' .. name, 1, value)
+        end
+        change_event(hash_id, 'add', names, nil)
+        changed_any = true
+        table.insert(results, hash_id)
+        table.insert(results, 'inserted')
+    else
+        hash_id = base_key .. ':' .. num
+        local old_ts = redis.call('ZSCORE', KEYS[1], hash_id)
+        local mapping = {}
+        local changed = {}
+        -- An item missing from _ts gets now (the history is rewound by _ts)
+        local history = {'*', '_ts', old_ts or now, '_new_ts', now}
+        local added = {}
+        local olds = {}
+        for _, field in ipairs(names) do
+            local value = data[field]
+            local old = redis.call('HGET', hash_id, field)
+            if field ~= unique_field and old ~= value then
+                olds[field] = old or 'None'
+                table.insert(mapping, field)
+                table.insert(mapping, value)
+                table.insert(changed, field)
+                table.insert(history, field)
+                table.insert(history, old or '')
+                if not old then
+                    table.insert(added, field)
+                end
+                for index_field, _ in pairs(index_fields) do
+                    if source_field(index_field) == field then
+                        move_index_entries(hash_id, index_field, old, value)
+                    end
+                end
+            end
+        end
+        for name, composite_fields in pairs(composites) do
+            local old_values, new_values, touched = {}, {}, false
+            for _, field in ipairs(composite_fields) do
+                if olds[field] then
+                    touched = true
+                    old_values[field] = olds[field]
+                    new_values[field] = data[field]
+                else
+                    local current = redis.call('HGET', hash_id, field)
+                    old_values[field] = current
+                    new_values[field] = current
+                end
+            end
+            if touched then
+                local old_value = composite_value(composite_fields, old_values)
+                local new_value = composite_value(composite_fields, new_values)
+                redis.call('SREM', base_key .. ':' .. name .. ':' .. old_value, hash_id)
+                redis.call('ZINCRBY', base_key .. ':' .. name, -1, old_value)
+                redis.call('SADD', base_key .. ':' .. name .. ':' .. new_value, hash_id)
+                redis.call('ZINCRBY', base_key .. ':' .. name, 1, new_value)
+            end
+        end
+        if #changed > 0 then
+            redis.call('HSET', hash_id, unpack(mapping))
+            redis.call('ZADD', KEYS[1], now, hash_id)
+            if history_maxlen >= 0 then
+                if #added > 0 then
+                    table.insert(history, '_added')
+                    table.insert(history, table.concat(added, ','))
+                end
+                if history_maxlen > 0 then
+                    table.insert(history, 1, history_maxlen)
+                    table.insert(history, 1, '~')
+                    table.insert(history, 1, 'MAXLEN')
+                end
+                redis.call('XADD', hash_id .. ':_history', unpack(history))
+            end
+            change_event(hash_id, 'update', changed, old_ts)
+            if channel ~= '' then
+                redis.call('PUBLISH', channel, hash_id)
+            end
+            changed_any = true
+            table.insert(results, hash_id)
+            table.insert(results, 'updated')
+        else
+            table.insert(results, hash_id)
+            table.insert(results, 'unchanged')
+        end
+    end
+end
+if changed_any then
+    redis.call('SET', KEYS[5], now)
+end
+return results
+"""
+_upsert_script = None
+
+# Store the union of the token sets of a text field for every token in its
+# vocabulary zset (all scores 0) that starts with a prefix
+#
+# KEYS[1]: destination set
+# KEYS[2]: vocabulary zset of the text field
+# ARGV: prefix, token set key prefix (i.e. "base:_text:field:")
+_PREFIX_UNION_LUA = """
+local tokens = redis.call('ZRANGEBYLEX', KEYS[2], '[' .. ARGV[1], '[' .. ARGV[1] .. '\\255')
+redis.call('DEL', KEYS[1])
+local batch = {}
+for _, token in ipairs(tokens) do
+    table.insert(batch, ARGV[2] .. token)
+    if #batch >= 1000 then
+        redis.call('SUNIONSTORE', KEYS[1], KEYS[1], unpack(batch))
+        batch = {}
+    end
+end
+if #batch > 0 then
+    redis.call('SUNIONSTORE', KEYS[1], KEYS[1], unpack(batch))
+end
+return redis.call('SCARD', KEYS[1])
+"""
+_prefix_union_script = None
+
+_LIVE_RANGE_LUA = """
+local function num(s)
+    if s == 'inf' or s == '+inf' then
+        return math.huge
+    elseif s == '-inf' then
+        return -math.huge
+    end
+    return tonumber(s)
+end
+local min, max, now = num(ARGV[1]), num(ARGV[2]), tonumber(ARGV[5])
+if ARGV[6] == '1' then
+    local total = redis.call('ZCOUNT', KEYS[1], ARGV[1], ARGV[2])
+    for _, hash_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[5])) do
+        local score = redis.call('ZSCORE', KEYS[1], hash_id)
+        if score and tonumber(score) >= min and tonumber(score) <= max then
+            total = total - 1
+        end
+    end
+    return total
+end
+local limit = tonumber(ARGV[4])
+local batch = math.max(limit, 100)
+local offset = 0
+local results = {}
+while #results < limit * 2 do
+    local found
+    if ARGV[3] == '1' then
+        found = redis.call('ZREVRANGEBYSCORE', KEYS[1], ARGV[2], ARGV[1], 'WITHSCORES', 'LIMIT', offset, batch)
+    else
+        found = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[2], 'WITHSCORES', 'LIMIT', offset, batch)
+    end
+    for i = 1, #found, 2 do
+        local expires = redis.call('ZSCORE', KEYS[2], found[i])
+        if not expires or tonumber(expires) > now then
+            table.insert(results, found[i])
+            table.insert(results, found[i + 1])
+            if #results >= limit * 2 then
+                break
+            end
+        end
+    end
+    if #found < batch * 2 then
+        break
+    end
+    offset = offset + batch
+end
+return results
+"""
+_live_range_script = None
+
+
+def _utc_float_to_stream_ms(utc_float):
+    """Return milliseconds since the epoch for a utc_float (for stream entry ids)"""
+    dt = dh.float_string_to_dt(str(utc_float))
+    return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+
+
+def _connect_worker(url):
+    """Give a worker process of a parallel task its own connection"""
+    rh.connect_to_server(url, attempt_docker=False, exception=True)
+
+
+def _run_worker_task(collection, method_name, chunk, kwargs):
+    """Call a Collection method for one chunk (in a worker process)
+
+    Return (pid, result, number of items, seconds)
+    """
+    start = time()
+    result, num = getattr(collection, method_name)(chunk, **kwargs)
+    return os.getpid(), result, num, time() - start
+
+
+def _json_index_string(value):
+    """Return the index set value for a value decoded from json
+
+    Numbers are formatted like index_string in the server-side scripts (which
+    can't tell 1.0 from 1): integral ones without a fraction or exponent,
+    others with 14 significant digits
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if abs(value) < 2**53 and value == int(value):
+            return '%d' % value
+        return '%.14g' % value
+    return str(value)
+
+
+def _previous_stream_id(entry_id):
+    """Return the stream entry id right before entry_id (for XREVRANGE paging)"""
+    ms, seq = (int(x) for x in ih.decode(entry_id).split('-'))
+    if seq > 0:
+        return '{}-{}'.format(ms, seq - 1)
+    return '{}-{}'.format(ms - 1, 2**64 - 1)
 
 
 class Collection(object):
@@ -41,11 +648,21 @@ class Collection(object):
     def __init__(self, namespace, name, unique_field='', index_fields='',
                  json_fields='', pickle_fields='', expected_fields='',
                  reference_fields='',
-                 insert_ts=False, list_name='', **kwargs):
+                 insert_ts=False, list_name='', read_from_replicas=False,
+                 read_your_writes=False, read_your_writes_timeout=100,
+                 cache_size=0, cache_ttl=60, cache_max_bytes=0,
+                 buffered_stats=False, stats_sample_rate=1, stats_flush_interval=5,
+                 stats_flush_size=1000, stats_top_k=1000, sketch_stats=False,
+                 changelog_maxlen=0, history_maxlen=1000, max_items=0,
+                 max_age='', expiring=False, default_ttl=0,
+                 multi_index_fields='', composite_indexes='', text_fields='',
+                 text_stemming=False, text_stop_words='', **kwargs):
         """Pass in namespace and name
 
         - unique_field: name of the optional unique field
         - index_fields: string of fields that should be indexed
+            - a 'json_field.key' path (i.e. 'request.user_id') indexes the
+              value at that path in a json field
         - json_fields: string of fields that should be serialized as JSON
         - pickle_fields: string of fields with complex/arbitrary structure
         - expected_fields: string of fields that are likely to be used
@@ -53,6 +670,65 @@ class Collection(object):
           correspond to the unique_field of another collection
         - insert_ts: if True, use an additional index for insert times
         - list_name: if provided _______________
+        - read_from_replicas: if True, send reads (get, find, random, stats)
+          to one of rh.REPLICAS (via rh.get_reader) instead of rh.REDIS
+            - find/random with terms build and scan a temporary result set
+              on rh.REDIS (replicas are read-only), so only fetching the
+              matched hashes is sent to a replica
+        - read_your_writes: if True (and read_from_replicas is True), WAIT for
+          the replicas to acknowledge any writes made by this instance before
+          the next read is sent to a replica
+        - read_your_writes_timeout: max number of milliseconds to WAIT for
+          replicas before falling back to reading from rh.REDIS
+        - cache_size: if greater than 0, keep up to this many records (and
+          unique value lookups) in an in-process LRU cache for self.get; writes
+          publish invalidation messages so other processes evict stale records
+        - cache_ttl: number of seconds a cached record is valid for
+        - cache_max_bytes: max total size of cached records (0 for no limit)
+        - buffered_stats: if True, aggregate get stats in memory and flush
+          them in one pipeline (in the background every stats_flush_interval
+          seconds, or once stats_flush_size distinct ids/fields are waiting);
+          id counts and last access times are kept for the top stats_top_k ids
+        - stats_sample_rate: fraction of self.get calls to record stats for
+          (recorded counts are weighted by 1/stats_sample_rate)
+        - stats_flush_interval: max number of seconds between get stats flushes
+        - stats_flush_size: number of distinct ids/fields to buffer before
+          flushing
+        - stats_top_k: number of most fetched (and most recently fetched) ids
+          (or find searches) to keep stats for when buffered_stats or
+          sketch_stats is True
+        - sketch_stats: if True, keep get/find stats in fixed-size keys: id and
+          search counts in count-min sketches (with top-k zsets of the
+          highest estimates) and distinct fetched ids in hourly HyperLogLogs
+        - changelog_maxlen: if greater than 0, append an event for every
+          add/update/delete/reindex to a Redis Stream (in the same pipeline as
+          the change) capped at about this many events (see self.changes)
+        - history_maxlen: max number (approximately) of updates to keep in the
+          change history stream of each hash_id (0 for no limit)
+        - max_items: if greater than 0, self.trim deletes the oldest items
+          beyond this many
+        - max_age: 'num:unit' string (i.e. 30:days); if specified, self.trim
+          deletes items older than this (by insert time if insert_ts is True)
+        - expiring: if True, items can be added with a _ttl (or given one with
+          self.expire); get and find skip expired items and self.trim deletes
+          them
+        - default_ttl: if greater than 0, the ttl (in seconds) of items added
+          without one (implies expiring=True)
+        - multi_index_fields: string of fields whose values are lists/sets
+          (stored as JSON) where each element is indexed, i.e. 'tag:redis'
+          matches items with 'redis' in their tag list
+        - composite_indexes: string of index field combos joined by '+' (i.e.
+          'host+uri, host+status') to keep one index set per combination of
+          values for; find uses a composite set directly (instead of
+          intersecting single field sets) when its terms cover the combo
+        - text_fields: string of fields with text to keep a word (token)
+          index for, i.e. find terms 'error~timeout' (items with all words of
+          'timeout' in their error field) or 'text^redi*' (items with a word
+          starting with 'redi' in their text field)
+        - text_stemming: if True, remove common English inflections from
+          words of text_fields (and from find terms) before indexing them
+        - text_stop_words: string of words of text_fields not to index (or
+          'english' for redis_helper.text.ENGLISH_STOP_WORDS)
         - kwargs: any other kwargs passed in
             - rx_{field}: a regular expression used to validate the field
               before add/update
@@ -69,12 +745,42 @@ class Collection(object):
         self._var_name = ih.make_var_name('{}_{}'.format(namespace, name))
         self._unique_field = unique_field
         index_fields_set = ih.string_to_set(index_fields)
+        self._multi_index_fields = ih.string_to_set(multi_index_fields)
+        self._text_fields = ih.string_to_set(text_fields)
+        self._text_stemming = text_stemming
+        if text_stop_words == 'english':
+            self._text_stop_words = set(ENGLISH_STOP_WORDS)
+        else:
+            self._text_stop_words = {word.lower() for word in ih.string_to_set(text_stop_words)}
         self._json_fields = ih.string_to_set(json_fields)
         self._pickle_fields = ih.string_to_set(pickle_fields)
         self._expected_fields = ih.string_to_set(expected_fields)
         self._reference_fields = ih.string_to_set(reference_fields)
         self._insert_ts = insert_ts
         self._list_name = list_name
+        self._read_from_replicas = read_from_replicas
+        self._read_your_writes = read_your_writes
+        self._read_your_writes_timeout = read_your_writes_timeout
+        self._unreplicated_writes = False
+        self._cache_size = cache_size
+        self._cache_ttl = cache_ttl
+        self._cache_max_bytes = cache_max_bytes
+        self._cache = None
+        self._buffered_stats = buffered_stats
+        self._stats_sample_rate = stats_sample_rate
+        self._stats_flush_interval = stats_flush_interval
+        self._stats_flush_size = stats_flush_size
+        self._stats_top_k = stats_top_k
+        self._sketch_stats = sketch_stats
+        self._stats_buffer = None
+        self._changelog_maxlen = changelog_maxlen
+        self._history_maxlen = history_maxlen
+        self._max_items = max_items
+        self._max_age = max_age
+        self._expiring = expiring or bool(default_ttl)
+        self._shadow_fields = []
+        self._default_ttl = default_ttl
+        self._trimmer = None
         self.field_rx_dict = {}
         self.field_reference_dict = {}
 
@@ -88,26 +794,82 @@ class Collection(object):
             .union(self._pickle_fields.intersection(u))
         )
         assert invalid == set(), 'field(s) used in too many places: {}'.format(invalid)
+        invalid = (
+            self._multi_index_fields.intersection(index_fields_set)
+            .union(self._multi_index_fields.intersection(self._pickle_fields))
+            .union(self._multi_index_fields.intersection(u))
+        )
+        assert invalid == set(), 'field(s) used in too many places: {}'.format(invalid)
+        invalid = (
+            self._text_fields.intersection(self._json_fields)
+            .union(self._text_fields.intersection(self._pickle_fields))
+            .union(self._text_fields.intersection(self._multi_index_fields))
+        )
+        assert invalid == set(), 'text field(s) cannot be json/pickle fields: {}'.format(invalid)
         invalid = (
             META_FIELDS.intersection(
                 index_fields_set.union(self._json_fields)
                 .union(self._pickle_fields)
+                .union(self._multi_index_fields)
+                .union(self._text_fields)
                 .union(u)
             )
         )
         assert invalid == set(), '{} not allowed to be saved or updated'.format(invalid)
+        self._path_index_fields = {}
+        for index_field in index_fields_set:
+            json_field, dot, path = index_field.partition('.')
+            if dot and json_field in self._json_fields:
+                self._path_index_fields[index_field] = (json_field, path.split('.'))
+        self._json_fields.update(self._multi_index_fields)
+        self._composite_indexes = OrderedDict()
+        for composite in ih.string_to_list(composite_indexes):
+            composite_fields = tuple(f.strip() for f in composite.split('+'))
+            assert len(composite_fields) > 1, (
+                '{} does not combine multiple index fields'.format(repr(composite))
+            )
+            invalid = set(composite_fields) - index_fields_set
+            assert invalid == set(), (
+                'composite index field(s) not in index_fields: {}'.format(invalid)
+            )
+            invalid = set(composite_fields).intersection(self._path_index_fields)
+            assert invalid == set(), (
+                'json path index field(s) cannot be in a composite index: {}'.format(invalid)
+            )
+            self._composite_indexes['+'.join(composite_fields)] = composite_fields
+        index_fields_set.update(self._multi_index_fields)
 
         self._base_key = self._make_key(namespace, name)
         self._index_base_keys = {
             index_field: self._make_key(self._base_key, index_field)
             for index_field in index_fields_set
         }
+        self._composite_base_keys = {
+            name: self._make_key(self._base_key, name)
+            for name in self._composite_indexes
+        }
+        self._text_base_keys = {
+            text_field: self._make_key(self._base_key, '_text', text_field)
+            for text_field in self._text_fields
+        }
         self._next_id_string_key = self._make_key(self._base_key, '_next_id')
         self._ts_zset_key = self._make_key(self._base_key, '_ts')
         self._id_zset_key = self._make_key(self._base_key, '_id')
         self._in_zset_key = self._make_key(self._base_key, '_in')
+        self._exp_zset_key = self._make_key(self._base_key, '_exp')
+        self._last_update_string_key = self._make_key(self._base_key, '_last_update')
+        self._wait_string_key = self._make_key(self._base_key, '_wait')
+        self._ingest_stream_key = self._make_key(self._base_key, '_ingest')
+        self._ingest_stats_hash_key = self._make_key(self._base_key, '_ingest_stats')
+        self._ingest_errors_list_key = self._make_key(self._base_key, '_ingest_errors')
+        self._changelog_stream_key = self._make_key(self._base_key, '_changelog')
+        self._reindex_hash_key = self._make_key(self._base_key, '_reindex')
         self._get_id_stats_hash_key = self._make_key(self._base_key, '_get_id_stats')
         self._get_field_stats_hash_key = self._make_key(self._base_key, '_get_field_stats')
+        self._get_id_top_zset_key = self._make_key(self._base_key, '_get_id_top')
+        self._get_id_last_zset_key = self._make_key(self._base_key, '_get_id_last')
+        self._get_id_cms_key = self._make_key(self._base_key, '_get_id_cms')
+        self._get_id_hll_base_key = self._make_key(self._base_key, '_get_id_hll')
         self._lock_string_key = self._make_key(self._base_key, '_LOCK')
         self._lock_time_string_key = self._make_key(self._base_key, '_LOCK_TIME')
         self._lock_durations_list_key = self._make_key(self._base_key, '_LOCK_DURATIONS')
@@ -115,6 +877,10 @@ class Collection(object):
         self._find_next_id_string_key = self._make_key(self._find_base_key, '_next_id')
         self._find_stats_hash_key = self._make_key(self._find_base_key, '_stats')
         self._find_searches_zset_key = self._make_key(self._find_base_key, '_searches')
+        self._find_cms_key = self._make_key(self._find_base_key, '_cms')
+        self._find_top_zset_key = self._make_key(self._find_base_key, '_top')
+        self._find_sizes_zset_key = self._make_key(self._find_base_key, '_sizes')
+        self._cache_channel = self._make_key(self._base_key, '_invalidate')
 
         ref_errors = []
         for f in self._reference_fields:
@@ -133,6 +899,8 @@ class Collection(object):
             self.field_reference_dict[field] = model
         if ref_errors:
             warnings.warn('Reference field errors: ' + repr(ref_errors))
+        if read_from_replicas and not rh.REPLICAS and rh.REDIS_REPLICA_URLS:
+            rh.connect_to_replicas()
 
         _parts = [
             '({}, {}'.format(repr(namespace), repr(name)),
@@ -144,6 +912,29 @@ class Collection(object):
             'reference_fields={}'.format(repr(reference_fields)) if reference_fields else '',
             'insert_ts={}'.format(repr(insert_ts)) if insert_ts else '',
             'list_name={}'.format(repr(list_name)) if list_name else '',
+            'read_from_replicas={}'.format(repr(read_from_replicas)) if read_from_replicas else '',
+            'read_your_writes={}'.format(repr(read_your_writes)) if read_your_writes else '',
+            'read_your_writes_timeout={}'.format(repr(read_your_writes_timeout)) if read_your_writes_timeout != 100 else '',
+            'cache_size={}'.format(repr(cache_size)) if cache_size else '',
+            'cache_ttl={}'.format(repr(cache_ttl)) if cache_size and cache_ttl != 60 else '',
+            'cache_max_bytes={}'.format(repr(cache_max_bytes)) if cache_max_bytes else '',
+            'buffered_stats={}'.format(repr(buffered_stats)) if buffered_stats else '',
+            'stats_sample_rate={}'.format(repr(stats_sample_rate)) if stats_sample_rate != 1 else '',
+            'stats_flush_interval={}'.format(repr(stats_flush_interval)) if stats_flush_interval != 5 else '',
+            'stats_flush_size={}'.format(repr(stats_flush_size)) if stats_flush_size != 1000 else '',
+            'stats_top_k={}'.format(repr(stats_top_k)) if stats_top_k != 1000 else '',
+            'sketch_stats={}'.format(repr(sketch_stats)) if sketch_stats else '',
+            'changelog_maxlen={}'.format(repr(changelog_maxlen)) if changelog_maxlen else '',
+            'history_maxlen={}'.format(repr(history_maxlen)) if history_maxlen != 1000 else '',
+            'max_items={}'.format(repr(max_items)) if max_items else '',
+            'max_age={}'.format(repr(max_age)) if max_age else '',
+            'expiring={}'.format(repr(expiring)) if expiring else '',
+            'default_ttl={}'.format(repr(default_ttl)) if default_ttl else '',
+            'multi_index_fields={}'.format(repr(multi_index_fields)) if multi_index_fields else '',
+            'composite_indexes={}'.format(repr(composite_indexes)) if composite_indexes else '',
+            'text_fields={}'.format(repr(text_fields)) if text_fields else '',
+            'text_stemming={}'.format(repr(text_stemming)) if text_stemming else '',
+            'text_stop_words={}'.format(repr(text_stop_words)) if text_stop_words else '',
         ]
         for k, v in sorted(kwargs.items()):
             if k.startswith('rx_'):
@@ -155,10 +946,7 @@ class Collection(object):
             ', '.join([p for p in _parts if p != '']),
             ')'
         ])
-        pipe = rh.REDIS.pipeline()
-        pipe.hset('_REDIS_HELPER_COLLECTION', self._base_key + '--last_args', self._init_args)
-        pipe.hset('_REDIS_HELPER_COLLECTION', self._base_key + '--last_size', self.size)
-        pipe.execute()
+        rh.REDIS.hset('_REDIS_HELPER_COLLECTION', self._base_key + '--last_args', self._init_args)
 
         if self.__class__.__name__ != 'Collection':
             item = rh.REDIS.get(self._init_args)
@@ -168,6 +956,19 @@ class Collection(object):
     def __repr__(self):
         return self._init_args
 
+    def __getstate__(self):
+        """Return instance state for pickling (without caches/threads/connections)"""
+        state = self.__dict__.copy()
+        for attr in _RUNTIME_ATTRS:
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache = None
+        self._stats_buffer = None
+        self._trimmer = None
+
     def __len__(self):
         return self.size
 
@@ -216,15 +1017,32 @@ class Collection(object):
         result = pipe.execute()
         return self._make_key(base_key, int(result[1]))
 
+    def _get_next_keys(self, next_id_string_key, num, base_key=None):
+        """Get the next num keys to use and increment next_id_string_key by num"""
+        if base_key is None:
+            base_key = ':'.join(next_id_string_key.split(':')[:-1])
+        pipe = rh.REDIS.pipeline()
+        pipe.setnx(next_id_string_key, 1)
+        pipe.incrby(next_id_string_key, num)
+        result = pipe.execute()
+        end = int(result[1])
+        return [self._make_key(base_key, i) for i in range(end - num, end)]
+
     def _get_next_find_key(self):
         return self._get_next_key(self._find_next_id_string_key, self._find_base_key)
 
     def _lock(self):
-        """Lock the collection from being modified"""
+        """Lock the collection from being modified
+
+        Also get the index fields of any online reindex in progress, so writes
+        made while locked are mirrored to the shadow indexes
+        """
         pipe = rh.REDIS.pipeline()
         pipe.set(self._lock_string_key, 'True')
         pipe.set(self._lock_time_string_key, dh.utc_now_float_string())
-        pipe.execute()
+        pipe.hget(self._reindex_hash_key, 'fields')
+        shadow_fields = pipe.execute()[-1]
+        self._shadow_fields = ih.string_to_list(ih.decode(shadow_fields)) if shadow_fields else []
 
     def _unlock(self):
         """Unlock the collection and allow modifications"""
@@ -237,6 +1055,74 @@ class Collection(object):
             pipe.delete(self._lock_time_string_key)
             pipe.lpush(self._lock_durations_list_key, '{}--{}'.format(now_string, duration))
         pipe.execute()
+        self._unreplicated_writes = True
+
+    @property
+    def _reader(self):
+        """Return the redis connection that reads should be sent to
+
+        If read_from_replicas is False (or there are no replicas), return
+        rh.REDIS. If read_your_writes is True and this instance has written
+        since its last replica read, WAIT for all replicas to acknowledge the
+        writes (falling back to rh.REDIS if they don't in time)
+
+        WAIT only covers writes made on its own connection, and the writes
+        may have gone out on any connection in the pool, so the WAIT is sent
+        in a pipeline right after an INCR of self._wait_string_key (the
+        replication offset of that INCR is past every earlier write)
+        """
+        if not self._read_from_replicas or not rh.REPLICAS:
+            return rh.REDIS
+        if self._read_your_writes and self._unreplicated_writes:
+            num_replicas = len(rh.REPLICAS)
+            pipe = rh.REDIS.pipeline(transaction=False)
+            pipe.incr(self._wait_string_key)
+            pipe.wait(num_replicas, self._read_your_writes_timeout)
+            acked = pipe.execute()[-1]
+            if acked < num_replicas:
+                return rh.REDIS
+            self._unreplicated_writes = False
+        return rh.get_reader()
+
+    def _get_cache(self):
+        """Return the LRUCache for records (or None if cache_size is 0)
+
+        The cache is created on first use, after subscribing to the
+        invalidation channel (and is cleared if the subscription thread died)
+        """
+        if not self._cache_size:
+            return None
+        if self._cache is None:
+            self._cache = LRUCache(self._cache_size, self._cache_ttl, self._cache_max_bytes)
+            self._cache_thread = None
+        if self._cache_thread is None or not self._cache_thread.is_alive():
+            self._cache.clear()
+            self._cache_pubsub = rh.REDIS.pubsub(ignore_subscribe_messages=True)
+            self._cache_pubsub.subscribe(**{self._cache_channel: self._handle_invalidation})
+            self._cache_thread = self._cache_pubsub.run_in_thread(sleep_time=1, daemon=True)
+        return self._cache
+
+    def _handle_invalidation(self, message):
+        """Evict the hash_id (and unique value) in an invalidation message"""
+        hash_id, *unique_val = ih.decode(message['data']).split('\n', 1)
+        keys = [hash_id]
+        if unique_val:
+            keys.append(('_unique', unique_val[0]))
+        if self._cache is not None:
+            self._cache.pop(*keys)
+
+    def _invalidate_cached(self, pipe, hash_id, unique_val=None):
+        """Add a cache invalidation message for hash_id to pipe and evict locally
+
+        - unique_val: the unique value of hash_id (only needed when deleting)
+        """
+        if not self._cache_size:
+            return
+        message = ih.decode(hash_id)
+        if unique_val is not None:
+            message += '\n' + str(ih.decode(unique_val))
+        pipe.publish(self._cache_channel, message)
+        self._handle_invalidation({'data': message})
 
     @property
     def is_locked(self):
@@ -254,38 +1140,114 @@ class Collection(object):
             sleep(sleeptime)
         return total_sleep
 
-    def add(self, **data):
+    def add(self, _ttl=None, **data):
         """Add all fields and values in data to the collection
 
+        - _ttl: number of seconds until the item expires (collection must be
+          expiring); if None, use default_ttl (a field named 'ttl' is stored
+          like any other field)
+
         If self._unique_field is a non-empty string, that field must be provided
         in the data and there must not be an item in the collection with the
         same value for that field
         """
+        return self.add_many(data, ttl=_ttl)[0]
+
+    def add_many(self, *records, on_error=None, ttl=None):
+        """Add many dicts to the collection using pipelined round trips
+
+        - records: dicts of fields and values (see self.add)
+        - on_error: callable accepting (record, exception) for any record that
+          fails validation or uniqueness checks; if None, the first exception
+          is raised before anything is added
+        - ttl: number of seconds until the added items expire (collection must
+          be expiring); if None, use default_ttl
+
+        Return a list of hash_ids (None for any record that was not added)
+        """
+        if ttl is not None:
+            assert self._expiring, 'Collection must be created with expiring=True to use ttl'
+        else:
+            ttl = self._default_ttl
+        records = [dict(record) for record in records]
+        existing_scores = [None] * len(records)
+        if self._unique_field:
+            pipe = rh.REDIS.pipeline(transaction=False)
+            for record in records:
+                pipe.zscore(self._id_zset_key, str(record.get(self._unique_field)))
+            existing_scores = pipe.execute()
+
+        valid = []
+        batch_unique_vals = set()
+        for i, record in enumerate(records):
+            try:
+                self._check_new_record(record, existing_scores[i], batch_unique_vals)
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(record, e)
+            else:
+                valid.append(i)
+
+        keys = [None] * len(records)
+        if not valid:
+            return keys
+
+        self.wait_for_unlock()
+        self._lock()
+        try:
+            now = self.now_utc_float
+            new_keys = self._get_next_keys(self._next_id_string_key, len(valid), self._base_key)
+            pipe = rh.REDIS.pipeline()
+            pipe.set(self._last_update_string_key, now)
+            expires = self._expires_at(ttl, now) if ttl else None
+            for i, key in zip(valid, new_keys):
+                self._queue_add(pipe, key, records[i], now)
+                if expires is not None:
+                    pipe.zadd(self._exp_zset_key, {key: expires})
+                keys[i] = key
+            pipe.execute()
+        finally:
+            self._unlock()
+        return keys
+
+    def _check_new_record(self, data, existing_score=None, batch_unique_vals=None):
+        """Raise an exception if data cannot be added to the collection
+
+        - existing_score: score of the unique value of data in self._id_zset_key
+        - batch_unique_vals: set of unique values already in the same batch
+          (the unique value of data is added to it)
+        """
         for mf in META_FIELDS:
             assert mf not in data, (
                 '{} is a meta field that cannot be saved or updated'.format(repr(mf))
             )
+        self._check_path_index_fields(data)
         if self._unique_field:
             unique_val = data.get(self._unique_field)
             assert unique_val is not None, (
                 'unique field {} is not in data'.format(repr(self._unique_field))
             )
-            score = rh.REDIS.zscore(self._id_zset_key, unique_val)
-            assert score is None, (
+            assert existing_score is None, (
                 '{}={} already exists'.format(self._unique_field, repr(unique_val))
             )
+            if batch_unique_vals is not None:
+                assert str(unique_val) not in batch_unique_vals, (
+                    '{}={} already exists'.format(self._unique_field, repr(unique_val))
+                )
+                batch_unique_vals.add(str(unique_val))
         errors = self.validate(**data)
         if errors:
             raise Exception('Validation errors: ' + repr(errors))
 
-        self.wait_for_unlock()
-        self._lock()
-        now = self.now_utc_float
-        key = self._get_next_key(self._next_id_string_key, self._base_key)
-        id_num = int(key.split(':')[-1])
+    def _serialize(self, data):
+        """Return a copy of data with values converted to what is stored in redis"""
+        data = dict(data)
         for field in self._json_fields:
             val = data.get(field)
             if val is not None:
+                if field in self._multi_index_fields and not isinstance(val, str):
+                    val = self._multi_list(val)
                 data[field] = dumps(val)
         for field in self._pickle_fields:
             val = data.get(field)
@@ -294,27 +1256,543 @@ class Collection(object):
         for field, value in data.items():
             if type(value) not in (bytes, str, int, float):
                 data[field] = str(value)
-        pipe = rh.REDIS.pipeline()
-        pipe.hset('_REDIS_HELPER_COLLECTION', self._base_key + '--last_update', self.now_utc_float)
-        pipe.hset('_REDIS_HELPER_COLLECTION', self._base_key + '--last_size', self.size + 1)
+        return data
+
+    def _decode_value(self, field, value):
+        """Return the Python value for a field value returned by redis"""
+        if value is None:
+            return None
+        if field in self._json_fields:
+            try:
+                return loads(value)
+            except TypeError:
+                try:
+                    return loads(ih.decode(value))
+                except TypeError:
+                    return ih.decode(value)
+            except ValueError:
+                return ih.decode(value)
+        elif field in self._pickle_fields:
+            return pickle.loads(value)
+        return ih.from_string(ih.decode(value))
+
+    def _multi_list(self, value):
+        """Return list of the elements of a multi_index_fields value
+
+        Sets are sorted (so they can be stored as JSON) and a scalar is
+        treated as a list of one element
+        """
+        if value is None:
+            return []
+        if isinstance(value, (set, frozenset)):
+            return sorted(value, key=str)
+        if isinstance(value, (list, tuple)):
+            return list(value)
+        return [value]
+
+    def _index_strings(self, field, value):
+        """Return list of index set values that value of index field is stored under
+
+        Scalar index fields have one (str(value)); json path index fields have
+        one and multi_index_fields have one per distinct element (formatted
+        with _json_index_string, like the server-side scripts do)
+        """
+        if field in self._path_index_fields:
+            return [_json_index_string(value)]
+        if field not in self._multi_index_fields:
+            return [str(value)]
+        return list(OrderedDict.fromkeys(_json_index_string(v) for v in self._multi_list(value)))
+
+    def _raw_index_strings(self, field, raw):
+        """Return list of index set values for a raw value of index field returned by redis
+
+        Values of json path index fields are the ones added by self._with_path_values
+        """
+        if field in self._path_index_fields:
+            return self._index_strings(field, raw)
+        if field in self._multi_index_fields:
+            return self._index_strings(field, self._decode_value(field, raw))
+        return [str(ih.decode(raw))]
+
+    def _raw_event_index_value(self, field, raw):
+        """Return the value of index field for a change event (from a raw value)"""
+        strings = self._raw_index_strings(field, raw)
+        return strings if field in self._multi_index_fields else strings[0]
+
+    def _event_index_value(self, field, value):
+        """Return the value of index field for a change event"""
+        if field in self._multi_index_fields:
+            return self._index_strings(field, value)
+        return self._index_strings(field, value)[0]
+
+    def _composite_values(self, strings):
+        """Return list of (count zset key, value) tuples for composite indexes
+
+        - strings: dict of index fields and their index set values (composite
+          indexes with a field missing from strings are skipped)
+        """
+        return [
+            (self._composite_base_keys[name], _COMPOSITE_SEP.join(strings[f] for f in fields))
+            for name, fields in self._composite_indexes.items()
+            if all(f in strings for f in fields)
+        ]
+
+    def _with_path_values(self, raw):
+        """Return a copy of raw (dict of fields and values returned by redis)
+        with the values of json path index fields added
+        """
+        raw = dict(raw)
+        if self._path_index_fields:
+            decoded = {
+                field: self._decode_value(field, raw[field])
+                for field in self._index_source_fields(self._path_index_fields)
+                if field in raw
+            }
+            raw.update(self._index_field_values(decoded, list(self._path_index_fields)))
+        return raw
+
+    def _decoded_index_values(self, raw, index_fields):
+        """Return list of (index field, decoded value) tuples for index_fields
+
+        - raw: dict of fields and values returned by redis (the fields
+          returned by self._index_source_fields for index_fields)
+        """
+        decoded = {field: self._decode_value(field, value) for field, value in raw.items()}
+        values = self._index_field_values(decoded, index_fields)
+        return [(field, values.get(field)) for field in index_fields]
+
+    def _check_path_index_fields(self, data):
+        """Raise an AssertionError if data has a json path index field"""
+        for field in self._path_index_fields:
+            assert field not in data, (
+                '{} is a json path index field that cannot be saved or updated'.format(repr(field))
+            )
+
+    def _tokens(self, value):
+        """Return list of the distinct tokens that value of a text field is indexed under
+
+        - value: the stored (serialized or raw) value
+        """
+        if value is None:
+            return []
+        return tokenize(ih.decode(value), self._text_stemming, self._text_stop_words)
+
+    def _queue_text_diff(self, pipe, hash_id, field, removed_tokens, added_tokens):
+        """Add the commands to move hash_id between token sets of text field to pipe
+
+        Added tokens are also added to the field's vocabulary zset (all scores
+        0, so prefixes can be matched with ZRANGEBYLEX)
+        """
+        base_key = self._text_base_keys[field]
+        for token in removed_tokens:
+            pipe.srem(self._make_key(base_key, token), hash_id)
+        for token in added_tokens:
+            pipe.sadd(self._make_key(base_key, token), hash_id)
+        if added_tokens:
+            pipe.zadd(base_key, {token: 0 for token in added_tokens})
+
+    def _index_source_fields(self, index_fields):
+        """Return list of the fields that index_fields are read from
+
+        Json path index fields are read from their json field
+        """
+        return list(OrderedDict.fromkeys(
+            self._path_index_fields[field][0] if field in self._path_index_fields else field
+            for field in index_fields
+        ))
+
+    def _index_field_values(self, values, index_fields=None):
+        """Return dict of index fields and their values
+
+        - values: dict of fields and their (decoded or not yet serialized) values
+        - index_fields: list of index fields (default is all index fields)
+
+        Values of json path index fields are extracted from their json field
+        (None if the path is missing). Index fields whose source field is not
+        in values are skipped
+        """
+        result = {}
+        if index_fields is None:
+            index_fields = self._index_base_keys
+        for field in index_fields:
+            if field in self._path_index_fields:
+                json_field, path = self._path_index_fields[field]
+                if json_field not in values:
+                    continue
+                value = values[json_field]
+                for key in path:
+                    value = value.get(key) if isinstance(value, dict) else None
+                result[field] = value
+            elif field in values:
+                result[field] = values[field]
+        return result
+
+    def _queue_add(self, pipe, key, data, now):
+        """Add the commands to store data at key (and index it) to pipe
+
+        - key: the hash_id for the new item
+        - data: dict of fields and values (not yet serialized)
+        - now: utc_float
+        """
+        id_num = int(key.split(':')[-1])
+        original = data
+        data = self._serialize(data)
         if self._unique_field:
-            pipe.zadd(self._id_zset_key, {unique_val: id_num})
+            pipe.zadd(self._id_zset_key, {data[self._unique_field]: id_num})
         pipe.zadd(self._ts_zset_key, {key: now})
         if self._insert_ts:
             pipe.zadd(self._in_zset_key, {key: now})
         pipe.hset(key, mapping=data)
+        index = {}
+        strings = {}
+        path_values = self._index_field_values(original, list(self._path_index_fields))
         for index_field, base_key in self._index_base_keys.items():
-            key_name = self._make_key(base_key, data.get(index_field))
-            pipe.sadd(key_name, key)
-            pipe.zincrby(base_key, 1, str(data.get(index_field)))
+            value = original.get(index_field)
+            if index_field in self._path_index_fields:
+                value = path_values.get(index_field)
+            elif index_field not in self._multi_index_fields:
+                value = data.get(index_field)
+                strings[index_field] = str(value)
+            for index_string in self._index_strings(index_field, value):
+                pipe.sadd(self._make_key(base_key, index_string), key)
+                pipe.zincrby(base_key, 1, index_string)
+            index[index_field] = self._event_index_value(index_field, value)
+        for base_key, value in self._composite_values(strings):
+            pipe.sadd(self._make_key(base_key, value), key)
+            pipe.zincrby(base_key, 1, value)
+        for shadow_field in self._shadow_fields:
+            value = original.get(shadow_field)
+            if shadow_field in self._path_index_fields:
+                value = path_values.get(shadow_field)
+            elif shadow_field not in self._multi_index_fields:
+                value = data.get(shadow_field)
+            for index_string in self._index_strings(shadow_field, value):
+                pipe.sadd(self._make_key(self._shadow_base_key(shadow_field), index_string), key)
+        for text_field in self._text_fields:
+            self._queue_text_diff(pipe, key, text_field, [], self._tokens(data.get(text_field)))
+        self._queue_change(pipe, 'add', key, data.keys(), now, index=index)
+
+    def _queue_change(self, pipe, op, hash_id, fields, now, prev_ts=None,
+                      index=None):
+        """Add a change event to pipe (if changelog_maxlen is set)
+
+        - op: one of add, update, delete, reindex
+        - hash_id: hash_id that was changed ('' for reindex)
+        - fields: iterable of field names that were changed
+        - now: utc_float of the change
+        - prev_ts: previous modify time of hash_id (for updates)
+        - index: dict of index fields and their (string) values after the
+          change, so watchers can match terms without querying
+        """
+        if not self._changelog_maxlen:
+            return
+        event = {'id': hash_id, 'op': op, 'fields': ','.join(sorted(fields)), 'ts': now}
+        if prev_ts is not None:
+            event['prev_ts'] = prev_ts
+        if index is not None:
+            event['index'] = dumps(index)
+        pipe.xadd(
+            self._changelog_stream_key, event,
+            maxlen=self._changelog_maxlen, approximate=True
+        )
+
+    def changes(self, since_id='0', block=None, count=100):
+        """Generate change events (dicts) appended after since_id
+
+        - since_id: a stream entry id ('0' for all available events, '$' for
+          only events appended after this is called)
+        - block: number of milliseconds to wait for new events with a blocking
+          XREAD; if None, stop once all available events have been generated,
+          otherwise keep waiting for new events forever
+        - count: max number of events to read per round trip
+
+        Each event has '_stream_id', '_id', 'op', 'fields' (list), '_ts', and
+        'index' (dict of index field values after the change; empty for
+        reindex), plus 'prev_ts' for updates. Save the '_stream_id' of the
+        last event processed to resume from it later
+        """
+        last_id = since_id
+        if last_id == '$':
+            last = rh.REDIS.xrevrange(self._changelog_stream_key, count=1)
+            last_id = ih.decode(last[0][0]) if last else '0-0'
+        while True:
+            response = rh.REDIS.xread(
+                {self._changelog_stream_key: last_id}, count=count, block=block
+            )
+            if not response:
+                if block is None:
+                    return
+                continue
+            for entry_id, event in response[0][1]:
+                last_id = ih.decode(entry_id)
+                event = {ih.decode(k): ih.decode(v) for k, v in event.items()}
+                result = {
+                    '_stream_id': last_id,
+                    '_id': event['id'],
+                    'op': event['op'],
+                    'fields': event['fields'].split(',') if event['fields'] else [],
+                    '_ts': float(event['ts']),
+                    'index': loads(event['index']) if 'index' in event else {},
+                }
+                if 'prev_ts' in event:
+                    result['prev_ts'] = float(event['prev_ts'])
+                yield result
+
+    def watch(self, terms='', fields='', since_id='$', since=None,
+              block=5000, count=100, include_meta=True):
+        """Generate items that are added or updated and match terms
+
+        - terms: string of 'index_field:value' pairs separated by any of , ; |
+          (values for the same field are OR'd, different fields are AND'd)
+        - fields: string of field names to get for each matching item
+        - since_id: a change stream entry id to resume after ('$' for only
+          changes made after this is called)
+        - since: a utc_float to resume from (instead of since_id), i.e. the
+          '_ts' of the last item a watcher received before reconnecting
+        - block: number of milliseconds to wait per blocking XREAD
+        - count: max number of change events to read per round trip
+        - include_meta: if True include attributes _id and _ts
+
+        Matching is done against the index values stored in each change event
+        (see self.changes), so watching costs writers nothing extra and
+        requires changelog_maxlen to be set
+        """
+        assert self._changelog_maxlen, 'Collection must be created with changelog_maxlen to watch'
+        term_values = defaultdict(set)
+        for term in ih.string_to_set(terms):
+            index_field, *value = term.split(':')
+            assert index_field in self._index_base_keys, (
+                '{} is not an index field'.format(repr(index_field))
+            )
+            term_values[index_field].add(':'.join(value))
+        last_id = since_id
+        if since is not None:
+            last_id = '{}-0'.format(_utc_float_to_stream_ms(since))
+        while True:
+            try:
+                for event in self.changes(since_id=last_id, block=block, count=count):
+                    last_id = event['_stream_id']
+                    if event['op'] not in ('add', 'update'):
+                        continue
+                    index = event['index']
+                    if all(
+                        not values.isdisjoint(index[f])
+                        if isinstance(index.get(f), (list, dict))
+                        else index.get(f) in values
+                        for f, values in term_values.items()
+                    ):
+                        item = self.get(
+                            event['_id'], fields, include_meta=include_meta,
+                            update_get_stats=False, from_primary=True
+                        )
+                        if item:
+                            yield item
+            except ConnectionError as e:
+                rh.logger.error('Watcher for {} lost connection: {}'.format(self._base_key, repr(e)))
+                sleep(1)
+
+    def buffered_writer(self, max_items=1000, max_latency_ms=100,
+                        max_queue_size=10000, put_timeout=None, on_error=None,
+                        change_history=True):
+        """Return a BufferedWriter that adds/updates items from a background thread
+
+        - max_items: max number of queued adds/updates to write per batch
+        - max_latency_ms: max number of milliseconds a queued add/update will
+          wait before its batch is written
+        - max_queue_size: max number of adds/updates that can be queued
+          (calls to add/update block when the queue is full)
+        - put_timeout: max number of seconds to block when the queue is full
+          before raising queue.Full (None to wait forever)
+        - on_error: callable accepting (record, exception) for records that
+          fail validation/uniqueness (or can't be written)
+        - change_history: passed to self.update_many for queued updates
+
+        Use as a context manager (or call 'close') to drain the queue on exit
+        """
+        return BufferedWriter(
+            self,
+            max_items=max_items,
+            max_latency_ms=max_latency_ms,
+            max_queue_size=max_queue_size,
+            put_timeout=put_timeout,
+            on_error=on_error,
+            change_history=change_history
+        )
+
+    def ingest(self, **data):
+        """Append data to the ingest stream (to be added by an indexer later)
+
+        Each field of data is a field of the stream entry, encoded the same
+        way it would be in the hash (see self._serialize)
+
+        Return the stream entry id. Use self.index_ingested (or the rh-indexer
+        console script) to add ingested data to the collection
+        """
+        assert data, 'data cannot be empty'
+        return ih.decode(rh.REDIS.xadd(self._ingest_stream_key, self._serialize(data)))
+
+    def ingest_many(self, *records):
+        """Append many dicts to the ingest stream in a single pipeline"""
+        assert all(records), 'records cannot be empty'
+        pipe = rh.REDIS.pipeline(transaction=False)
+        for record in records:
+            pipe.xadd(self._ingest_stream_key, self._serialize(record))
+        return [ih.decode(entry_id) for entry_id in pipe.execute()]
+
+    def _decode_ingested(self, fields):
+        """Return the record for the fields of an ingest stream entry
+
+        json/pickle fields are decoded; other values are left as the strings
+        that self.add_many would store anyway
+        """
+        record = {}
+        for field, value in fields.items():
+            field = ih.decode(field)
+            if field in self._json_fields or field in self._pickle_fields:
+                record[field] = self._decode_value(field, value)
+            else:
+                record[field] = ih.decode(value)
+        return record
+
+    def _ensure_ingest_group(self):
+        """Create the consumer group for the ingest stream (if needed)"""
+        try:
+            rh.REDIS.xgroup_create(self._ingest_stream_key, INGEST_GROUP, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def index_ingested(self, consumer='', count=1000, block_ms=5000,
+                       claim_idle_ms=60000, max_deliveries=5):
+        """Read a batch from the ingest stream (as part of a consumer group) and add it
+
+        - consumer: name of this consumer (default is hostname-pid)
+        - count: max number of entries to read and add in the batch
+        - block_ms: max number of milliseconds to wait for new entries
+        - claim_idle_ms: entries pending for another consumer for at least this
+          many milliseconds are claimed (i.e. the consumer died)
+        - max_deliveries: pending entries that have been delivered this many
+          times are moved to the ingest errors list instead of being retried
+
+        Entries still pending for this consumer name (i.e. it restarted after
+        a crash) are read again before any new entries. Entries are
+        acknowledged (and deleted from the stream) after they are added. Records that fail validation or uniqueness checks are pushed to
+        the ingest errors list. Return the number of entries processed
+        """
+        consumer = consumer or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self._ensure_ingest_group()
+        entries = []
+        dead_ids = []
+        own_pending = False
+        for pending in rh.REDIS.xpending_range(self._ingest_stream_key, INGEST_GROUP, '-', '+', count):
+            own = ih.decode(pending['consumer']) == consumer
+            if not own and pending['time_since_delivered'] < claim_idle_ms:
+                continue
+            if pending['times_delivered'] >= max_deliveries:
+                dead_ids.append(pending['message_id'])
+            elif own:
+                own_pending = True
+            else:
+                entries.extend(rh.REDIS.xclaim(
+                    self._ingest_stream_key, INGEST_GROUP, consumer,
+                    claim_idle_ms, [pending['message_id']]
+                ))
+        if not entries and own_pending:
+            # Entries delivered to this consumer name that were never
+            # acknowledged (i.e. it restarted after a crash); reading from id
+            # '0' redelivers them (and increments their delivery counts)
+            response = rh.REDIS.xreadgroup(
+                INGEST_GROUP, consumer, {self._ingest_stream_key: '0'}, count=count
+            )
+            if response:
+                entries = [
+                    (entry_id, fields) for entry_id, fields in response[0][1]
+                    if entry_id not in dead_ids
+                ]
+        if not entries:
+            response = rh.REDIS.xreadgroup(
+                INGEST_GROUP, consumer, {self._ingest_stream_key: '>'},
+                count=count, block=block_ms
+            )
+            if response:
+                entries = response[0][1]
+
+        start = time()
+        errors = []
+        records = []
+        entry_ids = list(dead_ids)
+        for entry_id, fields in entries:
+            entry_ids.append(entry_id)
+            if not fields:
+                # Pending entry that was already deleted from the stream
+                continue
+            try:
+                records.append(self._decode_ingested(fields))
+            except Exception as e:
+                errors.append((fields, e))
+        num_errors = len(errors)
+        if records:
+            self.add_many(*records, on_error=lambda record, e: errors.append((record, e)))
+        num_indexed = len(records) - (len(errors) - num_errors)
+        if not entry_ids:
+            return 0
+
+        elapsed = time() - start
+        pipe = rh.REDIS.pipeline()
+        if dead_ids:
+            for entry_id, fields in rh.REDIS.xrange(self._ingest_stream_key, dead_ids[0], dead_ids[-1]):
+                if entry_id in dead_ids:
+                    errors.append((fields, 'max_deliveries reached'))
+        for record, e in errors:
+            pipe.lpush(self._ingest_errors_list_key, repr((record, str(e))))
+        pipe.ltrim(self._ingest_errors_list_key, 0, 9999)
+        pipe.xack(self._ingest_stream_key, INGEST_GROUP, *entry_ids)
+        pipe.xdel(self._ingest_stream_key, *entry_ids)
+        pipe.hincrby(self._ingest_stats_hash_key, 'indexed', num_indexed)
+        pipe.hincrby(self._ingest_stats_hash_key, 'errors', len(errors))
+        pipe.hset(self._ingest_stats_hash_key, mapping={
+            'last_batch_size': len(entry_ids),
+            'last_batch_seconds': round(elapsed, 6),
+            'last_batch_ts': self.now_utc_float,
+        })
         pipe.execute()
-        self._unlock()
-        return key
+        return len(entry_ids)
+
+    def run_indexer(self, consumer='', count=1000, block_ms=5000,
+                    claim_idle_ms=60000, max_deliveries=5, show=False):
+        """Call self.index_ingested in a loop until interrupted
+
+        - show: if True, print the number of entries processed per batch
+        """
+        while True:
+            try:
+                num = self.index_ingested(
+                    consumer=consumer,
+                    count=count,
+                    block_ms=block_ms,
+                    claim_idle_ms=claim_idle_ms,
+                    max_deliveries=max_deliveries
+                )
+                if show and num:
+                    print('{}: indexed {} entries'.format(self._base_key, num))
+            except KeyboardInterrupt:
+                break
+            except ConnectionError as e:
+                rh.logger.error('Indexer for {} lost connection: {}'.format(self._base_key, repr(e)))
+                sleep(1)
+
+    def ingest_errors(self, limit=10):
+        """Return list of the limit most recent records that failed to be indexed"""
+        return [
+            ih.decode(error)
+            for error in rh.REDIS.lrange(self._ingest_errors_list_key, 0, limit-1)
+        ]
 
     def get(self, hash_ids, fields='', include_meta=False,
             timestamp_formatter=rh.identity, ts_fmt=None, ts_tz=None,
             admin_fmt=False, item_format='', insert_ts=False,
-            load_ref_data=False, update_get_stats=True):
+            load_ref_data=False, update_get_stats=True, from_primary=False,
+            as_of=None):
         """Wrapper to rh.REDIS.hget/hmget/hgetall
 
         - hash_ids: string of hash_ids to get data for separated by any of , ; |
@@ -333,8 +1811,12 @@ class Collection(object):
         - update_get_stats: if True update access count and last access time
           for each hash_id and update field access counts for each field in
           'fields'
+        - from_primary: if True, read from rh.REDIS and skip the in-process
+          cache (i.e. when the data is about to be modified)
+        - as_of: a utc_float; if specified, return the data as it was at that
+          time (rebuilt from the change history of each hash_id)
         """
-        hash_ids = ih.string_to_list(ih.decode(hash_ids))
+        hash_ids = [ih.decode(hash_id) for hash_id in ih.string_to_list(ih.decode(hash_ids))]
         if admin_fmt or ts_fmt or ts_tz:
             include_meta = True
         if item_format:
@@ -355,23 +1837,45 @@ class Collection(object):
                 )
         if include_meta:
             key = self._ts_zset_key if not insert_ts else self._in_zset_key
+        if from_primary or as_of is not None:
+            reader = rh.REDIS
+            cache = None
+        else:
+            reader = self._reader
+            cache = self._get_cache()
+        expires_before = None
+        if self._expiring and as_of is None:
+            expires_before = self.now_utc_float
 
         # Define the _get_data func based on number of fields requested
-        if num_fields == 1:
+        as_of_scores = {}
+        prefetched_scores = None
+        if as_of is not None:
+            _get_data = partial(self._get_data_as_of, fields, as_of, as_of_scores)
+        elif cache is not None:
+            _get_data = partial(self._get_cached_data, cache, reader, fields, expires_before)
+        elif len(hash_ids) > 1 or expires_before is not None:
+            prefetched, prefetched_scores = self._fetch_many(
+                reader, hash_ids, fields, key if include_meta else None,
+                expires_before
+            )
+            _get_data = lambda hash_id: dict(prefetched[hash_id])
+        elif num_fields == 1:
             field = fields.pop()
-            _get_data = lambda hash_id: {field: rh.REDIS.hget(hash_id, field)}
+            _get_data = lambda hash_id: {field: reader.hget(hash_id, field)}
         elif num_fields > 1:
-            _get_data = lambda hash_id: dict(zip(fields, rh.REDIS.hmget(hash_id, *fields)))
+            _get_data = lambda hash_id: dict(zip(fields, reader.hmget(hash_id, *fields)))
         else:
             _get_data = lambda hash_id: {
                 ih.decode(k): v
-                for k, v in rh.REDIS.hgetall(hash_id).items()
+                for k, v in reader.hgetall(hash_id).items()
             }
 
         results = []
         if update_get_stats:
-            # Start creating the 'pipe' for adding get_*_stats
-            pipe = rh.REDIS.pipeline()
+            # Decide if this call is sampled and start collecting get_*_stats
+            update_get_stats = self._stats_sample_rate >= 1 or random.random() < self._stats_sample_rate
+            field_counts = defaultdict(int)
 
         for hash_id in hash_ids:
             try:
@@ -379,61 +1883,303 @@ class Collection(object):
             except ResponseError:
                 data = {}
 
-            if update_get_stats:
-                pipe.hincrby(self._get_id_stats_hash_key, hash_id + '--count', 1)
-                pipe.hset(self._get_id_stats_hash_key, hash_id + '--last_access', self.now_utc_float)
-
             for field in data.keys():
                 if update_get_stats:
-                    pipe.hincrby(self._get_field_stats_hash_key, field, 1)
-                if field in self._json_fields:
-                    try:
-                        data[field] = loads(data[field])
-                    except TypeError:
-                        try:
-                            data[field] = loads(ih.decode((data[field])))
-                        except TypeError:
-                            data[field] = ih.decode((data[field]))
-                    except ValueError:
-                        data[field] = ih.decode((data[field]))
-                elif field in self._pickle_fields:
-                    data[field] = pickle.loads(data[field])
-                else:
-                    val = ih.decode(data[field])
-                    data[field] = ih.from_string(val) if val is not None else None
+                    field_counts[field] += 1
+                data[field] = self._decode_value(field, data[field])
             if include_meta:
                 data['_id'] = ih.decode(hash_id)
-                data['_ts'] = timestamp_formatter(
-                    rh.REDIS.zscore(key, hash_id)
-                )
+                if as_of is not None:
+                    score = as_of_scores.get(hash_id)
+                elif prefetched_scores is not None:
+                    score = prefetched_scores.get(hash_id)
+                elif cache is not None:
+                    score = self._get_cached_score(cache, reader, key, hash_id)
+                else:
+                    score = reader.zscore(key, hash_id)
+                data['_ts'] = timestamp_formatter(score)
                 if update_get_stats:
                     for field in META_FIELDS:
-                        pipe.hincrby(self._get_field_stats_hash_key, field, 1)
+                        field_counts[field] += 1
 
             if item_format:
                 results.append(item_format.format(**data))
             else:
-                if load_ref_data:
-                    for field, collection in self.field_reference_dict.items():
-                        if field in data:
-                            _ref_field_data = collection[data[field]]
-                            if _ref_field_data:
-                                data[field] = _ref_field_data
                 results.append(data)
 
+        if load_ref_data and not item_format:
+            self._load_ref_data(results)
+
         if update_get_stats:
-            pipe.execute()
+            self._update_get_stats(hash_ids, field_counts)
 
         if len(results) == 1:
             return results[0]
         return results
 
+    def _load_ref_data(self, results):
+        """Replace reference field values in results with the referenced data
+
+        - results: list of dicts returned by self.get
+
+        Values are grouped by referenced collection (even across different
+        reference fields) and each distinct value is fetched once, using one
+        ZMSCORE and one pipeline per referenced collection
+        """
+        by_collection = OrderedDict()
+        for field, collection in self.field_reference_dict.items():
+            _, fields, vals = by_collection.setdefault(
+                collection._base_key, (collection, [], OrderedDict())
+            )
+            fields.append(field)
+            for data in results:
+                val = data.get(field)
+                if val is not None:
+                    vals[val] = None
+        for collection, fields, vals in by_collection.values():
+            if not vals:
+                continue
+            ref_data = collection.get_many_by_unique_values(vals.keys(), include_meta=True)
+            for data in results:
+                for field in fields:
+                    _ref_field_data = ref_data.get(data.get(field))
+                    if _ref_field_data:
+                        data[field] = dict(_ref_field_data)
+
+    def _fetch_many(self, reader, hash_ids, fields, score_key=None,
+                    expires_before=None):
+        """Return dicts of raw field values and scores for hash_ids (one round trip)
+
+        - reader: redis client to read from
+        - fields: set of field names to return (all fields if empty)
+        - score_key: name of the sorted set to get scores from (if None, the
+          returned scores dict is empty)
+        - expires_before: utc_float; if specified, the expire time of each
+          hash_id is fetched in the same pipeline and an empty dict is
+          returned for any hash_id that expires before then
+        """
+        fields = list(fields)
+        pipe = reader.pipeline(transaction=False)
+        for hash_id in hash_ids:
+            if fields:
+                pipe.hmget(hash_id, *fields)
+            else:
+                pipe.hgetall(hash_id)
+            if score_key:
+                pipe.zscore(score_key, hash_id)
+            if expires_before is not None:
+                pipe.zscore(self._exp_zset_key, hash_id)
+        values = pipe.execute(raise_on_error=False)
+        step = 1 + bool(score_key) + (expires_before is not None)
+        data = {}
+        scores = {}
+        for i, hash_id in enumerate(hash_ids):
+            value = values[i * step]
+            expires = values[i * step + step - 1] if expires_before is not None else None
+            if isinstance(value, Exception) or (expires is not None and expires <= expires_before):
+                data[hash_id] = {}
+            elif fields:
+                data[hash_id] = dict(zip(fields, value))
+            else:
+                data[hash_id] = {ih.decode(k): v for k, v in value.items()}
+            if score_key:
+                scores[hash_id] = values[i * step + 1]
+        return data, scores
+
+    def _zmscore(self, reader, key, members):
+        """Return list of scores for members of key (with ZMSCORE if available)"""
+        if not members:
+            return []
+        try:
+            scores = reader.execute_command('ZMSCORE', key, *members)
+        except ResponseError:
+            # Redis < 6.2
+            pipe = reader.pipeline(transaction=False)
+            for member in members:
+                pipe.zscore(key, member)
+            return pipe.execute()
+        return [None if score is None else float(score) for score in scores]
+
+    def _get_data_as_of(self, fields, as_of, scores, hash_id):
+        """Return dict of raw field values for hash_id as they were at as_of
+
+        - fields: set of field names to return (all fields if empty)
+        - as_of: utc_float
+        - scores: dict that the modify time of hash_id (as of as_of) is set in
+
+        The current data is rewound using the newest entries of the change
+        history stream (only the entries newer than as_of are read)
+        """
+        pipe = rh.REDIS.pipeline(transaction=False)
+        pipe.hgetall(hash_id)
+        pipe.zscore(self._ts_zset_key, hash_id)
+        pipe.zscore(self._in_zset_key, hash_id)
+        raw, score, insert_score = pipe.execute()
+        if not raw or (insert_score is not None and insert_score > as_of):
+            return {}
+        data = {ih.decode(k): v for k, v in raw.items()}
+        history_stream_key = self._make_key(hash_id, '_history')
+        max_id = '+'
+        done = score is None or score <= as_of
+        while not done:
+            entries = rh.REDIS.xrevrange(history_stream_key, max=max_id, min='-', count=100)
+            for entry_id, entry in entries:
+                entry = {ih.decode(k): v for k, v in entry.items()}
+                if float(entry.pop('_new_ts')) <= as_of:
+                    done = True
+                    break
+                score = float(entry.pop('_ts'))
+                added = ih.string_to_set(ih.decode(entry.pop('_added', b'')))
+                for field, value in entry.items():
+                    if field in added:
+                        data.pop(field, None)
+                    else:
+                        data[field] = value
+            if len(entries) < 100:
+                done = True
+            elif not done:
+                max_id = _previous_stream_id(entries[-1][0])
+        if score is not None and score > as_of:
+            # Not in the history, so it was added after as_of
+            return {}
+        scores[hash_id] = score
+        if fields:
+            return {field: data.get(field) for field in fields}
+        return data
+
+    def _get_cached_data(self, cache, reader, fields, expires_before, hash_id):
+        """Return dict of raw field values for hash_id, using/filling the cache
+
+        - fields: set of field names to return (all fields if empty)
+        - expires_before: utc_float; if specified, the expire time of hash_id
+          is cached with its data and an empty dict is returned if it expires
+          before then
+        """
+        entry = cache.get(hash_id)
+        if entry is None:
+            generation = cache.generation
+            expires = None
+            if expires_before is not None:
+                pipe = reader.pipeline(transaction=False)
+                pipe.hgetall(hash_id)
+                pipe.zscore(self._exp_zset_key, hash_id)
+                raw, expires = pipe.execute()
+            else:
+                raw = reader.hgetall(hash_id)
+            raw = {ih.decode(k): v for k, v in raw.items()}
+            if not raw:
+                return {}
+            entry = {'data': raw, 'scores': {}, 'expires': expires}
+            nbytes = sum(len(k) + len(v) for k, v in raw.items())
+            cache.set(hash_id, entry, nbytes=nbytes, generation=generation)
+        if expires_before is not None and entry.get('expires') is not None:
+            if entry['expires'] <= expires_before:
+                return {}
+        if fields:
+            return {field: entry['data'].get(field) for field in fields}
+        return dict(entry['data'])
+
+    def _get_cached_score(self, cache, reader, key, hash_id):
+        """Return the score of hash_id in the key zset, using cached entry if possible"""
+        entry = cache.peek(hash_id)
+        if entry is None:
+            return reader.zscore(key, hash_id)
+        if key not in entry['scores']:
+            entry['scores'][key] = reader.zscore(key, hash_id)
+        return entry['scores'][key]
+
+    def _update_get_stats(self, hash_ids, field_counts):
+        """Record access counts for hash_ids and fields fetched by self.get
+
+        If buffered_stats is True, add to the in-process StatsBuffer (flushed
+        later by self.flush_get_stats); otherwise write to redis now. Counts
+        are weighted by 1/stats_sample_rate
+        """
+        weight = 1
+        if self._stats_sample_rate < 1:
+            weight = int(round(1 / self._stats_sample_rate))
+        now = self.now_utc_float
+        if self._buffered_stats:
+            if self._stats_buffer is None:
+                self._stats_buffer = StatsBuffer(
+                    self._write_get_stats,
+                    flush_interval=self._stats_flush_interval,
+                    flush_size=self._stats_flush_size
+                )
+            self._stats_buffer.record(hash_ids, field_counts, now, weight=weight)
+            return
+
+        id_counts = defaultdict(int)
+        for hash_id in hash_ids:
+            id_counts[hash_id] += weight
+        self._write_get_stats(
+            id_counts,
+            {hash_id: now for hash_id in id_counts},
+            {field: count * weight for field, count in field_counts.items()}
+        )
+
+    def _write_get_stats(self, id_counts, last_access, field_counts):
+        """Write get stats counters in a single pipeline
+
+        - id_counts: dict of hash_ids and number of times they were fetched
+        - last_access: dict of hash_ids and utc_float of their last access
+        - field_counts: dict of fields and number of times they were fetched
+
+        If sketch_stats is True, id counts go to a count-min sketch and the
+        estimated counts of the stats_top_k most fetched ids are kept in a
+        zset; distinct ids are counted in hourly HyperLogLogs. If only
+        buffered_stats is True, id counts are incremented in the top-k zset.
+        Either way, last access times are kept for the stats_top_k most
+        recently fetched ids. Otherwise, every id has an entry in the
+        _get_id_stats hash
+        """
+        k = self._stats_top_k
+        pipe = rh.REDIS.pipeline(transaction=False)
+        if self._sketch_stats:
+            queue_cms_topk(pipe, self._get_id_cms_key, self._get_id_top_zset_key, id_counts, k)
+            buckets = defaultdict(list)
+            for hash_id, utc_float in last_access.items():
+                buckets[hll_bucket_key(self._get_id_hll_base_key, utc_float)].append(hash_id)
+            for bucket_key, bucket_ids in buckets.items():
+                pipe.pfadd(bucket_key, *bucket_ids)
+                pipe.expire(bucket_key, HLL_BUCKET_TTL)
+        elif self._buffered_stats:
+            for hash_id, count in id_counts.items():
+                pipe.zincrby(self._get_id_top_zset_key, count, hash_id)
+            pipe.zremrangebyrank(self._get_id_top_zset_key, 0, -(k + 1))
+        else:
+            for hash_id, count in id_counts.items():
+                pipe.hincrby(self._get_id_stats_hash_key, hash_id + '--count', count)
+                pipe.hset(self._get_id_stats_hash_key, hash_id + '--last_access', last_access[hash_id])
+
+        if (self._sketch_stats or self._buffered_stats) and last_access:
+            pipe.zadd(self._get_id_last_zset_key, last_access)
+            pipe.zremrangebyrank(self._get_id_last_zset_key, 0, -(k + 1))
+        for field, count in field_counts.items():
+            pipe.hincrby(self._get_field_stats_hash_key, field, count)
+        pipe.execute()
+
+    def flush_get_stats(self):
+        """Write any get stats buffered in memory (if buffered_stats is True)"""
+        if self._stats_buffer is not None:
+            self._stats_buffer.flush()
+
     def get_hash_id_for_unique_value(self, unique_val):
         """Return the hash_id of the object that has unique_val in _unique_field"""
         if self._unique_field:
-            score = rh.REDIS.zscore(self._id_zset_key, unique_val)
+            cache = self._get_cache()
+            if cache is not None:
+                cache_key = ('_unique', str(ih.decode(unique_val)))
+                hash_id = cache.get(cache_key)
+                if hash_id is not None:
+                    return hash_id
+                generation = cache.generation
+            score = self._reader.zscore(self._id_zset_key, unique_val)
             if score:
-                return self._make_key(self._base_key, int(score))
+                hash_id = self._make_key(self._base_key, int(score))
+                if cache is not None:
+                    cache.set(cache_key, hash_id, generation=generation)
+                return hash_id
 
     def get_by_unique_value(self, unique_val, fields='', include_meta=False,
                             timestamp_formatter=rh.identity, ts_fmt=None,
@@ -468,6 +2214,37 @@ class Collection(object):
             )
         return data
 
+    def get_many_by_unique_values(self, unique_vals, fields='', **get_kwargs):
+        """Return an OrderedDict of unique values and their data (None if missing)
+
+        - unique_vals: list of unique values (input order is preserved)
+        - fields: string of field names to get separated by any of , ; |
+        - get_kwargs: dict of keyword arguments to pass to self.get
+
+        All hash_ids are resolved with one ZMSCORE and all data is fetched in
+        one pipeline
+        """
+        assert self._unique_field, 'Collection does not have a unique_field'
+        unique_vals = list(unique_vals)
+        members = [str(ih.decode(val)) for val in unique_vals]
+        scores = self._zmscore(self._reader, self._id_zset_key, list(OrderedDict.fromkeys(members)))
+        hash_id_for_member = {
+            member: self._make_key(self._base_key, int(score))
+            for member, score in zip(OrderedDict.fromkeys(members), scores)
+            if score is not None
+        }
+        hash_ids = list(hash_id_for_member.values())
+        data_for_hash_id = {}
+        if hash_ids:
+            found = self.get(hash_ids, fields, **get_kwargs)
+            if len(hash_ids) == 1:
+                found = [found]
+            data_for_hash_id = dict(zip(hash_ids, found))
+        return OrderedDict([
+            (val, data_for_hash_id.get(hash_id_for_member.get(member)))
+            for val, member in zip(unique_vals, members)
+        ])
+
     def get_by_position(self, pos, **kwargs):
         """Wrapper to self.get
 
@@ -478,7 +2255,7 @@ class Collection(object):
             kwargs['update_get_stats'] = False
         insert_ts = kwargs.get('insert_ts', False)
         key = self._ts_zset_key if not insert_ts else self._in_zset_key
-        x = rh.REDIS.zrange(key, pos, pos, withscores=True)
+        x = self._reader.zrange(key, pos, pos, withscores=True)
         if x:
             hash_id, ts = x[0]
             data = self.get(hash_id, **kwargs)
@@ -501,7 +2278,7 @@ class Collection(object):
         key = self._ts_zset_key if not insert_ts else self._in_zset_key
         return [
             self.get(hash_id, **kwargs)
-            for hash_id, ts in rh.REDIS.zrange(key, _start, _stop, withscores=True)
+            for hash_id, ts in self._reader.zrange(key, _start, _stop, withscores=True)
         ]
 
     def random(self, terms='', start=None, end=None, ts_fmt=None, ts_tz=None,
@@ -554,17 +2331,28 @@ class Collection(object):
             # is the "most specific" (even thought that isn't always true)
             time_range_key = sorted(time_ranges.keys(), key=lambda x: len(x))[-1]
             _start, _end = time_ranges[time_range_key]
-            result_count = rh.REDIS.zcount(result_key, _start, _end)
+            # Temporary result sets are only on rh.REDIS (replicas are read-only)
+            reader = rh.REDIS if result_key_is_tmp else self._reader
+            result_count = reader.zcount(result_key, _start, _end)
             if result_count > 0:
-                ten_hash_ids = rh.REDIS.zrangebyscore(result_key, _start, _end, start=0, num=10)
+                ten_hash_ids = reader.zrangebyscore(result_key, _start, _end, start=0, num=10)
                 hash_id = random.choice(ten_hash_ids)
                 item = self.get(hash_id, **get_kwargs)
 
             if result_key_is_tmp:
                 rh.REDIS.delete(result_key)
         elif self.size > 0:
-            while item == {}:
+            # Expired items (not trimmed yet) come back as {}, so only try a
+            # few positions before picking from the newest live items
+            for _ in range(10):
                 item = self.get_by_position(random.randint(0, self.size - 1), **get_kwargs)
+                if item != {}:
+                    break
+            if item == {} and self._expiring:
+                key = self._in_zset_key if get_kwargs.get('insert_ts') else self._ts_zset_key
+                live = self._live_range(self._reader, key, '-inf', '+inf', desc=True, limit=10)
+                if live:
+                    item = self.get(random.choice(live)[0], **get_kwargs)
         return item
 
     @classmethod
@@ -633,15 +2421,24 @@ class Collection(object):
     @classmethod
     def report_all(cls):
         """A class method to show some info about the Collections"""
-        pprint(rh.REDIS.hgetall('_REDIS_HELPER_COLLECTION'))
+        s = cls.init_stats(limit=None)
+        report = {}
+        for base_key, init_args in s['init_args'].items():
+            report[base_key + '--last_args'] = init_args
+        for base_key, size in s['sizes'].items():
+            report[base_key + '--last_size'] = size
+        for base_key, (last_update, _) in s['timestamps'].items():
+            report[base_key + '--last_update'] = last_update
+        pprint(report)
 
     @property
     def last_update(self):
         """Return the last time the collection was updated"""
-        return ih.decode(rh.REDIS.hget(
-            '_REDIS_HELPER_COLLECTION',
-            self._base_key + '--last_update'
-        ))
+        pipe = rh.REDIS.pipeline(transaction=False)
+        pipe.get(self._last_update_string_key)
+        pipe.hget('_REDIS_HELPER_COLLECTION', self._base_key + '--last_update')
+        last_update, old_last_update = pipe.execute()
+        return ih.decode(last_update or old_last_update)
 
     @property
     def last_update_admin(self):
@@ -732,6 +2529,7 @@ class Collection(object):
         keys_generator = chain(
             rh.REDIS.scan_iter('{}:[^0-9]*'.format(self._base_key)),
             rh.REDIS.scan_iter('{}:[0-9]*_changes'.format(self._base_key)),
+            rh.REDIS.scan_iter('{}:[0-9]*_history'.format(self._base_key)),
         )
 
         return sorted([
@@ -743,6 +2541,8 @@ class Collection(object):
         """Delete all Redis keys under self._base_key"""
         for key in rh.REDIS.scan_iter('{}*'.format(self._base_key)):
             rh.REDIS.delete(key)
+        if self._cache is not None:
+            self._cache.clear()
 
     @classmethod
     def clear_all_collection_locks(cls):
@@ -796,47 +2596,352 @@ class Collection(object):
 
         pipe.delete(hash_id)
         pipe.delete(self._make_key(hash_id, '_changes'))
+        pipe.delete(self._make_key(hash_id, '_history'))
+        self._invalidate_cached(pipe, hash_id, unique_val)
         pipe.hdel(
             self._get_id_stats_hash_key,
             hash_id + '--count',
             hash_id + '--last_access',
         )
+        if self._buffered_stats or self._sketch_stats:
+            pipe.zrem(self._get_id_top_zset_key, hash_id)
+            pipe.zrem(self._get_id_last_zset_key, hash_id)
+            if self._stats_buffer is not None:
+                self._stats_buffer.discard(hash_id)
         if score:
             pipe.zrem(key, hash_id)
         if score2:
             pipe.zrem(other_key, hash_id)
         if unique_val:
             pipe.zrem(self._id_zset_key, unique_val)
-
-        index_fields = ','.join(self._index_base_keys.keys())
+        if self._expiring:
+            pipe.zrem(self._exp_zset_key, hash_id)
+
+        index = {}
+        strings = {}
+        index_fields = set(self._index_base_keys).union(self._shadow_fields)
+        for text_field in self._text_fields:
+            raw_text = rh.REDIS.hget(hash_id, text_field)
+            self._queue_text_diff(pipe, hash_id, text_field, self._tokens(raw_text), [])
         if index_fields:
-            for k, v in self.get(hash_id, index_fields).items():
-                old_index_key = self._make_key(self._base_key, k, v)
-                pipe.srem(old_index_key, hash_id)
-                pipe.zincrby(self._index_base_keys[k], -1, str(v))
+            # Read the raw values (get() would skip an expired item that
+            # hasn't been trimmed yet)
+            read_fields = self._index_source_fields(index_fields)
+            raw = dict(zip(read_fields, rh.REDIS.hmget(hash_id, *read_fields)))
+            for k, v in self._decoded_index_values(raw, sorted(index_fields)):
+                if k in self._shadow_fields:
+                    for index_string in self._index_strings(k, v):
+                        pipe.srem(self._make_key(self._shadow_base_key(k), index_string), hash_id)
+                if k not in self._index_base_keys:
+                    continue
+                for index_string in self._index_strings(k, v):
+                    old_index_key = self._make_key(self._base_key, k, index_string)
+                    pipe.srem(old_index_key, hash_id)
+                    pipe.zincrby(self._index_base_keys[k], -1, index_string)
+                if k not in self._multi_index_fields:
+                    strings[k] = str(v)
+                index[k] = self._event_index_value(k, v)
+        for base_key, value in self._composite_values(strings):
+            pipe.srem(self._make_key(base_key, value), hash_id)
+            pipe.zincrby(base_key, -1, value)
 
-        pipe.hset('_REDIS_HELPER_COLLECTION', self._base_key + '--last_update', self.now_utc_float)
+        now = self.now_utc_float
+        pipe.set(self._last_update_string_key, now)
+        self._queue_change(pipe, 'delete', hash_id, [], now, index=index)
 
         if execute:
             val = pipe.execute()
-            rh.REDIS.hset('_REDIS_HELPER_COLLECTION', self._base_key + '--last_size', self.size)
             self._unlock()
             return val
 
-    def delete_many(self, *hash_ids):
-        """Wrapper to self.delete"""
+    def delete_many(self, *hash_ids, chunk_size=1000, progress=None, workers=0):
+        """Delete many hash_ids (and remove them from indexes) in chunks
+
+        - chunk_size: number of hash_ids to delete per pair of round trips
+        - progress: callable accepting a dict of 'deleted', 'total', 'seconds',
+          and 'per_second' (called after each chunk)
+        - workers: if greater than 0, delete the chunks in this many worker
+          processes (the report also gets a 'workers' dict, see
+          self._run_parallel)
+
+        For each chunk, index values are read with one pipeline, then hashes
+        are removed with UNLINK and sorted sets, index sets, and index counts
+        are updated with multi-member commands in one transaction. Unique
+        values are read from the _id zset (by id number), so an _id entry
+        whose hash is already gone is removed too
+
+        Return a dict of 'deleted', 'total', 'seconds', and 'per_second'
+        (this used to return the result of the last command in the delete
+        pipeline)
+        """
+        hash_ids = [ih.decode(hash_id) for hash_id in hash_ids]
+        for hash_id in hash_ids:
+            assert hash_id.startswith(self._base_key), (
+                '{} does not start with {}'.format(repr(hash_id), repr(self._base_key))
+            )
+        start = time()
+        report = {'deleted': 0, 'total': len(hash_ids), 'seconds': 0, 'per_second': 0}
         self.wait_for_unlock()
         self._lock()
-        pipe = rh.REDIS.pipeline()
+        try:
+            if workers:
+                def _progress(parallel_report):
+                    report['deleted'] = parallel_report['items']
+                    report['seconds'] = parallel_report['seconds']
+                    report['per_second'] = parallel_report['per_second']
+                    if progress is not None:
+                        progress(dict(report))
+
+                _, parallel_report = self._run_parallel(
+                    '_delete_id_list',
+                    [hash_ids[i:i + chunk_size] for i in range(0, len(hash_ids), chunk_size)],
+                    workers=workers,
+                    progress=_progress
+                )
+                report['workers'] = parallel_report['workers']
+            else:
+                for i in range(0, len(hash_ids), chunk_size):
+                    report['deleted'] += self._delete_chunk(hash_ids[i:i + chunk_size])
+                    report['seconds'] = round(time() - start, 6)
+                    if report['seconds']:
+                        report['per_second'] = round(report['deleted'] / report['seconds'], 2)
+                    if progress is not None:
+                        progress(dict(report))
+        finally:
+            self._unlock()
+        return report
+
+    def _delete_chunk(self, hash_ids):
+        """Delete hash_ids with one read pipeline and one write transaction
+
+        Return the number of hash_ids that existed
+        """
+        read_fields = self._index_source_fields(set(self._index_base_keys).union(self._shadow_fields))
+        read_fields.extend(sorted(self._text_fields))
+        pipe = rh.REDIS.pipeline(transaction=False)
         for hash_id in hash_ids:
-            self.delete(hash_id, pipe)
-        val = pipe.execute()
-        rh.REDIS.hset('_REDIS_HELPER_COLLECTION', self._base_key + '--last_size', self.size)
-        self._unlock()
-        if val:
-            return val[-1]
+            pipe.zscore(self._ts_zset_key, hash_id)
+            pipe.zscore(self._in_zset_key, hash_id)
+            if self._unique_field:
+                # Read the unique value from the _id zset, so an entry whose
+                # hash is already gone is still removed
+                number = int(hash_id.split(':')[-1])
+                pipe.zrangebyscore(self._id_zset_key, number, number)
+            if read_fields:
+                pipe.hmget(hash_id, *read_fields)
+        values = iter(pipe.execute())
+
+        existing = []
+        unique_vals = []
+        index_members = defaultdict(list)
+        index_counts = defaultdict(int)
+        shadow_members = defaultdict(list)
+        text_members = defaultdict(list)
+        for hash_id in hash_ids:
+            score, score2 = next(values), next(values)
+            unique_val = None
+            if self._unique_field:
+                unique_val = next(iter(next(values)), None)
+            raw = self._with_path_values(zip(read_fields, next(values))) if read_fields else {}
+            if score is None and score2 is None and unique_val is None:
+                continue
+            existing.append((hash_id, unique_val, raw))
+            if unique_val is not None:
+                unique_vals.append(unique_val)
+            strings = {}
+            for index_field, base_key in self._index_base_keys.items():
+                for value in self._raw_index_strings(index_field, raw.get(index_field)):
+                    index_members[(base_key, value)].append(hash_id)
+                    index_counts[(base_key, value)] += 1
+                    strings[index_field] = value
+            for base_key, value in self._composite_values(strings):
+                index_members[(base_key, value)].append(hash_id)
+                index_counts[(base_key, value)] += 1
+            for shadow_field in self._shadow_fields:
+                for index_string in self._raw_index_strings(shadow_field, raw.get(shadow_field)):
+                    shadow_members[(shadow_field, index_string)].append(hash_id)
+            for text_field in self._text_fields:
+                for token in self._tokens(raw.get(text_field)):
+                    text_members[(text_field, token)].append(hash_id)
+        if not existing:
+            return 0
+
+        now = self.now_utc_float
+        ids = [hash_id for hash_id, _, _ in existing]
+        pipe = rh.REDIS.pipeline()
+        pipe.unlink(*chain.from_iterable(
+            (hash_id, self._make_key(hash_id, '_changes'), self._make_key(hash_id, '_history'))
+            for hash_id in ids
+        ))
+        pipe.zrem(self._ts_zset_key, *ids)
+        pipe.zrem(self._in_zset_key, *ids)
+        if self._expiring:
+            pipe.zrem(self._exp_zset_key, *ids)
+        if unique_vals:
+            pipe.zrem(self._id_zset_key, *unique_vals)
+        for (base_key, value), members in index_members.items():
+            pipe.srem(self._make_key(base_key, value), *members)
+            pipe.zincrby(base_key, -index_counts[(base_key, value)], value)
+        for (shadow_field, value), members in shadow_members.items():
+            pipe.srem(self._make_key(self._shadow_base_key(shadow_field), value), *members)
+        for (text_field, token), members in text_members.items():
+            pipe.srem(self._make_key(self._text_base_keys[text_field], token), *members)
+        pipe.hdel(self._get_id_stats_hash_key, *chain.from_iterable(
+            (hash_id + '--count', hash_id + '--last_access') for hash_id in ids
+        ))
+        if self._buffered_stats or self._sketch_stats:
+            pipe.zrem(self._get_id_top_zset_key, *ids)
+            pipe.zrem(self._get_id_last_zset_key, *ids)
+        for hash_id, unique_val, raw in existing:
+            if self._stats_buffer is not None:
+                self._stats_buffer.discard(hash_id)
+            self._invalidate_cached(pipe, hash_id, unique_val)
+            self._queue_change(pipe, 'delete', hash_id, [], now, index={
+                index_field: self._raw_event_index_value(index_field, raw.get(index_field))
+                for index_field in self._index_base_keys
+            })
+        pipe.set(self._last_update_string_key, now)
+        pipe.execute()
+        return len(existing)
 
-    def delete_where(self, terms='', limit=None, desc=False, insert_ts=False):
+    @property
+    def has_retention(self):
+        """Return True if max_items, max_age, or expiring was set on the collection"""
+        return bool(self._max_items or self._max_age or self._expiring)
+
+    def _expires_at(self, seconds, now=None):
+        """Return the utc_float that is seconds after now"""
+        now = now or self.now_utc_float
+        return float(dh.utc_ago_float_string('{}:seconds'.format(-seconds), now=str(now)))
+
+    def expire(self, hash_id, seconds):
+        """Set hash_id to expire in seconds (if None, hash_id will not expire)
+
+        The collection must be created with expiring=True (or default_ttl).
+        Expired items are skipped by get/find until self.trim deletes them
+
+        Return True if hash_id exists
+        """
+        assert self._expiring, 'Collection must be created with expiring=True to use expire'
+        if rh.REDIS.zscore(self._ts_zset_key, hash_id) is None:
+            return False
+        pipe = rh.REDIS.pipeline()
+        if seconds is None:
+            pipe.zrem(self._exp_zset_key, hash_id)
+        else:
+            pipe.zadd(self._exp_zset_key, {hash_id: self._expires_at(seconds)})
+        self._invalidate_cached(pipe, hash_id)
+        pipe.execute()
+        return True
+
+    def ttl(self, hash_id):
+        """Return number of seconds until hash_id expires (None if it won't expire)"""
+        expires = self._reader.zscore(self._exp_zset_key, hash_id)
+        if expires is None:
+            return None
+        delta = dh.float_string_to_dt(str(expires)) - dh.float_string_to_dt(self.now_utc_float_string)
+        return max(delta.total_seconds(), 0)
+
+    def trim(self, chunk_size=500, max_busy_ratio=0.5, max_seconds=None,
+             progress=None):
+        """Delete expired items and the oldest items beyond max_items or older than max_age
+
+        - chunk_size: number of items to delete per chunk (the collection is
+          only locked while a chunk is deleted)
+        - max_busy_ratio: fraction of time spent deleting; after each chunk
+          sleep long enough to keep (deleting time / total time) at or below
+          this (1 for no sleeping)
+        - max_seconds: stop after this many seconds (None to finish)
+        - progress: callable accepting a dict of 'deleted', 'chunks',
+          'seconds', and 'per_second' (called after each chunk)
+
+        Return a dict of 'deleted', 'chunks', 'seconds', and 'per_second'
+        """
+        assert 0 < max_busy_ratio <= 1, 'max_busy_ratio must be greater than 0 and at most 1'
+        key = self._in_zset_key if self._insert_ts else self._ts_zset_key
+        start = time()
+        report = {'deleted': 0, 'chunks': 0, 'seconds': 0, 'per_second': 0}
+        cutoff = None
+        if self._max_age:
+            cutoff = float(dh.utc_ago_float_string(self._max_age, now=self.now_utc_float_string))
+        while max_seconds is None or time() - start < max_seconds:
+            hash_ids = []
+            source_key = key
+            if self._expiring:
+                source_key = self._exp_zset_key
+                hash_ids = rh.REDIS.zrangebyscore(
+                    source_key, 0, self.now_utc_float, start=0, num=chunk_size
+                )
+            if not hash_ids and cutoff is not None:
+                source_key = key
+                hash_ids = rh.REDIS.zrangebyscore(key, 0, cutoff, start=0, num=chunk_size)
+            if not hash_ids and self._max_items:
+                source_key = key
+                excess = rh.REDIS.zcard(key) - self._max_items
+                if excess > 0:
+                    hash_ids = rh.REDIS.zrange(key, 0, min(excess, chunk_size) - 1)
+            if not hash_ids:
+                break
+            chunk_start = time()
+            self.wait_for_unlock()
+            self._lock()
+            try:
+                deleted = self._delete_chunk([ih.decode(hash_id) for hash_id in hash_ids])
+            finally:
+                self._unlock()
+            busy = time() - chunk_start
+            report['deleted'] += deleted
+            report['chunks'] += 1
+            report['seconds'] = round(time() - start, 6)
+            if report['seconds']:
+                report['per_second'] = round(report['deleted'] / report['seconds'], 2)
+            if progress is not None:
+                progress(dict(report))
+            if not deleted:
+                # Only stale sorted set members left (remove them directly)
+                rh.REDIS.zrem(source_key, *hash_ids)
+            if max_busy_ratio < 1:
+                sleep(busy * (1 - max_busy_ratio) / max_busy_ratio)
+        report['seconds'] = round(time() - start, 6)
+        return report
+
+    def start_trimmer(self, interval=60, **trim_kwargs):
+        """Call self.trim every interval seconds from a background thread
+
+        - trim_kwargs: keyword arguments passed to self.trim
+
+        Return the thread (call self.stop_trimmer to stop it)
+        """
+        assert self.has_retention, 'Collection must be created with max_items, max_age, or expiring'
+        max_busy_ratio = trim_kwargs.get('max_busy_ratio', 0.5)
+        assert 0 < max_busy_ratio <= 1, 'max_busy_ratio must be greater than 0 and at most 1'
+        if self._trimmer is not None and self._trimmer[0].is_alive():
+            return self._trimmer[0]
+        stop = threading.Event()
+
+        def _run():
+            while not stop.is_set():
+                try:
+                    self.trim(**trim_kwargs)
+                except Exception as e:
+                    rh.logger.error('Unable to trim {}: {}'.format(self._base_key, repr(e)))
+                stop.wait(interval)
+
+        thread = threading.Thread(target=_run, daemon=True)
+        self._trimmer = (thread, stop)
+        thread.start()
+        return thread
+
+    def stop_trimmer(self):
+        """Stop the background thread started by self.start_trimmer"""
+        if self._trimmer is not None:
+            thread, stop = self._trimmer
+            stop.set()
+            thread.join()
+            self._trimmer = None
+
+    def delete_where(self, terms='', limit=None, desc=False, insert_ts=False,
+                     chunk_size=1000, progress=None, workers=0):
         """Wrapper to self.delete_many
 
         - terms: string of 'index_field:value' pairs
@@ -844,6 +2949,9 @@ class Collection(object):
         - desc: if False and limit is not None, delete the oldest limit matches,
           if True and limit is not None, delete the newest limit matches
         - insert_ts: if True, use score of insert time instead of modify time
+        - chunk_size: passed to self.delete_many
+        - progress: passed to self.delete_many
+        - workers: passed to self.delete_many
         """
         assert terms or limit, 'Must specify terms or a limit'
         ids = self.find(
@@ -854,9 +2962,12 @@ class Collection(object):
             item_format='{_id}'
         )
         if ids:
-            return self.delete_many(*ids)
+            return self.delete_many(
+                *ids, chunk_size=chunk_size, progress=progress, workers=workers
+            )
 
-    def delete_to(self, score=None, ts='', tz=None, insert_ts=False):
+    def delete_to(self, score=None, ts='', tz=None, insert_ts=False,
+                  chunk_size=1000, progress=None, workers=0):
         """Delete all items with a score (timestamp) between 0 and score
 
         - score: a utc_float
@@ -864,6 +2975,9 @@ class Collection(object):
           (in the timezone specified in tz or dh.ADMIN_TIMEZONE)
         - tz: a timezone
         - insert_ts: if True, use score of insert time instead of modify time
+        - chunk_size: passed to self.delete_many
+        - progress: passed to self.delete_many
+        - workers: passed to self.delete_many
         """
         if ts:
             tz = tz or dh.ADMIN_TIMEZONE
@@ -876,16 +2990,103 @@ class Collection(object):
             for hash_id in rh.REDIS.zrangebyscore(key, 0, score)
         ]
         if ids:
-            return self.delete_many(*ids)
+            return self.delete_many(
+                *ids, chunk_size=chunk_size, progress=progress, workers=workers
+            )
 
     def update(self, hash_id, change_history=True, **data):
         """Update data at a particular hash_id
 
-        - change_history: if True, save changes to the _changes hash key for
+        - change_history: if True, save changes to the _history stream key for
           hash_id
 
         If a unique_field is being used, it cannot be updated
         """
+        return self.update_many({hash_id: data}, change_history=change_history)[hash_id]
+
+    def update_many(self, updates, change_history=True, on_error=None):
+        """Update data at many hash_ids using pipelined round trips
+
+        - updates: dict of hash_ids and dicts of fields/values to update
+        - change_history: if True, save changes to the _history stream key for
+          each hash_id
+        - on_error: callable accepting (record, exception) for any update that
+          fails validation (record is the update data with an '_id' field); if
+          None, the first exception is raised before anything is updated
+
+        Return a dict of hash_ids and lists of changes (None for any hash_id
+        that doesn't exist or wasn't updated)
+        """
+        results = {}
+        checked = {}
+        for hash_id, data in updates.items():
+            hash_id = ih.decode(hash_id)
+            results[hash_id] = None
+            try:
+                self._check_update(hash_id, data)
+            except AssertionError as e:
+                if on_error is None:
+                    raise
+                on_error(dict(data, _id=hash_id), e)
+            else:
+                if data:
+                    checked[hash_id] = dict(data)
+        if not checked:
+            return results
+
+        self.wait_for_unlock()
+        self._lock()
+        try:
+            pipe = rh.REDIS.pipeline(transaction=False)
+            for hash_id, data in checked.items():
+                pipe.zscore(self._ts_zset_key, hash_id)
+                pipe.hmget(hash_id, *data.keys(), *self._other_index_fields(data))
+            values = pipe.execute()
+
+            now = self.now_utc_float
+            pipe = rh.REDIS.pipeline()
+            for (hash_id, data), old_timestamp, old_raw in zip(checked.items(), values[::2], values[1::2]):
+                if old_timestamp is None:
+                    continue
+                errors = self.validate(**data)
+                if errors:
+                    e = Exception('Validation errors: ' + repr(errors))
+                    if on_error is None:
+                        raise e
+                    on_error(dict(data, _id=hash_id), e)
+                    continue
+                other_index_fields = self._other_index_fields(data)
+                results[hash_id] = self._queue_update(
+                    pipe, hash_id, data, dict(zip(data.keys(), old_raw[:len(data)])),
+                    old_timestamp, now, change_history,
+                    index_raw=dict(zip(other_index_fields, old_raw[len(data):]))
+                )
+            if pipe.command_stack:
+                pipe.execute()
+        finally:
+            self._unlock()
+        return results
+
+    def _other_index_fields(self, data):
+        """Return list of index fields not in data (that change events and
+        composite indexes of fields in data need)
+
+        The json fields of json path index fields are returned instead
+        """
+        fields = set()
+        if self._changelog_maxlen:
+            fields.update(self._index_base_keys)
+        for composite_fields in self._composite_indexes.values():
+            if not data.keys().isdisjoint(composite_fields):
+                fields.update(composite_fields)
+        return [
+            field
+            for field in self._index_source_fields(f for f in self._index_base_keys if f in fields)
+            if field not in data
+        ]
+
+    def _check_update(self, hash_id, data):
+        """Raise an AssertionError if data can never be used to update hash_id"""
         assert hash_id.startswith(self._base_key), (
             '{} does not start with {}'.format(repr(hash_id), repr(self._base_key))
         )
@@ -893,55 +3094,369 @@ class Collection(object):
             assert mf not in data, (
                 '{} is a meta field that cannot be saved or updated'.format(repr(mf))
             )
+        self._check_path_index_fields(data)
         if self._unique_field:
             assert self._unique_field not in data, (
                 '{} is the unique field and cannot be updated'.format(repr(self._unique_field))
             )
-        score = rh.REDIS.zscore(self._ts_zset_key, hash_id)
-        if score is None or data == {}:
-            return
-        errors = self.validate(**data)
-        if errors:
-            raise Exception('Validation errors: ' + repr(errors))
 
-        self.wait_for_unlock()
-        self._lock()
+    def _queue_index_diff(self, pipe, hash_id, field, removed_strings, added_strings):
+        """Add the commands to move hash_id between index sets of field to pipe
+
+        - removed_strings: index set values hash_id is no longer stored under
+        - added_strings: index set values hash_id is now stored under
+
+        Shadow index sets of field are kept in sync during self.reindex_online
+        """
+        if field in self._shadow_fields:
+            shadow_base_key = self._shadow_base_key(field)
+            for value in removed_strings:
+                pipe.srem(self._make_key(shadow_base_key, value), hash_id)
+            for value in added_strings:
+                pipe.sadd(self._make_key(shadow_base_key, value), hash_id)
+        if field in self._index_base_keys:
+            base_key = self._index_base_keys[field]
+            for value in removed_strings:
+                pipe.srem(self._make_key(base_key, value), hash_id)
+                pipe.zincrby(base_key, -1, value)
+            for value in added_strings:
+                pipe.sadd(self._make_key(base_key, value), hash_id)
+                pipe.zincrby(base_key, 1, value)
+
+    def _queue_update(self, pipe, hash_id, data, old_raw, old_timestamp, now,
+                      change_history=True, index_raw=None):
+        """Add the commands to update hash_id (and its indexes) to pipe
+
+        - data: dict of fields and new values (not yet serialized)
+        - old_raw: dict of fields and their current values returned by redis
+        - old_timestamp: current score of hash_id in self._ts_zset_key
+        - now: utc_float
+        - change_history: if True, save old values to the _history stream key
+        - index_raw: dict of index fields (or json fields of json path index
+          fields) not in data and their current values returned by redis (for
+          the change event and composite indexes)
+
+        Return a list of changes (nothing is added to pipe if nothing changed)
+        """
         changes = []
-        now = self.now_utc_float
-        update_fields = ','.join(data.keys())
-        changes_hash_key = self._make_key(hash_id, '_changes')
-        old_timestamp = rh.REDIS.zscore(self._ts_zset_key, hash_id)
-        pipe = rh.REDIS.pipeline()
-        pipe.hset('_REDIS_HELPER_COLLECTION', self._base_key + '--last_update', self.now_utc_float)
-        for field, old_value in self.get(hash_id, update_fields).items():
-            if ih.from_string(data[field]) != old_value:
+        history = {}
+        added = []
+        index_raw = index_raw or {}
+        index = {
+            field: self._event_index_value(field, self._decode_value(field, raw_value))
+            for field, raw_value in index_raw.items()
+            if field in self._index_base_keys
+        }
+        if self._path_index_fields:
+            index.update({
+                field: self._event_index_value(field, value)
+                for field, value in self._index_field_values(
+                    {
+                        field: self._decode_value(field, raw_value)
+                        for field, raw_value in chain(index_raw.items(), old_raw.items())
+                        if field in self._json_fields
+                    },
+                    list(self._path_index_fields)
+                ).items()
+            })
+        index.update({
+            field: self._event_index_value(field, value)
+            for field, value in self._index_field_values(data).items()
+        })
+        original = data
+        data = dict(data)
+        for field, raw_value in old_raw.items():
+            old_value = self._decode_value(field, raw_value)
+            if field in self._multi_index_fields:
+                new_value = self._multi_list(data[field])
+            else:
+                new_value = ih.from_string(data[field])
+            if new_value != old_value:
                 changes.append('{} {}: {} | {}'.format(hash_id, field, old_value, data[field]))
                 if change_history:
-                    k = '{}--{}'.format(field, old_timestamp)
-                    pipe.hset(changes_hash_key, k, str(old_value))
-                if field in self._index_base_keys:
-                    old_index_key = self._make_key(self._base_key, field, old_value)
-                    index_key = self._make_key(self._base_key, field, data[field])
-                    pipe.srem(old_index_key, hash_id)
-                    pipe.zincrby(self._index_base_keys[field], -1, str(old_value))
-                    pipe.sadd(index_key, hash_id)
-                    pipe.zincrby(self._index_base_keys[field], 1, str(data[field]))
+                    if raw_value is None:
+                        added.append(field)
+                        history[field] = ''
+                    else:
+                        history[field] = raw_value
+                if field in self._index_base_keys or field in self._shadow_fields:
+                    old_strings = self._index_strings(field, old_value)
+                    new_strings = self._index_strings(field, data[field])
+                    self._queue_index_diff(
+                        pipe, hash_id, field,
+                        [v for v in old_strings if v not in new_strings],
+                        [v for v in new_strings if v not in old_strings]
+                    )
+                path_fields = [
+                    path_field
+                    for path_field, (json_field, _) in self._path_index_fields.items()
+                    if json_field == field
+                ]
+                if path_fields:
+                    old_paths = self._index_field_values({field: old_value}, path_fields)
+                    new_paths = self._index_field_values({field: data[field]}, path_fields)
+                    for path_field in path_fields:
+                        old_string = str(old_paths[path_field])
+                        new_string = str(new_paths[path_field])
+                        if old_string != new_string:
+                            self._queue_index_diff(pipe, hash_id, path_field, [old_string], [new_string])
+                if field in self._multi_index_fields:
+                    data[field] = dumps(new_value)
                 elif field in self._json_fields:
                     data[field] = dumps(data[field])
                 elif field in self._pickle_fields:
                     data[field] = pickle.dumps(data[field])
-                else:
+                elif field not in self._index_base_keys:
                     data[field] = str(data[field])
+                if field in self._text_fields:
+                    old_tokens = self._tokens(raw_value)
+                    new_tokens = self._tokens(data[field])
+                    self._queue_text_diff(
+                        pipe, hash_id, field,
+                        [t for t in old_tokens if t not in new_tokens],
+                        [t for t in new_tokens if t not in old_tokens]
+                    )
             else:
                 data.pop(field)
 
+        if data and self._composite_indexes:
+            composite_fields = set(chain.from_iterable(self._composite_indexes.values()))
+            old_strings = {
+                field: str(self._decode_value(field, raw_value))
+                for field, raw_value in chain(old_raw.items(), index_raw.items())
+                if field in composite_fields
+            }
+            new_strings = dict(old_strings)
+            new_strings.update({
+                field: str(original[field])
+                for field in data
+                if field in composite_fields
+            })
+            old_values = dict(self._composite_values(old_strings))
+            for base_key, value in self._composite_values(new_strings):
+                if old_values[base_key] != value:
+                    pipe.srem(self._make_key(base_key, old_values[base_key]), hash_id)
+                    pipe.zincrby(base_key, -1, old_values[base_key])
+                    pipe.sadd(self._make_key(base_key, value), hash_id)
+                    pipe.zincrby(base_key, 1, value)
+
+        if history:
+            history.update({'_ts': old_timestamp, '_new_ts': now})
+            if added:
+                history['_added'] = ','.join(added)
+            pipe.xadd(
+                self._make_key(hash_id, '_history'), history,
+                maxlen=self._history_maxlen or None, approximate=True
+            )
         if data:
             pipe.hset(hash_id, mapping=data)
             pipe.zadd(self._ts_zset_key, {hash_id: now})
-            pipe.execute()
-        self._unlock()
+            pipe.set(self._last_update_string_key, now)
+            self._invalidate_cached(pipe, hash_id)
+            self._queue_change(pipe, 'update', hash_id, data.keys(), now, old_timestamp, index)
         return changes
 
+    def upsert(self, change_history=True, **data):
+        """Add data if its unique value is new, otherwise update the changed fields
+
+        Return a tuple of (hash_id, status) where status is one of 'inserted',
+        'updated', or 'unchanged'. See self.upsert_many
+        """
+        return self.upsert_many(data, change_history=change_history)[0]
+
+    def upsert_many(self, *records, change_history=True, on_error=None):
+        """Insert or update many dicts (by unique value) atomically in one round trip
+
+        - records: dicts of fields and values (each must include the
+          unique_field)
+        - change_history: if True, save old values of updated fields to the
+          _history stream key for each hash_id
+        - on_error: callable accepting (record, exception) for any record that
+          fails validation; if None, the first exception is raised before
+          anything is written
+
+        Unique values are resolved, ids allocated, changed fields written, and
+        index sets/counts adjusted in a single server-side script, so there is
+        no race between checking for and adding a unique value. The script
+        also checks the collection lock (if it was taken after waiting for
+        the unlock, nothing is written and it is run again after the next
+        unlock). Return a list of (hash_id, status) tuples (None for records
+        that failed validation)
+        """
+        global _upsert_script
+        assert self._unique_field, 'Collection does not have a unique_field'
+        results = [None] * len(records)
+        valid = []
+        args = []
+        for i, record in enumerate(records):
+            try:
+                for mf in META_FIELDS:
+                    assert mf not in record, (
+                        '{} is a meta field that cannot be saved or updated'.format(repr(mf))
+                    )
+                self._check_path_index_fields(record)
+                invalid = self._text_fields.intersection(record)
+                assert not invalid, (
+                    'text field(s) {} cannot be upserted (use add/update)'.format(invalid)
+                )
+                assert record.get(self._unique_field) is not None, (
+                    'unique field {} is not in data'.format(repr(self._unique_field))
+                )
+                errors = self.validate(**record)
+                if errors:
+                    raise Exception('Validation errors: ' + repr(errors))
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(record, e)
+                continue
+            valid.append(i)
+            data = self._serialize(record)
+            args.append(len(data))
+            for field, value in data.items():
+                args.extend([field, value])
+        if not valid:
+            return results
+
+        if _upsert_script is None:
+            _upsert_script = rh.REDIS.register_script(_UPSERT_LUA)
+        index_fields = list(self._index_base_keys.keys())
+        multi_index_fields = sorted(self._multi_index_fields)
+        response = None
+        while response is None:
+            # The script also checks the lock (a lock taken after this wait
+            # makes it return None without writing anything)
+            self.wait_for_unlock()
+            now = self.now_utc_float_string
+            response = _upsert_script(
+                keys=[
+                    self._ts_zset_key,
+                    self._id_zset_key,
+                    self._in_zset_key,
+                    self._next_id_string_key,
+                    self._last_update_string_key,
+                    self._changelog_stream_key,
+                    self._reindex_hash_key,
+                    self._exp_zset_key,
+                    self._lock_string_key,
+                ],
+                args=[
+                    now,
+                    self._base_key,
+                    self._unique_field,
+                    1 if self._insert_ts else 0,
+                    self._history_maxlen if change_history else -1,
+                    self._changelog_maxlen,
+                    self._cache_channel if self._cache_size else '',
+                    self._expires_at(self._default_ttl, now) if self._default_ttl else '',
+                    len(index_fields),
+                ] + index_fields + [len(multi_index_fields)] + multi_index_fields + [
+                    len(self._composite_indexes)
+                ] + list(self._composite_indexes) + [
+                    len(self._path_index_fields)
+                ] + list(self._path_index_fields) + args
+            )
+        self._unreplicated_writes = True
+        for i, hash_id, status in zip(valid, response[::2], response[1::2]):
+            hash_id, status = ih.decode(hash_id), ih.decode(status)
+            if status == 'updated' and self._cache is not None:
+                self._cache.pop(hash_id)
+            results[i] = (hash_id, status)
+        return results
+
+    def incr(self, hash_id, field, amount=1, change_history=False, _type='int',
+             unique_val=None):
+        """Atomically increment field at hash_id by amount (with HINCRBY)
+
+        - hash_id: hash_id to increment a field for
+        - field: name of the field (cannot be the unique_field, a json/pickle
+          field, or a meta field)
+        - amount: integer amount to increment by (negative to decrement)
+        - change_history: if True, save the old value to the _history stream
+        - _type: 'int' or 'float'
+        - unique_val: if hash_id is None, the unique value of the item
+
+        The modify time, index (if field is indexed), change stream, and cache
+        invalidation are all updated in the same server-side script (after
+        waiting for the collection to be unlocked, like upsert). The index set
+        value is the new value as stored by redis. Return the new value (None
+        if hash_id doesn't exist)
+        """
+        global _incr_script
+        assert field not in META_FIELDS, (
+            '{} is a meta field that cannot be saved or updated'.format(repr(field))
+        )
+        assert field != self._unique_field, (
+            '{} is the unique field and cannot be updated'.format(repr(self._unique_field))
+        )
+        assert field not in self._json_fields and field not in self._pickle_fields, (
+            '{} is a json/pickle field and cannot be incremented'.format(repr(field))
+        )
+        assert field not in self._text_fields, (
+            '{} is a text field and cannot be incremented'.format(repr(field))
+        )
+        self._check_path_index_fields({field: amount})
+        if hash_id is not None:
+            hash_id = ih.decode(hash_id)
+            assert hash_id.startswith(self._base_key), (
+                '{} does not start with {}'.format(repr(hash_id), repr(self._base_key))
+            )
+        if _incr_script is None:
+            _incr_script = rh.REDIS.register_script(_INCR_LUA)
+        self.wait_for_unlock()
+        result = _incr_script(
+            keys=[
+                self._ts_zset_key,
+                self._id_zset_key,
+                self._last_update_string_key,
+                self._changelog_stream_key,
+                self._reindex_hash_key,
+            ],
+            args=[
+                hash_id or '',
+                '' if unique_val is None else str(unique_val),
+                field,
+                amount,
+                _type,
+                self.now_utc_float_string,
+                self._base_key,
+                1 if field in self._index_base_keys else 0,
+                self._history_maxlen if change_history else -1,
+                self._changelog_maxlen,
+                self._cache_channel if self._cache_size else '',
+                ','.join(
+                    name for name, composite_fields in self._composite_indexes.items()
+                    if field in composite_fields
+                ),
+                ','.join(self._path_index_fields),
+            ] + [f for f in self._index_base_keys if f != field]
+        )
+        if not result:
+            return
+        hash_id = ih.decode(result[0])
+        self._unreplicated_writes = True
+        if self._cache is not None:
+            self._cache.pop(hash_id)
+        return ih.from_string(ih.decode(result[1]))
+
+    def incr_float(self, hash_id, field, amount=1.0, change_history=False):
+        """Atomically increment field at hash_id by amount (with HINCRBYFLOAT)
+
+        See self.incr
+        """
+        return self.incr(hash_id, field, amount, change_history, _type='float')
+
+    def incr_by_unique_value(self, unique_val, field, amount=1,
+                             change_history=False, _type='int'):
+        """Atomically increment field of the item with unique_val by amount
+
+        The unique value is resolved in the same server-side script (one round
+        trip). See self.incr
+        """
+        assert self._unique_field, 'Collection does not have a unique_field'
+        return self.incr(None, field, amount, change_history, _type=_type,
+                         unique_val=unique_val)
+
     def validate(self, **data):
         """Validate all fields in data that have a regex; Return list of errors"""
         errors = []
@@ -951,41 +3466,634 @@ class Collection(object):
                     errors.append((field, value, self.field_rx_dict[field].pattern))
         return errors
 
-    def reindex(self):
+    def verify(self, repair=False, batch_size=500, max_busy_ratio=1,
+               examples=10, progress=None, workers=0, chunk_size=1000,
+               id_range=None, lock=True):
+        """Cross-check hashes, sorted sets, index sets, and index counts
+
+        - repair: if True, fix the discrepancies that can be fixed (the
+          collection is locked while each batch is checked and repaired)
+        - batch_size: number of members/keys to check per pipelined batch
+        - max_busy_ratio: fraction of time spent checking; after each batch
+          sleep long enough to keep (checking time / total time) at or below
+          this (i.e. 0.2 against a busy production instance)
+        - examples: max number of example members/keys to report per issue
+        - progress: callable accepting the report dict (called after each batch)
+        - workers: if greater than 0, check the hashes by id ranges of
+          chunk_size in this many worker processes (the report also gets a
+          'workers' dict, see self._run_parallel); the other checks are done
+          in this process
+        - chunk_size: number of hash_ids per chunk (by id number)
+        - id_range: (start, stop) id numbers; if specified, only check the
+          hashes in this range (used by the worker processes)
+        - lock: if False, don't lock the collection to repair (used by the
+          worker processes, since the calling process holds the lock for the
+          whole parallel run)
+
+        Everything is streamed with SCAN/ZSCAN/SSCAN, so memory use is bounded
+        by batch_size. Issues that can be found (and what repair does):
+
+        - ts_without_hash: _ts member whose hash is missing (removed from _ts,
+          _in, and _exp)
+        - in_without_ts / exp_without_ts: _in or _exp member not in _ts
+          (removed)
+        - in_missing: hash not in _in when insert_ts is True (added with its
+          _ts score)
+        - unique_missing: unique value of a hash not in _id (added)
+        - unique_conflict: unique value of a hash maps to another hash_id (not
+          repaired)
+        - unique_dead: _id entry for a hash_id not in _ts (removed)
+        - hash_without_ts: hash that is not in _ts (not repaired)
+        - index_missing: hash not in the index set for its value (added)
+        - index_stale: index set member whose hash is missing or has another
+          value (removed)
+        - count_drift: index count that doesn't match the size of its index
+          set (set to the size)
+        - text_missing: hash not in the token set for a token of its text
+          field (added, and the token added to the vocabulary)
+        - text_stale: token set member whose hash is missing or whose text
+          field no longer has the token (removed)
+        - vocabulary_missing: token set whose token is not in the vocabulary
+          of its text field (added)
+
+        Composite index sets and counts are checked like index fields
+
+        Without repair, the collection is not locked, so writes made during
+        the check may show up as (transient) issues. Return a dict of
+        'checked', 'issues', 'examples', 'repaired', and 'seconds'
+        """
+        assert 0 < max_busy_ratio <= 1, 'max_busy_ratio must be greater than 0 and at most 1'
+        start = time()
+        report = {'checked': {}, 'issues': {}, 'examples': {}, 'repaired': repair, 'seconds': 0}
+        index_fields = list(self._index_base_keys.keys())
+        index_base_keys = dict(self._index_base_keys, **self._composite_base_keys)
+        read_fields = self._index_source_fields(index_fields)
+        read_fields += [self._unique_field] if self._unique_field else []
+        text_fields = sorted(self._text_fields)
+        read_fields += text_fields
+
+        def _found(issue, items):
+            if not items:
+                return
+            report['issues'][issue] = report['issues'].get(issue, 0) + len(items)
+            sample = report['examples'].setdefault(issue, [])
+            sample.extend(items[:max(examples - len(sample), 0)])
+
+        def _run(name, iterator, check):
+            iterator = iter(iterator)
+            while True:
+                batch = list(islice(iterator, batch_size))
+                if not batch:
+                    break
+                batch_start = time()
+                if repair and lock:
+                    self.wait_for_unlock()
+                    self._lock()
+                try:
+                    check(batch)
+                finally:
+                    if repair and lock:
+                        self._unlock()
+                report['checked'][name] = report['checked'].get(name, 0) + len(batch)
+                report['seconds'] = round(time() - start, 6)
+                if progress is not None:
+                    progress(dict(report))
+                if max_busy_ratio < 1:
+                    sleep((time() - batch_start) * (1 - max_busy_ratio) / max_busy_ratio)
+
+        def _index_values(field, raw):
+            """Return the index set values that raw could be stored under"""
+            if field in self._path_index_fields:
+                return set(self._index_strings(field, raw))
+            return {
+                'None' if raw is None else ih.decode(raw),
+                str(self._decode_value(field, raw)),
+            }
+
+        def _index_groups(field, raw):
+            """Return a list of value sets, each of which needs one index set hit
+
+            For a composite index, raw is a dict of its fields and raw values
+            """
+            if field in self._composite_indexes:
+                return [{
+                    _COMPOSITE_SEP.join(parts)
+                    for parts in product(*[
+                        _index_values(f, raw[f]) for f in self._composite_indexes[field]
+                    ])
+                }]
+            if field in self._multi_index_fields:
+                return [{value} for value in self._raw_index_strings(field, raw)]
+            return [_index_values(field, raw)]
+
+        def _check_ts(batch):
+            pipe = rh.REDIS.pipeline(transaction=False)
+            for hash_id, _ in batch:
+                pipe.exists(hash_id)
+                pipe.zscore(self._in_zset_key, hash_id)
+                if read_fields:
+                    pipe.hmget(hash_id, *read_fields)
+            values = pipe.execute()
+            step = 3 if read_fields else 2
+            dead = []
+            in_missing = []
+            candidates = []
+            for i, (hash_id, score) in enumerate(batch):
+                hash_id = ih.decode(hash_id)
+                exists, in_score = values[i * step:i * step + 2]
+                if not exists:
+                    dead.append(hash_id)
+                    continue
+                if self._insert_ts and in_score is None:
+                    in_missing.append((hash_id, score))
+                if read_fields:
+                    candidates.append((hash_id, self._with_path_values(zip(read_fields, values[i * step + 2]))))
+
+            pipe = rh.REDIS.pipeline(transaction=False)
+            for hash_id, raw in candidates:
+                for field in index_fields:
+                    for group in _index_groups(field, raw[field]):
+                        for value in group:
+                            pipe.sismember(self._make_key(self._index_base_keys[field], value), hash_id)
+                for name in self._composite_indexes:
+                    for value in _index_groups(name, raw)[0]:
+                        pipe.sismember(self._make_key(self._composite_base_keys[name], value), hash_id)
+                for text_field in text_fields:
+                    for token in self._tokens(raw[text_field]):
+                        pipe.sismember(self._make_key(self._text_base_keys[text_field], token), hash_id)
+                if self._unique_field:
+                    pipe.zscore(self._id_zset_key, raw[self._unique_field] or '')
+            values = iter(pipe.execute())
+            index_missing = []
+            text_missing = []
+            unique_missing = []
+            unique_conflict = []
+            for hash_id, raw in candidates:
+                # Repairs add the index set value a write would have used
+                # (from the raw stored value, not a decoded variant)
+                for field in index_fields:
+                    groups = _index_groups(field, raw[field])
+                    for group, value in zip(groups, self._raw_index_strings(field, raw[field])):
+                        if not any([next(values) for _ in group]):
+                            index_missing.append((hash_id, field, value))
+                for name, composite_fields in self._composite_indexes.items():
+                    group = _index_groups(name, raw)[0]
+                    if not any([next(values) for _ in group]):
+                        value = _COMPOSITE_SEP.join(
+                            self._raw_index_strings(f, raw[f])[0] for f in composite_fields
+                        )
+                        index_missing.append((hash_id, name, value))
+                for text_field in text_fields:
+                    for token in self._tokens(raw[text_field]):
+                        if not next(values):
+                            text_missing.append((hash_id, text_field, token))
+                if self._unique_field:
+                    num = next(values)
+                    unique_val = raw[self._unique_field]
+                    if unique_val is None:
+                        continue
+                    if num is None:
+                        unique_missing.append((hash_id, unique_val))
+                    elif self._make_key(self._base_key, int(num)) != hash_id:
+                        unique_conflict.append(hash_id)
+
+            _found('ts_without_hash', dead)
+            _found('in_missing', [hash_id for hash_id, _ in in_missing])
+            _found('index_missing', [hash_id for hash_id, _, _ in index_missing])
+            _found('text_missing', [hash_id for hash_id, _, _ in text_missing])
+            _found('unique_missing', [hash_id for hash_id, _ in unique_missing])
+            _found('unique_conflict', unique_conflict)
+            if repair and (dead or in_missing or index_missing or text_missing or unique_missing):
+                pipe = rh.REDIS.pipeline()
+                if dead:
+                    pipe.zrem(self._ts_zset_key, *dead)
+                    pipe.zrem(self._in_zset_key, *dead)
+                    pipe.zrem(self._exp_zset_key, *dead)
+                for hash_id, score in in_missing:
+                    pipe.zadd(self._in_zset_key, {hash_id: score})
+                for hash_id, field, value in index_missing:
+                    pipe.sadd(self._make_key(index_base_keys[field], value), hash_id)
+                for hash_id, text_field, token in text_missing:
+                    self._queue_text_diff(pipe, hash_id, text_field, [], [token])
+                for hash_id, unique_val in unique_missing:
+                    pipe.zadd(self._id_zset_key, {unique_val: int(hash_id.split(':')[-1])})
+                pipe.execute()
+
+        def _check_in_ts(issue, key, batch):
+            hash_ids = [ih.decode(hash_id) for hash_id, _ in batch]
+            scores = self._zmscore(rh.REDIS, self._ts_zset_key, hash_ids)
+            missing = [hash_id for hash_id, score in zip(hash_ids, scores) if score is None]
+            _found(issue, missing)
+            if repair and missing:
+                rh.REDIS.zrem(key, *missing)
+
+        def _check_unique(batch):
+            hash_ids = [self._make_key(self._base_key, int(num)) for _, num in batch]
+            scores = self._zmscore(rh.REDIS, self._ts_zset_key, hash_ids)
+            dead = [
+                unique_val
+                for (unique_val, _), score in zip(batch, scores)
+                if score is None
+            ]
+            _found('unique_dead', [ih.decode(unique_val) for unique_val in dead])
+            if repair and dead:
+                rh.REDIS.zrem(self._id_zset_key, *dead)
+
+        def _check_hashes(batch):
+            prefix_len = len(self._base_key) + 1
+            hash_ids = [
+                ih.decode(key) for key in batch
+                if ih.decode(key)[prefix_len:].isdigit()
+            ]
+            scores = self._zmscore(rh.REDIS, self._ts_zset_key, hash_ids)
+            _found('hash_without_ts', [
+                hash_id for hash_id, score in zip(hash_ids, scores)
+                if score is None
+            ])
+
+        def _check_index_set(field, key, value, batch):
+            members = [ih.decode(member) for member in batch]
+            composite_fields = self._composite_indexes.get(field)
+            pipe = rh.REDIS.pipeline(transaction=False)
+            for hash_id in members:
+                pipe.zscore(self._ts_zset_key, hash_id)
+                if composite_fields:
+                    pipe.hmget(hash_id, *composite_fields)
+                else:
+                    pipe.hget(hash_id, self._index_source_fields([field])[0])
+            values = pipe.execute()
+            if composite_fields:
+                values[1::2] = [dict(zip(composite_fields, raw)) for raw in values[1::2]]
+            elif field in self._path_index_fields:
+                json_field = self._path_index_fields[field][0]
+                values[1::2] = [self._with_path_values({json_field: raw})[field] for raw in values[1::2]]
+            stale = [
+                hash_id
+                for hash_id, score, raw in zip(members, values[::2], values[1::2])
+                if score is None or not any([value in group for group in _index_groups(field, raw)])
+            ]
+            _found('index_stale', ['{} in {}'.format(hash_id, key) for hash_id in stale])
+            if repair and stale:
+                rh.REDIS.srem(key, *stale)
+
+        def _check_counts(field, batch):
+            index_base_key = index_base_keys[field]
+            pipe = rh.REDIS.pipeline(transaction=False)
+            for key in batch:
+                pipe.scard(key)
+                pipe.zscore(index_base_key, ih.decode(key)[len(index_base_key) + 1:])
+            values = pipe.execute()
+            drift = []
+            for key, size, count in zip(batch, values[::2], values[1::2]):
+                if int(count or 0) != size:
+                    drift.append((ih.decode(key)[len(index_base_key) + 1:], size))
+            _found('count_drift', ['{}:{}'.format(field, value) for value, _ in drift])
+            if repair and drift:
+                rh.REDIS.zadd(index_base_key, dict(drift))
+
+        def _check_count_members(field, batch):
+            index_base_key = index_base_keys[field]
+            pipe = rh.REDIS.pipeline(transaction=False)
+            for value, _ in batch:
+                pipe.exists(self._make_key(index_base_key, ih.decode(value)))
+            drift = [
+                ih.decode(value)
+                for (value, count), exists in zip(batch, pipe.execute())
+                if count and not exists
+            ]
+            _found('count_drift', ['{}:{}'.format(field, value) for value in drift])
+            if repair and drift:
+                rh.REDIS.zrem(index_base_key, *drift)
+
+        def _check_text_set(text_field, key, token, batch):
+            members = [ih.decode(member) for member in batch]
+            pipe = rh.REDIS.pipeline(transaction=False)
+            for hash_id in members:
+                pipe.zscore(self._ts_zset_key, hash_id)
+                pipe.hget(hash_id, text_field)
+            values = pipe.execute()
+            stale = [
+                hash_id
+                for hash_id, score, raw in zip(members, values[::2], values[1::2])
+                if score is None or token not in self._tokens(raw)
+            ]
+            _found('text_stale', ['{} in {}'.format(hash_id, key) for hash_id in stale])
+            if repair and stale:
+                rh.REDIS.srem(key, *stale)
+
+        def _check_vocabulary(text_field, batch):
+            base_key = self._text_base_keys[text_field]
+            tokens = [ih.decode(key)[len(base_key) + 1:] for key in batch]
+            scores = self._zmscore(rh.REDIS, base_key, tokens)
+            missing = [token for token, score in zip(tokens, scores) if score is None]
+            _found('vocabulary_missing', ['{}~{}'.format(text_field, token) for token in missing])
+            if repair and missing:
+                rh.REDIS.zadd(base_key, {token: 0 for token in missing})
+
+        if id_range is not None:
+            hash_ids = [self._make_key(self._base_key, i) for i in range(*id_range)]
+            scores = self._zmscore(rh.REDIS, self._ts_zset_key, hash_ids)
+            _run('ts', [(h, score) for h, score in zip(hash_ids, scores) if score is not None], _check_ts)
+            report['seconds'] = round(time() - start, 6)
+            return report
+        if workers:
+            # The lock isn't reentrant, so it is held here (not by each worker)
+            if repair and lock:
+                self.wait_for_unlock()
+                self._lock()
+            try:
+                partial_reports, parallel_report = self._run_parallel(
+                    '_verify_id_range', self._id_ranges(chunk_size), workers=workers,
+                    repair=repair, batch_size=batch_size, max_busy_ratio=max_busy_ratio,
+                    examples=examples, lock=False
+                )
+            finally:
+                if repair and lock:
+                    self._unlock()
+            for partial_report in partial_reports:
+                report['checked']['ts'] = report['checked'].get('ts', 0) + partial_report['checked'].get('ts', 0)
+                for issue, count in partial_report['issues'].items():
+                    report['issues'][issue] = report['issues'].get(issue, 0) + count
+                    sample = report['examples'].setdefault(issue, [])
+                    sample.extend(partial_report['examples'][issue][:max(examples - len(sample), 0)])
+            report['workers'] = parallel_report['workers']
+        else:
+            _run('ts', rh.REDIS.zscan_iter(self._ts_zset_key, count=batch_size), _check_ts)
+        _run('in', rh.REDIS.zscan_iter(self._in_zset_key, count=batch_size),
+             partial(_check_in_ts, 'in_without_ts', self._in_zset_key))
+        _run('exp', rh.REDIS.zscan_iter(self._exp_zset_key, count=batch_size),
+             partial(_check_in_ts, 'exp_without_ts', self._exp_zset_key))
+        if self._unique_field:
+            _run('unique', rh.REDIS.zscan_iter(self._id_zset_key, count=batch_size), _check_unique)
+        _run('keys', rh.REDIS.scan_iter('{}:[0-9]*'.format(self._base_key), count=batch_size),
+             _check_hashes)
+        for field, index_base_key in index_base_keys.items():
+            set_keys = rh.REDIS.scan_iter('{}:*'.format(index_base_key), count=batch_size)
+            for key in set_keys:
+                key = ih.decode(key)
+                value = key[len(index_base_key) + 1:]
+                _run('index_members', rh.REDIS.sscan_iter(key, count=batch_size),
+                     partial(_check_index_set, field, key, value))
+            _run('index_sets', rh.REDIS.scan_iter('{}:*'.format(index_base_key), count=batch_size),
+                 partial(_check_counts, field))
+            _run('index_counts', rh.REDIS.zscan_iter(index_base_key, count=batch_size),
+                 partial(_check_count_members, field))
+        for text_field in text_fields:
+            text_base_key = self._text_base_keys[text_field]
+            for key in rh.REDIS.scan_iter('{}:*'.format(text_base_key), count=batch_size):
+                key = ih.decode(key)
+                token = key[len(text_base_key) + 1:]
+                _run('text_members', rh.REDIS.sscan_iter(key, count=batch_size),
+                     partial(_check_text_set, text_field, key, token))
+            _run('text_sets', rh.REDIS.scan_iter('{}:*'.format(text_base_key), count=batch_size),
+                 partial(_check_vocabulary, text_field))
+        report['seconds'] = round(time() - start, 6)
+        return report
+
+    def _id_ranges(self, chunk_size=1000):
+        """Return list of (start, stop) id number ranges covering every hash_id"""
+        next_id = int(rh.REDIS.get(self._next_id_string_key) or 1)
+        return [
+            (start, min(start + chunk_size, next_id))
+            for start in range(1, next_id, chunk_size)
+        ]
+
+    def _run_parallel(self, method_name, chunks, workers=4, progress=None,
+                      on_result=None, **kwargs):
+        """Call a method for each chunk in a pool of worker processes
+
+        - method_name: name of a method accepting (chunk, **kwargs) and
+          returning (result, number of items processed)
+        - chunks: list of id ranges (see self._id_ranges) or lists of hash_ids
+        - workers: number of worker processes, each with its own connection
+          (if 0, call the method for each chunk in this process)
+        - progress: callable accepting the report dict (called after each chunk)
+        - on_result: callable accepting each result (in chunk order) as soon as
+          it is available; if specified, results are not collected
+
+        Return a list of results (in chunk order; empty if on_result is
+        specified) and a report dict of 'items', 'seconds', 'per_second', and
+        'workers' (dict of worker pid and its 'items', 'seconds', and
+        'per_second')
+        """
+        start = time()
+        report = {'items': 0, 'seconds': 0, 'per_second': 0, 'workers': {}}
+        executor = None
+        if workers:
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_connect_worker,
+                initargs=(rh.REDIS_URL,)
+            )
+            outputs = executor.map(
+                _run_worker_task, repeat(self), repeat(method_name), chunks, repeat(kwargs)
+            )
+        else:
+            outputs = (
+                _run_worker_task(self, method_name, chunk, kwargs)
+                for chunk in chunks
+            )
+        results = []
+        try:
+            for pid, result, num, seconds in outputs:
+                if on_result is not None:
+                    on_result(result)
+                else:
+                    results.append(result)
+                worker = report['workers'].setdefault(pid, {'items': 0, 'seconds': 0, 'per_second': 0})
+                worker['items'] += num
+                worker['seconds'] = round(worker['seconds'] + seconds, 6)
+                if worker['seconds']:
+                    worker['per_second'] = round(worker['items'] / worker['seconds'], 2)
+                report['items'] += num
+                report['seconds'] = round(time() - start, 6)
+                if report['seconds']:
+                    report['per_second'] = round(report['items'] / report['seconds'], 2)
+                if progress is not None:
+                    progress(dict(report))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        report['seconds'] = round(time() - start, 6)
+        return results, report
+
+    def _reindex_id_range(self, id_range):
+        """Add hash_ids in id_range to index sets; return partial index counts"""
+        fields = list(self._index_base_keys.keys())
+        text_fields = sorted(self._text_fields)
+        read_fields = self._index_source_fields(fields) + text_fields
+        hash_ids = [self._make_key(self._base_key, i) for i in range(*id_range)]
+        pipe = rh.REDIS.pipeline(transaction=False)
+        for hash_id in hash_ids:
+            pipe.zscore(self._ts_zset_key, hash_id)
+            pipe.hmget(hash_id, *read_fields)
+        values = pipe.execute()
+        counts = {}
+        members = defaultdict(list)
+        num = 0
+        for hash_id, score, raw in zip(hash_ids, values[::2], values[1::2]):
+            if score is None:
+                continue
+            num += 1
+            strings = {}
+            for field, decoded in self._decoded_index_values(dict(zip(read_fields, raw)), fields):
+                for value in self._index_strings(field, decoded):
+                    members[self._make_key(self._index_base_keys[field], value)].append(hash_id)
+                    field_counts = counts.setdefault(self._index_base_keys[field], {})
+                    field_counts[value] = field_counts.get(value, 0) + 1
+                    strings[field] = value
+            for base_key, value in self._composite_values(strings):
+                members[self._make_key(base_key, value)].append(hash_id)
+                field_counts = counts.setdefault(base_key, {})
+                field_counts[value] = field_counts.get(value, 0) + 1
+            for text_field, raw_text in zip(text_fields, raw[-len(text_fields):] if text_fields else []):
+                base_key = self._text_base_keys[text_field]
+                for token in self._tokens(raw_text):
+                    members[self._make_key(base_key, token)].append(hash_id)
+                    # Vocabulary scores are all 0 (so merged partial counts stay 0)
+                    counts.setdefault(base_key, {})[token] = 0
+        pipe = rh.REDIS.pipeline(transaction=False)
+        for key, key_members in members.items():
+            pipe.sadd(key, *key_members)
+        pipe.execute()
+        return counts, num
+
+    def _verify_id_range(self, id_range, **kwargs):
+        """Check the hashes in id_range; return the partial verify report and
+        the number of hashes checked
+        """
+        report = self.verify(id_range=id_range, **kwargs)
+        return report, report['checked'].get('ts', 0)
+
+    def _export_id_range(self, id_range, fields=''):
+        """Return list of JSON strings for the items in id_range"""
+        hash_ids = [self._make_key(self._base_key, i) for i in range(*id_range)]
+        results = self.get(hash_ids, fields, include_meta=True, update_get_stats=False)
+        if len(hash_ids) == 1:
+            results = [results]
+        lines = []
+        for data in results:
+            if data['_ts'] is None or not set(data) - META_FIELDS:
+                continue
+            for field in self._pickle_fields.intersection(data):
+                data[field] = repr(data[field])
+            lines.append(dumps(data))
+        return lines, len(lines)
+
+    def _delete_id_list(self, hash_ids):
+        """Delete a chunk of hash_ids; return number deleted (twice)"""
+        deleted = self._delete_chunk(hash_ids)
+        return deleted, deleted
+
+    def export(self, path, fields='', workers=0, chunk_size=1000, progress=None):
+        """Write every item (with _id and _ts) to a file as JSON lines
+
+        - path: file to write to
+        - fields: string of field names to export separated by any of , ; |
+          (default is all fields)
+        - workers: number of worker processes to fetch and encode items with
+          (if 0, do it in this process)
+        - chunk_size: number of hash_ids per chunk (by id number)
+        - progress: callable accepting the report dict (see self._run_parallel)
+
+        Items are written in id order (each chunk as soon as it and the chunks
+        before it are done); pickle fields are written with repr. Return the
+        report dict from self._run_parallel
+        """
+        with open(path, 'w') as fp:
+            def _write(lines):
+                for line in lines:
+                    fp.write(line + '\n')
+
+            _, report = self._run_parallel(
+                '_export_id_range', self._id_ranges(chunk_size), workers=workers,
+                progress=progress, on_result=_write, fields=fields
+            )
+        return report
+
+    def reindex(self, workers=0, chunk_size=1000):
         """Re-index whatever data is currently in the collection
 
+        - workers: if greater than 0, split the hash_ids into id ranges of
+          chunk_size and index them in this many worker processes (partial
+          index counts are merged into the count sorted sets at the end)
+        - chunk_size: number of hash_ids per chunk (by id number)
+
         This should only have to be done if new field names are added to
-        'index_fields' (via modifying init args to define the Collection instance)
+        'index_fields' or 'text_fields' (via modifying init args to define the
+        Collection instance)
 
         This should also be run if changing the value of the insert_ts init arg
+
+        The collection is locked the whole time (see self.reindex_online to
+        rebuild index fields in batches while writes continue). If workers is
+        greater than 0, return the report dict from self._run_parallel
         """
         self.wait_for_unlock()
         self._lock()
 
         pipe = rh.REDIS.pipeline()
-        for index_base_key in self._index_base_keys.values():
-            for key in rh.REDIS.scan_iter('{}*'.format(index_base_key)):
+        for index_base_key in chain(
+            self._index_base_keys.values(),
+            self._composite_base_keys.values(),
+            self._text_base_keys.values()
+        ):
+            pipe.delete(index_base_key)
+            for key in rh.REDIS.scan_iter('{}:*'.format(index_base_key)):
                 pipe.delete(ih.decode(key))
         pipe.execute()
 
         pipe = rh.REDIS.pipeline()
         base_key_counts = {}
-        for hash_id in rh.zshow(self._ts_zset_key, withscores=False):
+        report = None
+        if workers and (self._index_base_keys or self._text_fields):
+            partial_counts, report = self._run_parallel(
+                '_reindex_id_range', self._id_ranges(chunk_size), workers=workers
+            )
+            for counts in partial_counts:
+                for base_key, count_dict in counts.items():
+                    merged = base_key_counts.setdefault(base_key, {})
+                    for value, count in count_dict.items():
+                        merged[value] = merged.get(value, 0) + count
+        hash_ids = rh.zshow(self._ts_zset_key, withscores=False) if not report else []
+        index_fields = list(self._index_base_keys.keys())
+        read_fields = self._index_source_fields(index_fields)
+        for hash_id in hash_ids:
             hash_id = ih.decode(hash_id)
-            data = self.get(hash_id)
+            # Read the raw values (get() would skip an expired item that
+            # hasn't been trimmed yet)
+            raw = dict(zip(read_fields, rh.REDIS.hmget(hash_id, *read_fields))) if read_fields else {}
+            data = dict(self._decoded_index_values(raw, index_fields))
+            strings = {
+                index_field: str(data.get(index_field))
+                for index_field in self._index_base_keys
+                if index_field not in self._multi_index_fields
+            }
+            index_values = [
+                (base_key, self._index_strings(index_field, data.get(index_field)))
+                for index_field, base_key in self._index_base_keys.items()
+            ] + [
+                (base_key, [value])
+                for base_key, value in self._composite_values(strings)
+            ]
 
-            for index_field, base_key in self._index_base_keys.items():
-                index_field_data = data.get(index_field)
-                key_name = self._make_key(base_key, index_field_data)
-                pipe.sadd(key_name, hash_id)
-                try:
-                    base_key_counts[base_key][index_field_data] += 1
-                except KeyError:
+            for base_key, index_strings in index_values:
+                for index_field_data in index_strings:
+                    key_name = self._make_key(base_key, index_field_data)
+                    pipe.sadd(key_name, hash_id)
                     try:
-                        base_key_counts[base_key][index_field_data] = 1
+                        base_key_counts[base_key][index_field_data] += 1
                     except KeyError:
-                        base_key_counts[base_key] = {}
-                        base_key_counts[base_key][index_field_data] = 1
+                        try:
+                            base_key_counts[base_key][index_field_data] = 1
+                        except KeyError:
+                            base_key_counts[base_key] = {}
+                            base_key_counts[base_key][index_field_data] = 1
+
+            if self._text_fields:
+                text_fields = sorted(self._text_fields)
+                for text_field, raw_text in zip(text_fields, rh.REDIS.hmget(hash_id, *text_fields)):
+                    self._queue_text_diff(pipe, hash_id, text_field, [], self._tokens(raw_text))
 
         for base_key, count_dict in base_key_counts.items():
             for count_name, value in count_dict.items():
@@ -994,6 +4102,7 @@ class Collection(object):
         if not self._insert_ts:
             pipe.delete(self._in_zset_key)
 
+        self._queue_change(pipe, 'reindex', '', self._index_base_keys.keys(), self.now_utc_float)
         pipe.execute()
 
         if self._insert_ts:
@@ -1005,23 +4114,219 @@ class Collection(object):
             pipe.execute()
 
         self._unlock()
+        return report
+
+    def _shadow_base_key(self, index_field):
+        """Return the base key of the shadow index for index_field"""
+        return self._make_key(self._base_key, '_shadow', index_field)
+
+    def reindex_status(self):
+        """Return dict of info about the online reindex in progress (or None)
+
+        Keys are 'fields', 'done', 'total', 'seconds', 'per_second', and
+        'eta_seconds'
+        """
+        state = {
+            ih.decode(k): ih.decode(v)
+            for k, v in rh.REDIS.hgetall(self._reindex_hash_key).items()
+        }
+        if not state:
+            return None
+        done = int(state.get('done', 0))
+        total = int(state.get('total', 0))
+        seconds = float(state.get('seconds', 0))
+        per_second = round(done / seconds, 2) if seconds else 0
+        return {
+            'fields': ih.string_to_list(state['fields']),
+            'done': done,
+            'total': total,
+            'seconds': round(seconds, 3),
+            'per_second': per_second,
+            'eta_seconds': round(max(total - done, 0) / per_second, 1) if per_second else None,
+        }
+
+    def reindex_online(self, fields='', batch_size=1000, restart=False,
+                       max_seconds=None, progress=None, show=False):
+        """Rebuild indexes in batches without locking the collection throughout
+
+        - fields: string of index fields to (re)build separated by any of , ; |
+          (default is all index_fields); use this to add a new index field
+          without rebuilding the others
+        - batch_size: number of hash_ids to index per batch (the collection is
+          only locked while a batch is read and written)
+        - restart: if True, discard an unfinished build (of any fields) and
+          start over
+        - max_seconds: stop after this many seconds (call again to resume)
+        - progress: callable accepting the dict returned by self.reindex_status
+          (called after each batch)
+        - show: if True, print progress and ETA after each batch
+
+        New index sets are built under a shadow prefix using a ZSCAN of the
+        _ts sorted set and pipelined HMGETs of only the fields being indexed.
+        Adds, updates, and deletes made while the build is in progress are
+        mirrored to the shadow indexes. The position of the scan is saved after
+        every batch, so an interrupted build is resumed by calling this again.
+        When the scan finishes, index counts are computed from the shadow sets
+        and the shadow keys are renamed over the current index keys in one
+        transaction
+
+        Return the final reindex_status (or None if the swap was done)
+        """
+        fields = ih.string_to_list(fields) or sorted(self._index_base_keys.keys())
+        invalid = set(fields) - set(self._index_base_keys)
+        assert not invalid, 'not index fields: {}'.format(invalid)
+        read_fields = self._index_source_fields(fields)
+        fields_string = ','.join(fields)
+        state = rh.REDIS.hgetall(self._reindex_hash_key)
+        current = ih.decode(state.get(b'fields', b''))
+        if current and (restart or current != fields_string):
+            assert restart, 'reindex of {} already in progress (use restart=True)'.format(repr(current))
+            self.wait_for_unlock()
+            self._lock()
+            try:
+                rh.REDIS.delete(self._reindex_hash_key)
+            finally:
+                self._unlock()
+            self._clear_shadow_keys(ih.string_to_list(current))
+            current = ''
+        if not current:
+            self._clear_shadow_keys(fields)
+            self.wait_for_unlock()
+            self._lock()
+            try:
+                rh.REDIS.hset(self._reindex_hash_key, mapping={
+                    'fields': fields_string,
+                    'cursor': 0,
+                    'done': 0,
+                    'total': rh.REDIS.zcard(self._ts_zset_key),
+                    'seconds': 0,
+                })
+            finally:
+                self._unlock()
+
+        start = time()
+        cursor = int(rh.REDIS.hget(self._reindex_hash_key, 'cursor'))
+        while max_seconds is None or time() - start < max_seconds:
+            batch_start = time()
+            self.wait_for_unlock()
+            self._lock()
+            try:
+                cursor, found = rh.REDIS.zscan(self._ts_zset_key, cursor, count=batch_size)
+                hash_ids = [ih.decode(hash_id) for hash_id, _ in found]
+                pipe = rh.REDIS.pipeline(transaction=False)
+                for hash_id in hash_ids:
+                    pipe.hmget(hash_id, *read_fields)
+                values = pipe.execute()
+                pipe = rh.REDIS.pipeline()
+                members = defaultdict(list)
+                for hash_id, raw in zip(hash_ids, values):
+                    for field, value in self._decoded_index_values(dict(zip(read_fields, raw)), fields):
+                        for index_string in self._index_strings(field, value):
+                            members[self._make_key(self._shadow_base_key(field), index_string)].append(hash_id)
+                for key, key_members in members.items():
+                    pipe.sadd(key, *key_members)
+                pipe.hset(self._reindex_hash_key, 'cursor', cursor)
+                pipe.hincrby(self._reindex_hash_key, 'done', len(found))
+                pipe.hincrbyfloat(self._reindex_hash_key, 'seconds', time() - batch_start)
+                pipe.execute()
+            finally:
+                self._unlock()
+            status = self.reindex_status()
+            if progress is not None:
+                progress(status)
+            if show:
+                print('{}: reindexed {} of {} ({}/s, ETA {}s)'.format(
+                    self._base_key, status['done'], status['total'],
+                    status['per_second'], status['eta_seconds']
+                ))
+            if cursor == 0:
+                self._swap_shadow_indexes(fields)
+                return
+        return self.reindex_status()
+
+    def _clear_shadow_keys(self, fields):
+        """Delete all shadow index keys for fields"""
+        for field in fields:
+            shadow_base_key = self._shadow_base_key(field)
+            keys = list(rh.REDIS.scan_iter('{}:*'.format(shadow_base_key)))
+            for i in range(0, len(keys), 1000):
+                rh.REDIS.unlink(*keys[i:i + 1000])
+            rh.REDIS.delete(shadow_base_key)
+
+    def _swap_shadow_indexes(self, fields):
+        """Rename shadow index keys over the index keys of fields (one transaction)"""
+        self.wait_for_unlock()
+        self._lock()
+        try:
+            renames = []
+            old_keys = []
+            counts = {}
+            for field in fields:
+                shadow_base_key = self._shadow_base_key(field)
+                index_base_key = self._index_base_keys[field]
+                shadow_keys = [
+                    ih.decode(key)
+                    for key in rh.REDIS.scan_iter('{}:*'.format(shadow_base_key))
+                ]
+                pipe = rh.REDIS.pipeline(transaction=False)
+                for key in shadow_keys:
+                    pipe.scard(key)
+                counts[field] = {}
+                for key, size in zip(shadow_keys, pipe.execute()):
+                    value = key[len(shadow_base_key) + 1:]
+                    if size:
+                        counts[field][value] = size
+                        renames.append((key, self._make_key(index_base_key, value)))
+                old_keys.append(index_base_key)
+                old_keys.extend(rh.REDIS.scan_iter('{}:*'.format(index_base_key)))
+
+            pipe = rh.REDIS.pipeline()
+            for i in range(0, len(old_keys), 1000):
+                pipe.unlink(*old_keys[i:i + 1000])
+            for key, new_key in renames:
+                pipe.rename(key, new_key)
+            for field, field_counts in counts.items():
+                if field_counts:
+                    pipe.zadd(self._index_base_keys[field], field_counts)
+            pipe.delete(self._reindex_hash_key)
+            self._queue_change(pipe, 'reindex', '', fields, self.now_utc_float)
+            pipe.execute()
+        finally:
+            self._unlock()
 
     def old_data_for_hash_id(self, hash_id):
-        """Return info about fields that have been modified on the hash_id"""
+        """Return info about fields that have been modified on the hash_id
+
+        Changes saved in the older _changes hash key are also included
+        """
         assert hash_id.startswith(self._base_key), (
             '{} does not start with {}'.format(repr(hash_id), repr(self._base_key))
         )
         results = []
-        changes_hash_key = self._make_key(hash_id, '_changes')
-        for name, value in rh.REDIS.hgetall(changes_hash_key).items():
-            field, timestamp = ih.decode(name).split('--')
+        pipe = rh.REDIS.pipeline(transaction=False)
+        pipe.hgetall(self._make_key(hash_id, '_changes'))
+        pipe.xrange(self._make_key(hash_id, '_history'))
+        legacy, entries = pipe.execute()
+        old_values = [
+            (ih.decode(name).split('--'), ih.decode(value))
+            for name, value in legacy.items()
+        ]
+        for _, entry in entries:
+            entry = {ih.decode(k): v for k, v in entry.items()}
+            timestamp = ih.decode(entry.pop('_ts'))
+            entry.pop('_new_ts')
+            added = ih.string_to_set(ih.decode(entry.pop('_added', b'')))
+            for field, value in entry.items():
+                value = None if field in added else self._decode_value(field, value)
+                old_values.append(((field, timestamp), str(value)))
+        for (field, timestamp), value in old_values:
             results.append({
                 '_ts_raw': timestamp,
                 '_ts_admin': dh.utc_float_to_pretty(
                     timestamp, fmt=dh.ADMIN_DATE_FMT, timezone=dh.ADMIN_TIMEZONE
                 ),
                 'field': field,
-                'value': ih.decode(value),
+                'value': value,
             })
         results.sort(key=lambda x: (x['_ts_raw'], x['field']))
         return results
@@ -1031,6 +4336,57 @@ class Collection(object):
         hash_id = self.get_hash_id_for_unique_value(unique_val)
         return self.old_data_for_hash_id(hash_id)
 
+    def history(self, terms='', since='', start=None, limit=None):
+        """Return dict of hash_ids (matching terms) and lists of their changes
+
+        - terms: string of 'index_field:value' pairs
+        - since: 'num:unit' string (i.e. 15:seconds, 1.5:weeks, etc)
+        - start: utc_float (instead of since)
+        - limit: max number of hash_ids to return changes for
+
+        Only hash_ids modified since the start time are checked, and only the
+        entries of their change history streams after that time are read (in a
+        single pipeline). Each change is a dict with '_ts' (time of the update),
+        '_prev_ts' (time the old values were set), and 'old' (dict of fields
+        and the values they had before the update)
+        """
+        if since:
+            start = float(dh.utc_ago_float_string(since, now=self.now_utc_float_string))
+        start = start or 0
+        hash_ids = self.find(
+            terms=terms,
+            start=start or None,
+            limit=limit if limit is not None else self.size,
+            desc=True,
+            item_format='{_id}'
+        )
+        # Stream entry ids use the redis server clock, so allow some skew
+        min_id = max(_utc_float_to_stream_ms(start) - 60000, 0) if start else 0
+        pipe = rh.REDIS.pipeline(transaction=False)
+        for hash_id in hash_ids:
+            pipe.xrange(self._make_key(hash_id, '_history'), min=min_id)
+        results = OrderedDict()
+        for hash_id, entries in zip(hash_ids, pipe.execute()):
+            changes = []
+            for _, entry in entries:
+                entry = {ih.decode(k): v for k, v in entry.items()}
+                new_ts = float(entry.pop('_new_ts'))
+                prev_ts = float(entry.pop('_ts'))
+                if new_ts < start:
+                    continue
+                added = ih.string_to_set(ih.decode(entry.pop('_added', b'')))
+                changes.append({
+                    '_ts': new_ts,
+                    '_prev_ts': prev_ts,
+                    'old': {
+                        field: None if field in added else self._decode_value(field, value)
+                        for field, value in entry.items()
+                    },
+                })
+            if changes:
+                results[hash_id] = changes
+        return results
+
     def recent_unique_values(self, limit=10):
         """Return list of limit most recent unique values
 
@@ -1040,7 +4396,7 @@ class Collection(object):
         limit = self.size if limit is None else limit
         return [
             ih.decode(val)
-            for val in rh.REDIS.zrevrange(self._id_zset_key, start=0, end=limit-1)
+            for val in self._reader.zrevrange(self._id_zset_key, start=0, end=limit-1)
         ]
 
     def all_unique_values(self):
@@ -1052,6 +4408,8 @@ class Collection(object):
 
         - index_name: name of index field to get top values and counts for
             - if index_name is the self._unique_field, the order by most recent
+            - if index_name is a composite index (i.e. 'host+uri'), each value
+              is a tuple of field values
         - limit: max number of results to return (default 10)
             - if None is passed, then all results will be returned
         """
@@ -1062,13 +4420,20 @@ class Collection(object):
                 for value in self.recent_unique_values(limit=limit)
             ]
 
+        if index_name in self._composite_base_keys:
+            base_key = self._composite_base_keys[index_name]
+            return [
+                (tuple(ih.decode(name).split(_COMPOSITE_SEP)), int(count))
+                for name, count in self._reader.zrange(base_key, 0, limit-1, withscores=True, desc=True)
+            ]
+
         assert index_name in self._index_base_keys, (
             '{} is not in {}'.format(repr(index_name), repr(sorted(list(self._index_base_keys.keys()))))
         )
         base_key = self._index_base_keys[index_name]
         return [
             (ih.decode(name), int(count))
-            for name, count in rh.zshow(base_key, end=limit-1)
+            for name, count in self._reader.zrange(base_key, 0, limit-1, withscores=True, desc=True)
         ]
 
     def index_field_info(self, limit=10):
@@ -1078,18 +4443,233 @@ class Collection(object):
             - if None is passed, then all results will be returned
         """
         limit = self.size if limit is None else limit
+        reader = self._reader
         results = []
         for index_field, base_key in sorted(self._index_base_keys.items()):
             results.extend([
                 (':'.join([index_field, ih.decode(name)]), int(count))
-                for name, count in rh.zshow(base_key, end=limit-1)
+                for name, count in reader.zrange(base_key, 0, limit-1, withscores=True, desc=True)
             ])
         return results
 
+    def _is_semi_join_field(self, index_field):
+        """Return True if index_field is a 'reference_field.index_field' term"""
+        return (
+            index_field not in self._index_base_keys and
+            index_field.split('.', 1)[0] in self.field_reference_dict
+        )
+
+    def _semi_join_parts(self, index_field, grouped_terms):
+        """Return the referenced collection, its index set keys for grouped_terms,
+        and the local index key prefix for a 'reference_field.index_field' term
+        """
+        ref_field, ref_index = index_field.split('.', 1)
+        collection = self.field_reference_dict[ref_field]
+        assert ref_field in self._index_base_keys, (
+            'reference field {} must also be an index field'.format(repr(ref_field))
+        )
+        assert ref_index in collection._index_base_keys, (
+            '{} is not an index field of {}'.format(repr(ref_index), collection._base_key)
+        )
+        ref_keys = [
+            collection._make_key(collection._base_key, ref_index, term.split(':', 1)[1])
+            for term in grouped_terms
+        ]
+        return collection, ref_keys, self._make_key(self._base_key, ref_field, '')
+
+    def _semi_join(self, dest_key, index_field, grouped_terms, batch_size=1000):
+        """Store the set of local hash_ids whose reference field points at an
+        item matching grouped_terms in the referenced collection
+
+        - dest_key: name of the set to store the hash_ids in
+        - index_field: string with form 'reference_field.index_field'
+        - grouped_terms: list of terms for index_field (unioned)
+        - batch_size: number of referenced hash_ids to map per round trip
+
+        The referenced hash_ids are read with SSCAN and mapped to unique values
+        (and the local index sets) in batches, so no single command has to
+        work through the whole join. Return the size of the set
+        """
+        collection, ref_keys, prefix = self._semi_join_parts(index_field, grouped_terms)
+        rh.REDIS.delete(dest_key)
+        ref_ids = chain.from_iterable(
+            rh.REDIS.sscan_iter(ref_key, count=batch_size) for ref_key in ref_keys
+        )
+        while True:
+            batch = list(islice(ref_ids, batch_size))
+            if not batch:
+                break
+            pipe = rh.REDIS.pipeline(transaction=False)
+            for ref_id in batch:
+                number = int(ih.decode(ref_id).split(':')[-1])
+                pipe.zrangebyscore(collection._id_zset_key, number, number)
+            local_keys = [
+                prefix + ih.decode(unique_vals[0])
+                for unique_vals in pipe.execute()
+                if unique_vals
+            ]
+            if local_keys:
+                rh.REDIS.sunionstore(dest_key, [dest_key] + local_keys)
+        return rh.REDIS.scard(dest_key)
+
+    def _text_term(self, term):
+        """Return (text field, op, value) if term is a text term, otherwise None
+
+        Op is '~' for words (value is tokenized like the text field) or '^' for
+        a token prefix (value is the last word, lowercased and stemmed like the
+        indexed tokens; '' if there is no word)
+        """
+        for text_field in self._text_fields:
+            for op in ('~', '^'):
+                if term.startswith(text_field + op):
+                    value = term[len(text_field) + 1:]
+                    if op == '^':
+                        words = TOKEN_RX.findall(value.lower())
+                        value = words[-1] if words else ''
+                        if value and self._text_stemming:
+                            value = stem(value)
+                    return text_field, op, value
+        return None
+
+    def _prefix_union(self, dest_key, text_field, prefix):
+        """Store the set of hash_ids with a token of text_field starting with
+        prefix (server-side); return the size of the set
+
+        - dest_key: name of the set to store the hash_ids in
+        """
+        global _prefix_union_script
+        base_key = self._text_base_keys[text_field]
+        if _prefix_union_script is None:
+            _prefix_union_script = rh.REDIS.register_script(_PREFIX_UNION_LUA)
+        return _prefix_union_script(
+            keys=[dest_key, base_key],
+            args=[prefix, self._make_key(base_key, '')]
+        )
+
+    def _use_composite_indexes(self, grouped_terms):
+        """Replace terms covered by a composite index with one composite term
+
+        - grouped_terms: dict of index fields and lists of their terms (only
+          fields with a single term can be covered)
+
+        Larger composite indexes are used first. Return grouped_terms
+        """
+        composites = sorted(self._composite_indexes.items(), key=lambda item: -len(item[1]))
+        for name, composite_fields in composites:
+            if all(len(grouped_terms.get(f, [])) == 1 for f in composite_fields):
+                values = [grouped_terms.pop(f)[0].split(':', 1)[1] for f in composite_fields]
+                grouped_terms[name] = ['{}:{}'.format(name, _COMPOSITE_SEP.join(values))]
+        return grouped_terms
+
+    def explain(self, terms='', insert_ts=False):
+        """Return a dict describing how find would resolve terms (without running it)
+
+        - terms: string of 'index_field:value' pairs (or text terms, see
+          self.find) separated by any of , ; |
+        - insert_ts: if True, use score of insert time instead of modify time
+
+        Each step has the 'field', the 'op' used to build its set ('set',
+        'union', 'composite', 'semi-join', 'text' for one token of a words
+        term, or 'prefix' for the union of the tokens matching a prefix), the
+        'keys' it reads and their 'sizes' (steps are sorted smallest first, as
+        Redis intersects them). 'max_results' is an upper bound on the number
+        of matches (None if no plain index sets are used, since semi-join
+        sizes are only known once they are run)
+        """
+        d = defaultdict(list)
+        steps = []
+        for term in ih.string_to_set(terms):
+            text_term = self._text_term(term)
+            if text_term is None:
+                d[term.split(':', 1)[0]].append(term)
+                continue
+            text_field, op, value = text_term
+            base_key = self._text_base_keys[text_field]
+            if op == '~':
+                tokens = self._tokens(value)
+                if not tokens:
+                    # Only stop words (or no words), so nothing can match
+                    steps.append({'field': text_field, 'op': 'text', 'keys': []})
+                for token in tokens:
+                    steps.append({
+                        'field': text_field,
+                        'op': 'text',
+                        'keys': [self._make_key(base_key, token)],
+                    })
+            else:
+                tokens = []
+                if value:
+                    tokens = rh.REDIS.zrangebylex(base_key, '[' + value, b'[' + value.encode() + b'\xff')
+                steps.append({
+                    'field': text_field,
+                    'op': 'prefix',
+                    'keys': [self._make_key(base_key, ih.decode(token)) for token in tokens],
+                    'through': base_key,
+                })
+        self._use_composite_indexes(d)
+        pipe = rh.REDIS.pipeline(transaction=False)
+        for index_field, grouped_terms in sorted(d.items()):
+            if self._is_semi_join_field(index_field):
+                collection, ref_keys, prefix = self._semi_join_parts(index_field, grouped_terms)
+                steps.append({
+                    'field': index_field,
+                    'op': 'semi-join',
+                    'keys': ref_keys,
+                    'collection': collection._base_key,
+                    'through': prefix + '*',
+                })
+            else:
+                op = 'union' if len(grouped_terms) > 1 else 'set'
+                if index_field in self._composite_indexes:
+                    op = 'composite'
+                steps.append({
+                    'field': index_field,
+                    'op': op,
+                    'keys': [self._make_key(self._base_key, term) for term in grouped_terms],
+                })
+            for key in steps[-1]['keys']:
+                pipe.scard(key)
+        sizes = pipe.execute()
+        for step in steps:
+            step['sizes'] = sizes[:len(step['keys'])]
+            sizes = sizes[len(step['keys']):]
+        steps.sort(key=lambda step: sum(step['sizes']))
+        bounded = [sum(step['sizes']) for step in steps if step['op'] != 'semi-join']
+        return {
+            'steps': steps,
+            'intersect': 'sinterstore' if len(steps) > 1 else None,
+            'sorted_by': self._ts_zset_key if not insert_ts else self._in_zset_key,
+            'max_results': min(bounded) if bounded else None,
+        }
+
+    def _live_range(self, reader, result_key, start, end, desc=False, limit=20,
+                    count=False):
+        """Return (hash_id, score) tuples in result_key between start and end,
+        skipping expired hash_ids (or the number of them if count is True)
+
+        Expire times are checked in the same server-side script call as the
+        range, so no extra round trip is made
+        """
+        global _live_range_script
+        if _live_range_script is None:
+            _live_range_script = rh.REDIS.register_script(_LIVE_RANGE_LUA)
+        result = _live_range_script(
+            keys=[result_key, self._exp_zset_key],
+            args=[
+                start, end, int(bool(desc)), limit or 0, self.now_utc_float,
+                int(bool(count))
+            ],
+            client=reader
+        )
+        if count:
+            return result
+        return [(result[i], float(result[i + 1])) for i in range(0, len(result), 2)]
+
     def _redis_zset_from_terms(self, terms='', insert_ts=False):
         """Return Redis key containing sorted set and bool denoting if its a temp
 
-        - terms: string of 'index_field:value' pairs separated by any of , ; |
+        - terms: string of 'index_field:value' pairs (or text terms, see
+          self.find) separated by any of , ; |
         - insert_ts: if True, use score of insert time instead of modify time
 
         Also keep track of count, size, and timestamp stats for any intermediate
@@ -1103,11 +4683,42 @@ class Collection(object):
         now = self.now_utc_float
         zset_key = self._ts_zset_key if not insert_ts else self._in_zset_key
         for term in terms:
+            text_term = self._text_term(term)
+            if text_term is not None:
+                text_field, op, value = text_term
+                tokens = self._tokens(value) if op == '~' else [value]
+                if not any(tokens):
+                    # Only stop words (or no words), so nothing can match;
+                    # intersect with an empty temporary set
+                    tmp_key = self._get_next_find_key()
+                    tmp_keys.append(tmp_key)
+                    to_intersect.append(tmp_key)
+                elif op == '~':
+                    # Every token of the words is intersected (stop words are skipped)
+                    for token in tokens:
+                        k = self._make_key(self._text_base_keys[text_field], token)
+                        stat_base_names['{}~{}'.format(text_field, token)] = k
+                        to_intersect.append(k)
+                else:
+                    tmp_key = self._get_next_find_key()
+                    stat_base_names[term] = tmp_key
+                    tmp_keys.append(tmp_key)
+                    self._prefix_union(tmp_key, text_field, value)
+                    to_intersect.append(tmp_key)
+                continue
             index_field, *value = term.split(':')
             value = ':'.join(value)
             d[index_field].append(term)
+        self._use_composite_indexes(d)
         for index_field, grouped_terms in d.items():
-            if len(grouped_terms) > 1:
+            if self._is_semi_join_field(index_field):
+                # Resolve the referenced collection's index sets to local ids
+                tmp_key = self._get_next_find_key()
+                stat_base_names[';'.join(sorted(grouped_terms))] = tmp_key
+                tmp_keys.append(tmp_key)
+                self._semi_join(tmp_key, index_field, grouped_terms)
+                to_intersect.append(tmp_key)
+            elif len(grouped_terms) > 1:
                 # Compute the union of all index_keys for the same field
                 tmp_key = self._get_next_find_key()
                 stat_base_names[';'.join(sorted(grouped_terms))] = tmp_key
@@ -1140,7 +4751,9 @@ class Collection(object):
         else:
             last_key = zset_key
 
-        if stat_base_names:
+        if stat_base_names and self._sketch_stats:
+            self._update_find_sketch_stats(stat_base_names, now)
+        elif stat_base_names:
             pipe = rh.REDIS.pipeline()
             for stat_base, set_name in stat_base_names.items():
                 set_len = rh.REDIS.scard(set_name)
@@ -1168,6 +4781,37 @@ class Collection(object):
 
         return (last_key, tmp_keys != [])
 
+    def _update_find_sketch_stats(self, stat_base_names, now):
+        """Update the count-min sketch and bounded zsets of find stats
+
+        - stat_base_names: dict of search names and the sets they resolved to
+        - now: utc_float
+
+        Search counts go to a count-min sketch (keeping the stats_top_k highest
+        estimates in a zset), and the last sizes and search times are kept for
+        the stats_top_k largest/most recent searches
+        """
+        k = self._stats_top_k
+        pipe = rh.REDIS.pipeline(transaction=False)
+        for set_name in stat_base_names.values():
+            pipe.scard(set_name)
+        sizes = dict(zip(stat_base_names.keys(), pipe.execute()))
+        found = {name: size for name, size in sizes.items() if size}
+        missing = [name for name, size in sizes.items() if not size]
+
+        pipe = rh.REDIS.pipeline(transaction=False)
+        if missing:
+            pipe.zrem(self._find_searches_zset_key, *missing)
+            pipe.zrem(self._find_top_zset_key, *missing)
+            pipe.zrem(self._find_sizes_zset_key, *missing)
+        if found:
+            queue_cms_topk(pipe, self._find_cms_key, self._find_top_zset_key, {name: 1 for name in found}, k)
+            pipe.zadd(self._find_searches_zset_key, {name: now for name in found})
+            pipe.zadd(self._find_sizes_zset_key, found)
+            pipe.zremrangebyrank(self._find_searches_zset_key, 0, -(k + 1))
+            pipe.zremrangebyrank(self._find_sizes_zset_key, 0, -(k + 1))
+        pipe.execute()
+
     def find(self, terms='', start=None, end=None, limit=20, desc=None,
              get_fields='', all_fields=False, count=False, ts_fmt=None,
              ts_tz=None, admin_fmt=False, start_ts='', end_ts='', since='',
@@ -1179,6 +4823,10 @@ class Collection(object):
         must be separated by any of , ; |
 
         - terms: string of 'index_field:value' pairs
+            - 'text_field~words' matches items with every word of words in
+              text_field (words are tokenized like text_field values)
+            - 'text_field^prefix*' matches items with any word in text_field
+              starting with prefix
         - start: utc_float
         - end: utc_float
         - limit: max number of results to return (default 20)
@@ -1224,6 +4872,9 @@ class Collection(object):
         results = {}
         now = self.now_utc_float_string
         result_key, result_key_is_tmp = self._redis_zset_from_terms(terms, insert_ts)
+
+        # Temporary result sets are only on rh.REDIS (replicas are read-only)
+        reader = rh.REDIS if result_key_is_tmp else self._reader
         time_ranges = dh.get_time_ranges_and_args(
             tz=ts_tz,
             now=now,
@@ -1242,11 +4893,15 @@ class Collection(object):
 
         for name, start_end_tuple in time_ranges.items():
             _start, _end = start_end_tuple
-            if count:
+            if self._expiring:
+                live_range = partial(self._live_range, reader, result_key, _start, _end)
+            if count and self._expiring:
+                results[name] = live_range(count=True)
+            elif count:
                 if _start > 0 or _end < float('inf'):
-                    func = partial(rh.REDIS.zcount, result_key, _start, _end)
+                    func = partial(reader.zcount, result_key, _start, _end)
                 else:
-                    func = partial(rh.REDIS.zcard, result_key)
+                    func = partial(reader.zcard, result_key)
                 results[name] = func()
             else:
                 _desc = desc
@@ -1256,42 +4911,38 @@ class Collection(object):
                     else:
                         _desc = True
 
-                if _desc:
+                if self._expiring:
+                    func = partial(live_range, desc=_desc, limit=limit)
+                elif _desc:
                     func = partial(
-                        rh.REDIS.zrevrangebyscore, result_key, _end, _start,
-                        start=0, num=limit, withscores=True
+                        reader.zrevrangebyscore, result_key, _end, _start,
+                        start=0 if limit is not None else None, num=limit, withscores=True
                     )
                 else:
                     func = partial(
-                        rh.REDIS.zrangebyscore, result_key, _start, _end,
-                        start=0, num=limit, withscores=True
+                        reader.zrangebyscore, result_key, _start, _end,
+                        start=0 if limit is not None else None, num=limit, withscores=True
                     )
 
-                i = 0
                 _results = []
-                for hash_id, timestamp in func():
-                    if all_fields:
-                        d = self.get(
-                            hash_id,
-                            include_meta=include_meta,
-                            timestamp_formatter=timestamp_formatter,
-                            item_format=item_format,
-                            load_ref_data=load_ref_data,
-                        )
-                        if include_meta and not item_format:
-                            d['_pos'] = i
-                    elif get_fields:
-                        d = self.get(
-                            hash_id,
-                            get_fields,
-                            include_meta=include_meta,
-                            timestamp_formatter=timestamp_formatter,
-                            item_format=item_format,
-                            load_ref_data=load_ref_data,
-                        )
-                        if include_meta and not item_format:
+                found = func()
+                if found and (all_fields or get_fields):
+                    # Fetch all items (and referenced data) in one get call
+                    _results = self.get(
+                        [ih.decode(hash_id) for hash_id, _ in found],
+                        '' if all_fields else get_fields,
+                        include_meta=include_meta,
+                        timestamp_formatter=timestamp_formatter,
+                        item_format=item_format,
+                        load_ref_data=load_ref_data,
+                    )
+                    if len(found) == 1:
+                        _results = [_results]
+                    if include_meta and not item_format:
+                        for i, d in enumerate(_results):
                             d['_pos'] = i
-                    else:
+                else:
+                    for i, (hash_id, timestamp) in enumerate(found):
                         d = {}
                         if include_meta:
                             d['_id'] = ih.decode(hash_id)
@@ -1299,8 +4950,7 @@ class Collection(object):
                             d['_pos'] = i
                         if item_format:
                             d = item_format.format(**d)
-                    _results.append(d)
-                    i += 1
+                        _results.append(d)
                 results[name] = _results
 
         if result_key_is_tmp:
@@ -1397,18 +5047,29 @@ class Collection(object):
         count_stats = []
         size_stats = []
         results = {}
-        for name, num in rh.REDIS.hgetall(self._find_stats_hash_key).items():
-            name, _type = ih.decode(name).rsplit('--', 1)
-            if _type == 'count':
-                count_stats.append((name, int(ih.decode(num))))
-            elif _type == 'last_size':
-                size_stats.append((name, int(ih.decode(num))))
+        reader = self._reader
+        if self._sketch_stats:
+            count_stats = [
+                (ih.decode(name), int(num))
+                for name, num in reader.zrange(self._find_top_zset_key, 0, limit-1, withscores=True, desc=True)
+            ]
+            size_stats = [
+                (ih.decode(name), int(num))
+                for name, num in reader.zrange(self._find_sizes_zset_key, 0, limit-1, withscores=True, desc=True)
+            ]
+        else:
+            for name, num in reader.hgetall(self._find_stats_hash_key).items():
+                name, _type = ih.decode(name).rsplit('--', 1)
+                if _type == 'count':
+                    count_stats.append((name, int(ih.decode(num))))
+                elif _type == 'last_size':
+                    size_stats.append((name, int(ih.decode(num))))
         count_stats.sort(key=lambda x: x[1], reverse=True)
         size_stats.sort(key=lambda x: x[1], reverse=True)
         results['counts'] = OrderedDict(count_stats[:limit])
         results['sizes'] = OrderedDict(size_stats[:limit])
         results['timestamps'] = OrderedDict()
-        newest = rh.zshow(self._find_searches_zset_key, end=3*(limit-1))
+        newest = reader.zrange(self._find_searches_zset_key, 0, 3*(limit-1), withscores=True, desc=True)
         for name, ts in newest:
             results['timestamps'][ih.decode(name)] = (
                 ts,
@@ -1421,60 +5082,149 @@ class Collection(object):
         """Return summary info about last size and update time of Collection items
 
         - limit: max number of ids to return
+
+        Sizes and update times are read from each collection's _ts zset and
+        _last_update key (so writes never touch the shared metadata hash).
+        Lag and throughput of ingest streams are included under 'ingest'
         """
         size_stats = []
         update_stats = []
         results = {'init_args': {}}
+        old_last_updates = {}
         for key, val in rh.REDIS.hgetall('_REDIS_HELPER_COLLECTION').items():
             base_key, _type = ih.decode(key).rsplit('--', 1)
-            if _type == 'last_size':
-                size_stats.append((base_key, int(ih.decode(val))))
+            if _type == 'last_args':
+                results['init_args'][base_key] = ih.decode(val)
             elif _type == 'last_update':
+                old_last_updates[base_key] = ih.decode(val)
+
+        base_keys = sorted(results['init_args'].keys())
+        pipe = rh.REDIS.pipeline(transaction=False)
+        for base_key in base_keys:
+            pipe.zcard('{}:_ts'.format(base_key))
+            pipe.get('{}:_last_update'.format(base_key))
+            pipe.xlen('{}:_ingest'.format(base_key))
+            pipe.hgetall('{}:_ingest_stats'.format(base_key))
+        values = pipe.execute()
+        results['ingest'] = OrderedDict()
+        for base_key, size, last_update, stream_len, ingest_stats in zip(
+            base_keys, values[::4], values[1::4], values[2::4], values[3::4]
+        ):
+            if stream_len or ingest_stats:
+                results['ingest'][base_key] = cls._ingest_info(base_key, stream_len, ingest_stats)
+            size_stats.append((base_key, size))
+            last_update = ih.decode(last_update) or old_last_updates.get(base_key)
+            if last_update:
                 update_stats.append((
                     base_key,
                     (
-                        ih.decode(val),
-                        dh.utc_float_to_pretty(ih.decode(val), fmt=dh.ADMIN_DATE_FMT, timezone=dh.ADMIN_TIMEZONE)
+                        last_update,
+                        dh.utc_float_to_pretty(last_update, fmt=dh.ADMIN_DATE_FMT, timezone=dh.ADMIN_TIMEZONE)
                     )
                 ))
-            elif _type == 'last_args':
-                results['init_args'][base_key] = ih.decode(val)
         size_stats.sort(key=lambda x: x[1], reverse=True)
         update_stats.sort(key=lambda x: x[1], reverse=True)
         results['sizes'] = OrderedDict(size_stats[:limit])
         results['timestamps'] = OrderedDict(update_stats[:limit])
         return results
 
+    @classmethod
+    def _ingest_info(cls, base_key, stream_len, ingest_stats):
+        """Return dict of lag and throughput info for an ingest stream
+
+        - base_key: base_key of the collection
+        - stream_len: number of entries in the ingest stream
+        - ingest_stats: dict from the ingest stats hash
+        """
+        ingest_stats = {ih.decode(k): ih.from_string(ih.decode(v)) for k, v in ingest_stats.items()}
+        pending = 0
+        if stream_len:
+            for group in rh.REDIS.xinfo_groups('{}:_ingest'.format(base_key)):
+                if ih.decode(group['name']) == INGEST_GROUP:
+                    pending = group['pending']
+        batch_seconds = ingest_stats.get('last_batch_seconds') or 0
+        return {
+            'length': stream_len,
+            'pending': pending,
+            'lag': stream_len - pending,
+            'indexed': ingest_stats.get('indexed', 0),
+            'errors': ingest_stats.get('errors', 0),
+            'last_batch_size': ingest_stats.get('last_batch_size', 0),
+            'last_batch_per_second': round(
+                ingest_stats.get('last_batch_size', 0) / batch_seconds, 2
+            ) if batch_seconds else None,
+        }
+
     def get_stats(self, limit=5):
         """Return summary info about ids and fields accessed by self.get
 
         - limit: max number of ids to return
+
+        If sketch_stats is True, also include estimated number of distinct ids
+        fetched per hour (for the last 24 hours). If cache_size was set, also
+        include hit/miss/eviction info for the cache
         """
         count_stats = []
         access_stats = []
         results = {}
-        for name, num in rh.REDIS.hgetall(self._get_id_stats_hash_key).items():
-            name, _type = ih.decode(name).rsplit('--', 1)
-            if _type == 'count':
-                count_stats.append((name, int(ih.decode(num))))
-            elif _type == 'last_access':
-                access_stats.append((
-                    name,
+        reader = self._reader
+        if self._buffered_stats or self._sketch_stats:
+            self.flush_get_stats()
+            count_stats = [
+                (ih.decode(name), int(num))
+                for name, num in reader.zrange(self._get_id_top_zset_key, 0, limit-1, withscores=True, desc=True)
+            ]
+            access_stats = [
+                (
+                    ih.decode(name),
                     (
-                        ih.decode(num),
-                        dh.utc_float_to_pretty(ih.decode(num), fmt=dh.ADMIN_DATE_FMT, timezone=dh.ADMIN_TIMEZONE)
+                        repr(num),
+                        dh.utc_float_to_pretty(num, fmt=dh.ADMIN_DATE_FMT, timezone=dh.ADMIN_TIMEZONE)
                     )
-                ))
+                )
+                for name, num in reader.zrange(self._get_id_last_zset_key, 0, limit-1, withscores=True, desc=True)
+            ]
+        else:
+            for name, num in reader.hgetall(self._get_id_stats_hash_key).items():
+                name, _type = ih.decode(name).rsplit('--', 1)
+                if _type == 'count':
+                    count_stats.append((name, int(ih.decode(num))))
+                elif _type == 'last_access':
+                    access_stats.append((
+                        name,
+                        (
+                            ih.decode(num),
+                            dh.utc_float_to_pretty(ih.decode(num), fmt=dh.ADMIN_DATE_FMT, timezone=dh.ADMIN_TIMEZONE)
+                        )
+                    ))
         count_stats.sort(key=lambda x: x[1], reverse=True)
         access_stats.sort(key=lambda x: x[1], reverse=True)
         results['counts'] = OrderedDict(count_stats[:limit])
         results['timestamps'] = OrderedDict(access_stats[:limit])
         field_stats = [
             (ih.decode(name), int(ih.decode(count)))
-            for name, count in rh.REDIS.hgetall(self._get_field_stats_hash_key).items()
+            for name, count in reader.hgetall(self._get_field_stats_hash_key).items()
         ]
         field_stats.sort(key=lambda x: x[1], reverse=True)
         results['fields'] = OrderedDict(field_stats)
+        if self._sketch_stats:
+            now = self.now_utc_float_string
+            bucket_keys = [
+                hll_bucket_key(
+                    self._get_id_hll_base_key,
+                    dh.utc_ago_float_string('{}:hours'.format(i), now=now)
+                )
+                for i in range(HLL_BUCKET_HOURS)
+            ]
+            pipe = reader.pipeline(transaction=False)
+            for bucket_key in bucket_keys:
+                pipe.pfcount(bucket_key)
+            results['distinct'] = OrderedDict([
+                (bucket_key.rsplit(':', 1)[-1], count)
+                for bucket_key, count in zip(bucket_keys, pipe.execute())
+            ])
+        if self._cache is not None:
+            results['cache'] = self._cache.stats
         return results
 
     def clear_find_stats(self):
@@ -1496,4 +5246,9 @@ class Collection(object):
         pipe = rh.REDIS.pipeline()
         pipe.delete(self._get_id_stats_hash_key)
         pipe.delete(self._get_field_stats_hash_key)
+        pipe.delete(self._get_id_top_zset_key)
+        pipe.delete(self._get_id_last_zset_key)
+        pipe.delete(self._get_id_cms_key)
+        for key in rh.REDIS.scan_iter('{}:*'.format(self._get_id_hll_base_key)):
+            pipe.delete(key)
         pipe.execute()
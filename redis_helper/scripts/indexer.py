@@ -0,0 +1,52 @@
+import click
+
+
+@click.command()
+@click.option(
+    '--consumer', '-c', 'consumer', default='', type=str,
+    help='name of this consumer in the "indexers" group (default hostname-pid)'
+)
+@click.option(
+    '--count', '-n', 'count', default=1000, type=int,
+    help='max number of ingested entries to add per batch (default 1000)'
+)
+@click.option(
+    '--block-ms', '-b', 'block_ms', default=5000, type=int,
+    help='max milliseconds to wait for new entries (default 5000)'
+)
+@click.option(
+    '--claim-idle-ms', 'claim_idle_ms', default=60000, type=int,
+    help='claim entries pending on other consumers this long (default 60000)'
+)
+@click.option(
+    '--max-deliveries', 'max_deliveries', default=5, type=int,
+    help='move entries delivered this many times to the errors list (default 5)'
+)
+@click.option(
+    '--quiet', '-q', 'quiet', is_flag=True, default=False,
+    help='Do not print the number of entries indexed per batch'
+)
+@click.argument('base_key', nargs=1)
+def main(consumer, count, block_ms, claim_idle_ms, max_deliveries, quiet, base_key):
+    """Add data from the ingest stream of a Collection (by base_key)"""
+    import redis_helper as rh
+
+    if rh.REDIS is None:
+        connected, _ = rh.connect_to_server()
+        if not connected:
+            raise Exception('Unable to connect to {}'.format(rh.REDIS_URL))
+    coll = rh.Collection.get_model(base_key)
+    if coll is None:
+        raise Exception('No Collection found for {}'.format(repr(base_key)))
+    coll.run_indexer(
+        consumer=consumer,
+        count=count,
+        block_ms=block_ms,
+        claim_idle_ms=claim_idle_ms,
+        max_deliveries=max_deliveries,
+        show=not quiet
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -11,19 +11,23 @@ class Notes(rh.Collection):
     def add_parsed(self, parsed_text, topic):
         """Modify parsed_text and add using 'self.add'
 
-        For now, the first #tag and @mention will also be separate attributes
+        Every #tag and @mention is indexed (as multi_index_fields 'tag' and
+        'mention'), and the words of the note are indexed (as text_fields 'text')
         """
         if 'tag_list' in parsed_text:
-            parsed_text['tag'] = parsed_text['tag_list'][0]
+            parsed_text['tag'] = parsed_text['tag_list']
         if 'mention_list' in parsed_text:
-            parsed_text['mention'] = parsed_text['mention_list'][0]
+            parsed_text['mention'] = parsed_text['mention_list']
         self.add(topic=topic, **parsed_text)
 
 
 notes = Notes(
     'input',
     'note',
-    index_fields='topic,tag,mention',
+    index_fields='topic',
+    multi_index_fields='tag,mention',
+    text_fields='text',
+    text_stemming=True,
     insert_ts=True
 )
 
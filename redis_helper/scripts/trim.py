@@ -0,0 +1,59 @@
+import click
+
+
+@click.command()
+@click.option(
+    '--chunk-size', '-n', 'chunk_size', default=500, type=int,
+    help='number of items to delete per chunk (default 500)'
+)
+@click.option(
+    '--max-busy-ratio', '-r', 'max_busy_ratio', default=0.5, type=float,
+    help='max fraction of time spent deleting (default 0.5)'
+)
+@click.option(
+    '--interval', '-i', 'interval', default=0, type=int,
+    help='if greater than 0, trim again every this many seconds until interrupted'
+)
+@click.option(
+    '--quiet', '-q', 'quiet', is_flag=True, default=False,
+    help='Do not print the number of items deleted per collection'
+)
+@click.argument('base_keys', nargs=-1)
+def main(chunk_size, max_busy_ratio, interval, quiet, base_keys):
+    """Delete items beyond max_items/max_age from Collections (by base_key)
+
+    If no base_keys are given, trim all Collections with max_items or max_age
+    """
+    from time import sleep
+    import redis_helper as rh
+
+    if rh.REDIS is None:
+        connected, _ = rh.connect_to_server()
+        if not connected:
+            raise Exception('Unable to connect to {}'.format(rh.REDIS_URL))
+    if not base_keys:
+        base_keys = sorted(rh.Collection.init_stats()['init_args'].keys())
+    colls = []
+    for base_key in base_keys:
+        coll = rh.Collection.get_model(base_key)
+        if coll is None:
+            raise Exception('No Collection found for {}'.format(repr(base_key)))
+        if coll.has_retention:
+            colls.append(coll)
+    while True:
+        for coll in colls:
+            report = coll.trim(chunk_size=chunk_size, max_busy_ratio=max_busy_ratio)
+            if not quiet:
+                print('{}: deleted {} in {}s'.format(
+                    coll._base_key, report['deleted'], report['seconds']
+                ))
+        if interval <= 0:
+            break
+        try:
+            sleep(interval)
+        except KeyboardInterrupt:
+            break
+
+
+if __name__ == '__main__':
+    main()
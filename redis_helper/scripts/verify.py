@@ -0,0 +1,60 @@
+import click
+
+
+@click.command()
+@click.option(
+    '--repair', '-r', 'repair', is_flag=True, default=False,
+    help='Fix the discrepancies that can be fixed'
+)
+@click.option(
+    '--batch-size', '-n', 'batch_size', default=500, type=int,
+    help='number of members/keys to check per batch (default 500)'
+)
+@click.option(
+    '--max-busy-ratio', '-b', 'max_busy_ratio', default=1.0, type=float,
+    help='max fraction of time spent checking, i.e. 0.2 for a busy instance (default 1.0)'
+)
+@click.option(
+    '--examples', '-e', 'examples', default=10, type=int,
+    help='max number of examples to show per issue (default 10)'
+)
+@click.option(
+    '--workers', '-w', 'workers', default=0, type=int,
+    help='number of worker processes to check hashes with (default 0)'
+)
+@click.argument('base_keys', nargs=-1)
+def main(repair, batch_size, max_busy_ratio, examples, workers, base_keys):
+    """Check (and repair) the indexes of Collections (by base_key)
+
+    If no base_keys are given, check all Collections
+    """
+    import redis_helper as rh
+
+    if rh.REDIS is None:
+        connected, _ = rh.connect_to_server()
+        if not connected:
+            raise Exception('Unable to connect to {}'.format(rh.REDIS_URL))
+    if not base_keys:
+        base_keys = sorted(rh.Collection.init_stats()['init_args'].keys())
+    for base_key in base_keys:
+        coll = rh.Collection.get_model(base_key)
+        if coll is None:
+            raise Exception('No Collection found for {}'.format(repr(base_key)))
+        report = coll.verify(
+            repair=repair,
+            batch_size=batch_size,
+            max_busy_ratio=max_busy_ratio,
+            examples=examples,
+            workers=workers
+        )
+        print('{}: checked {} in {}s'.format(
+            base_key, sum(report['checked'].values()), report['seconds']
+        ))
+        for issue, count in sorted(report['issues'].items()):
+            print('    {}: {} (i.e. {})'.format(
+                issue, count, ', '.join(report['examples'][issue])
+            ))
+
+
+if __name__ == '__main__':
+    main()
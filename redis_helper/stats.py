@@ -0,0 +1,158 @@
+import atexit
+import hashlib
+import threading
+import redis_helper as rh
+from collections import Counter
+from time import sleep
+
+
+CMS_WIDTH = 2048
+CMS_DEPTH = 4
+HLL_BUCKET_HOURS = 24
+HLL_BUCKET_TTL = 8 * 24 * 3600
+
+# Increment items in a count-min sketch (a BITFIELD of u32 counters) and set
+# their estimated counts in a top-k sorted set that is trimmed to k members
+#
+# KEYS[1]: count-min sketch key, KEYS[2]: top-k sorted set key
+# ARGV: k, depth, then (item, increment, offset_1, ... offset_depth) per item
+_CMS_TOPK_LUA = """
+local k = tonumber(ARGV[1])
+local depth = tonumber(ARGV[2])
+local i = 3
+while i <= #ARGV do
+    local args = {'OVERFLOW', 'SAT'}
+    for d = 1, depth do
+        table.insert(args, 'INCRBY')
+        table.insert(args, 'u32')
+        table.insert(args, '#' .. ARGV[i + 1 + d])
+        table.insert(args, ARGV[i + 1])
+    end
+    local counts = redis.call('BITFIELD', KEYS[1], unpack(args))
+    local estimate = counts[1]
+    for d = 2, depth do
+        if counts[d] < estimate then
+            estimate = counts[d]
+        end
+    end
+    redis.call('ZADD', KEYS[2], estimate, ARGV[i])
+    i = i + 2 + depth
+end
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -(k + 1))
+return #ARGV
+"""
+_cms_topk_script = None
+
+
+def cms_offsets(item, width=CMS_WIDTH, depth=CMS_DEPTH):
+    """Return list of counter offsets for item (one per row of the sketch)
+
+    Each row uses its own 4 byte slice of one blake2b digest, so collisions
+    in one row are independent of collisions in the others
+    """
+    item = item if type(item) == bytes else str(item).encode('utf-8')
+    digest = hashlib.blake2b(item, digest_size=4 * depth).digest()
+    return [
+        row * width + int.from_bytes(digest[4 * row:4 * row + 4], 'little') % width
+        for row in range(depth)
+    ]
+
+
+def queue_cms_topk(pipe, cms_key, topk_key, counts, k):
+    """Add a count-min sketch + top-k update for the counts dict to pipe
+
+    - pipe: a redis pipeline object
+    - cms_key: name of the key holding the count-min sketch
+    - topk_key: name of the sorted set holding (at most) k items with the
+      highest estimated counts
+    - counts: dict of items and the amount to increment them by
+    - k: number of items to keep in topk_key
+    """
+    global _cms_topk_script
+    if not counts:
+        return
+    if _cms_topk_script is None:
+        _cms_topk_script = rh.REDIS.register_script(_CMS_TOPK_LUA)
+    args = [k, CMS_DEPTH]
+    for item, count in counts.items():
+        args.extend([item, int(count)])
+        args.extend(cms_offsets(item))
+    _cms_topk_script(keys=[cms_key, topk_key], args=args, client=pipe)
+
+
+def hll_bucket_key(base_key, utc_float):
+    """Return name of the HyperLogLog key for the hour of utc_float
+
+    - utc_float: a float (or float string) with form YYYYMMDDHHMMSS.f
+    """
+    return '{}:{}'.format(base_key, str(utc_float)[:10])
+
+
+class StatsBuffer(object):
+    """Aggregate get-stats counters in memory and flush them in batches
+
+    Counters are merged in process memory and passed to 'flush_func' from a
+    background thread every 'flush_interval' seconds (or sooner, from the
+    calling thread, once 'flush_size' distinct ids/fields are waiting)
+    """
+    def __init__(self, flush_func, flush_interval=5, flush_size=1000):
+        """
+        - flush_func: callable that accepts (id_counts, last_access, field_counts)
+        - flush_interval: max number of seconds between flushes
+        - flush_size: number of distinct ids and fields to buffer before
+          flushing immediately
+        """
+        self._flush_func = flush_func
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        self._lock = threading.Lock()
+        self._thread = None
+        self.id_counts = Counter()
+        self.last_access = {}
+        self.field_counts = Counter()
+        atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self.id_counts) + len(self.field_counts)
+
+    def _run(self):
+        while True:
+            sleep(self._flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                rh.logger.error('Unable to flush get stats: {}'.format(repr(e)))
+
+    def record(self, hash_ids, field_counts, now, weight=1):
+        """Add counts for hash_ids (accessed at time now) and field_counts
+
+        - weight: amount to increment each count by (i.e. 1/sample_rate)
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        with self._lock:
+            for hash_id in hash_ids:
+                self.id_counts[hash_id] += weight
+                self.last_access[hash_id] = now
+            for field, count in field_counts.items():
+                self.field_counts[field] += count * weight
+            full = len(self) >= self._flush_size
+        if full:
+            self.flush()
+
+    def discard(self, hash_id):
+        """Remove any buffered counts for hash_id (i.e. when it is deleted)"""
+        with self._lock:
+            self.id_counts.pop(hash_id, None)
+            self.last_access.pop(hash_id, None)
+
+    def flush(self):
+        """Pass all buffered counters to flush_func and reset them"""
+        with self._lock:
+            if len(self) == 0:
+                return
+            id_counts, self.id_counts = self.id_counts, Counter()
+            last_access, self.last_access = self.last_access, {}
+            field_counts, self.field_counts = self.field_counts, Counter()
+        self._flush_func(id_counts, last_access, field_counts)
@@ -0,0 +1,55 @@
+import re
+from collections import OrderedDict
+
+
+TOKEN_RX = re.compile(r'\w+')
+ENGLISH_STOP_WORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from',
+    'has', 'have', 'he', 'her', 'his', 'i', 'if', 'in', 'into', 'is', 'it',
+    'its', 'me', 'my', 'no', 'not', 'of', 'on', 'or', 'our', 'she', 'so',
+    'such', 'that', 'the', 'their', 'them', 'then', 'there', 'these', 'they',
+    'this', 'to', 'was', 'we', 'were', 'will', 'with', 'you', 'your',
+}
+_SUFFIXES = ('ingly', 'edly', 'ings', 'ing', 'ed', 'ly')
+
+
+def stem(word):
+    """Return word with a common English inflection removed
+
+    A light suffix stripper (i.e. 'errors', 'erroring', and 'errored' all
+    become 'error', while 'refuse' and 'refused' both become 'refus'); words
+    shorter than 4 characters or with digits are returned as is
+    """
+    if len(word) < 4 or not word.isalpha():
+        return word
+    if word.endswith(('ies', 'ied')) and len(word) > 4:
+        return word[:-3] + 'y'
+    if word.endswith('bly'):
+        word = word[:-1] + 'e'
+    else:
+        for suffix in _SUFFIXES:
+            if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+                word = word[:-len(suffix)]
+                if word[-1] == word[-2] and word[-1] not in 'aeioulsz':
+                    word = word[:-1]
+                return word
+        if word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+            word = word[:-1]
+    if word.endswith('e') and len(word) > 3:
+        word = word[:-1]
+    return word
+
+
+def tokenize(text, stemming=False, stop_words=None):
+    """Return list of the distinct tokens in text (in order of first appearance)
+
+    - text: string to split into words (lowercased)
+    - stemming: if True, pass each word through stem
+    - stop_words: set of (lowercase) words to skip
+    """
+    tokens = []
+    for word in TOKEN_RX.findall(str(text).lower()):
+        if stop_words and word in stop_words:
+            continue
+        tokens.append(stem(word) if stemming else word)
+    return list(OrderedDict.fromkeys(tokens))
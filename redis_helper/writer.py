@@ -0,0 +1,184 @@
+import queue
+import threading
+import redis_helper as rh
+from time import time
+
+
+_STOP = object()
+
+
+class BufferedWriter(object):
+    """Queue adds/updates for a Collection and write them in pipelined batches
+
+    Batches are written from a background thread once 'max_items' are queued
+    or 'max_latency_ms' has passed since the first item of the batch was
+    queued. Calls to 'add'/'update' block when 'max_queue_size' items are
+    waiting (backpressure)
+    """
+    def __init__(self, collection, max_items=1000, max_latency_ms=100,
+                 max_queue_size=10000, put_timeout=None, on_error=None,
+                 change_history=True):
+        """
+        - collection: a Collection instance
+        - max_items: max number of queued adds/updates to write per batch
+        - max_latency_ms: max number of milliseconds a queued add/update will
+          wait before its batch is written
+        - max_queue_size: max number of adds/updates that can be queued
+        - put_timeout: max number of seconds to block when the queue is full
+          before raising queue.Full (None to wait forever)
+        - on_error: callable accepting (record, exception) for records that
+          fail validation/uniqueness (or can't be written)
+        - change_history: passed to collection.update_many for queued updates
+        """
+        self._collection = collection
+        self._max_items = max_items
+        self._max_latency = max_latency_ms / 1000
+        self._put_timeout = put_timeout
+        self._on_error = on_error
+        self._change_history = change_history
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._closed = False
+        self.flushes = 0
+        self.written = 0
+        self.errors = 0
+        self.last_flush_seconds = 0
+        self.max_flush_seconds = 0
+        self.total_flush_seconds = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _put(self, item):
+        assert not self._closed, 'BufferedWriter is closed'
+        self._queue.put(item, timeout=self._put_timeout)
+
+    def add(self, **data):
+        """Queue data to be added to the collection"""
+        self._put(('add', None, data))
+
+    def update(self, hash_id, **data):
+        """Queue data to update at hash_id"""
+        self._put(('update', hash_id, data))
+
+    def _handle_error(self, record, exception):
+        self.errors += 1
+        if self._on_error is not None:
+            self._on_error(record, exception)
+        else:
+            rh.logger.error('Unable to write {}: {}'.format(repr(record), repr(exception)))
+
+    def _write(self, batch):
+        """Write a batch of queued items, grouping consecutive adds/updates"""
+        start = time()
+        groups = []
+        for action, hash_id, data in batch:
+            if not groups or groups[-1][0] != action:
+                groups.append((action, []))
+            groups[-1][1].append((hash_id, data))
+
+        for action, items in groups:
+            try:
+                if action == 'add':
+                    keys = self._collection.add_many(
+                        *[data for _, data in items],
+                        on_error=self._handle_error
+                    )
+                    self.written += len([key for key in keys if key is not None])
+                else:
+                    updates = {}
+                    for hash_id, data in items:
+                        updates.setdefault(hash_id, {}).update(data)
+                    results = self._collection.update_many(
+                        updates,
+                        change_history=self._change_history,
+                        on_error=self._handle_error
+                    )
+                    self.written += len([
+                        changes for changes in results.values()
+                        if changes is not None
+                    ])
+            except Exception as e:
+                for hash_id, data in items:
+                    record = data if hash_id is None else dict(data, _id=hash_id)
+                    self._handle_error(record, e)
+
+        elapsed = time() - start
+        self.flushes += 1
+        self.last_flush_seconds = elapsed
+        self.total_flush_seconds += elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                break
+            batch = [item]
+            deadline = time() + self._max_latency
+            while len(batch) < self._max_items:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+            self._write(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self):
+        """Block until everything queued so far has been written
+
+        If the background thread has died (i.e. an on_error callback raised),
+        return without waiting on the queue
+        """
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks and self._thread.is_alive():
+                self._queue.all_tasks_done.wait(0.1)
+
+    def close(self):
+        """Write everything that is queued and stop the background thread
+
+        If the background thread has died (i.e. an on_error callback raised),
+        return without waiting on the queue
+        """
+        if self._closed:
+            return
+        self._closed = True
+        while self._thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=0.1)
+            except queue.Full:
+                continue
+            self._thread.join()
+
+    @property
+    def queue_depth(self):
+        """Return the number of adds/updates waiting to be written"""
+        return self._queue.qsize()
+
+    @property
+    def metrics(self):
+        """Return a dict of queue depth, counts, and flush latency info"""
+        return {
+            'queue_depth': self.queue_depth,
+            'flushes': self.flushes,
+            'written': self.written,
+            'errors': self.errors,
+            'last_flush_ms': round(self.last_flush_seconds * 1000, 3),
+            'max_flush_ms': round(self.max_flush_seconds * 1000, 3),
+            'avg_flush_ms': round(self.total_flush_seconds * 1000 / self.flushes, 3) if self.flushes else 0.0,
+        }
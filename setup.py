@@ -34,6 +34,9 @@ setup(
             'rh-shell=redis_helper.scripts.shell:main',
             'rh-collection-reports=redis_helper.scripts.collection_reports:main',
             'rh-clear-all-locks=redis_helper.scripts.clear_locks:main',
+            'rh-indexer=redis_helper.scripts.indexer:main',
+            'rh-trim=redis_helper.scripts.trim:main',
+            'rh-verify=redis_helper.scripts.verify:main',
         ],
     },
     classifiers=[
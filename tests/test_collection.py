@@ -1,5 +1,7 @@
 import random
+import threading
 import pytest
+from time import sleep
 import redis_helper as rh
 
 
@@ -124,6 +126,487 @@ class TestCollection:
         assert thing == 'first'
         assert thing_with_ref_data == first_from_coll5
 
+    def test_get_many_by_unique_values(self, coll5, coll6):
+        found = coll5.get_many_by_unique_values(['second', 'missing', 'first'], 'name')
+        assert list(found.items()) == [
+            ('second', {'name': 'second'}), ('missing', None), ('first', {'name': 'first'})
+        ]
+        hash_id = coll6.add(thing='missing', z=1)
+        assert coll6.get(hash_id, 'thing', load_ref_data=True) == {'thing': 'missing'}
+
+    def test_find_with_ref_data(self, coll5, coll6):
+        coll6.add(thing='second', z=200)
+        coll6.add(thing='first', z=300)
+        found = coll6.find(get_fields='thing,z', load_ref_data=True)
+        things = {d['z']: d['thing'] for d in found}
+        assert things[100] == coll5['first']
+        assert things[200]['name'] == 'second'
+        assert things[300]['_id'] == things[100]['_id']
+        assert things[1] == 'missing'
+
+    def test_find_with_get_fields(self, coll6):
+        found = coll6.find(get_fields='z', limit=2)
+        assert [set(d) for d in found] == [{'z', '_id', '_ts', '_pos'}] * 2
+        assert coll6.get_stats()['counts'][found[0]['_id']] >= 1
+        assert coll6.find(item_format='{z}', limit=1)[0].isdigit()
+
+    def test_read_from_replicas_without_replicas(self):
+        coll = rh.Collection('test', 'coll1', read_from_replicas=True, read_your_writes=True)
+        assert coll._reader is rh.REDIS
+        data = generate_coll1_data()
+        hash_id = coll.add(**data)
+        assert coll.get(hash_id) == data
+
+    def test_read_from_replicas_with_replica(self, coll3):
+        # A second connection to the same server stands in for a replica
+        replica = rh.StrictRedis.from_url(rh.REDIS_URL)
+        rh.REPLICAS = [replica]
+        try:
+            coll = rh.Collection('test', 'coll3', index_fields='a', json_fields='data',
+                                 read_from_replicas=True, read_your_writes=True,
+                                 read_your_writes_timeout=10)
+            assert coll._reader is replica
+            data = generate_coll23_data()
+            hash_id = coll.add(**data)
+
+            # Nothing acknowledges the WAIT, so reads fall back to rh.REDIS
+            assert coll._reader is rh.REDIS
+            assert int(rh.REDIS.get('test:coll3:_wait')) == 1
+            assert coll.get(hash_id) == data
+            assert hash_id in coll.find('a:{}'.format(data['a']), item_format='{_id}')
+
+            no_wait = rh.Collection('test', 'coll3', index_fields='a', json_fields='data',
+                                    read_from_replicas=True)
+            no_wait.update(hash_id, b=1)
+            assert no_wait._reader is replica
+            assert hash_id in no_wait.find('a:{}'.format(data['a']), item_format='{_id}')
+            assert no_wait.random('a:{}'.format(data['a'])) != {}
+        finally:
+            rh.REPLICAS = []
+
+    def test_cached_get_is_invalidated_by_update(self, coll5):
+        cached = rh.Collection('test', 'coll5', unique_field='name', index_fields='status', cache_size=10)
+        data = cached.get_by_unique_value('first')
+        assert cached.get_by_unique_value('first') == data
+        assert cached.get_stats()['cache']['hits'] == 2
+        cached.update(cached.get_hash_id_for_unique_value('first'), x=7)
+        assert cached.get_by_unique_value('first')['x'] == 7
+
+    def test_buffered_get_stats(self, coll1):
+        buffered = rh.Collection('test', 'coll1', buffered_stats=True, stats_top_k=2)
+        hash_ids = buffered.find(item_format='{_id}', limit=3)
+        for hash_id in hash_ids:
+            buffered.get(hash_id)
+        buffered.get(hash_ids[0])
+        stats = buffered.get_stats()
+        assert list(stats['counts'].items())[0] == (hash_ids[0], 2)
+        assert len(stats['counts']) == 2
+        assert rh.REDIS.zcard('test:coll1:_get_id_top') == 2
+
+    def test_delete_discards_buffered_stats(self, coll3):
+        buffered = rh.Collection('test', 'coll3', index_fields='a', json_fields='data',
+                                 buffered_stats=True)
+        hash_id = buffered.add(**generate_coll23_data())
+        buffered.get(hash_id)
+        buffered.delete(hash_id)
+        assert hash_id not in buffered.get_stats()['counts']
+
+    def test_sketch_stats(self, coll1):
+        sketched = rh.Collection('test', 'coll1', sketch_stats=True, stats_top_k=2)
+        hash_ids = sketched.find(item_format='{_id}', limit=3)
+        for hash_id in hash_ids:
+            sketched.get(hash_id)
+        sketched.get(hash_ids[0])
+        stats = sketched.get_stats()
+        assert list(stats['counts'].items())[0] == (hash_ids[0], 2)
+        assert len(stats['counts']) == 2
+        assert list(stats['distinct'].values())[0] == 3
+
+    def test_cms_rows_are_independent(self):
+        offsets = [rh.stats.cms_offsets('test:coll1:{}'.format(i)) for i in range(10000, 12000)]
+        first_row = {}
+        for row_offsets in offsets:
+            first_row.setdefault(row_offsets[0], []).append(row_offsets)
+        collisions = [group for group in first_row.values() if len(group) > 1]
+        assert collisions
+        assert not all(len({o[1] for o in group}) == 1 for group in collisions)
+
+    def test_add_many_with_errors(self, coll5):
+        errors = []
+        keys = coll5.add_many(
+            {'name': 'third', 'status': 'ok'},
+            {'name': 'first', 'status': 'ok'},
+            {'name': 'third', 'status': 'dup'},
+            {'status': 'no name'},
+            on_error=lambda record, e: errors.append(record),
+        )
+        assert keys[0] is not None and keys[1:] == [None, None, None]
+        assert len(errors) == 3
+        assert coll5.get(keys[0], 'name') == {'name': 'third'}
+        with pytest.raises(AssertionError):
+            coll5.add_many({'name': 'fourth'}, {'name': 'first'})
+        assert coll5.get_hash_id_for_unique_value('fourth') is None
+
+    def test_buffered_writer(self, coll1):
+        size = coll1.size
+        with coll1.buffered_writer(max_items=10, max_latency_ms=10) as writer:
+            for _ in range(25):
+                writer.add(**generate_coll1_data())
+        assert writer.metrics['written'] == 25
+        assert writer.metrics['queue_depth'] == 0
+        assert coll1.size == size + 25
+
+    def test_buffered_writer_errors(self, coll5):
+        hash_id = coll5.get_hash_id_for_unique_value('first')
+        other_id = coll5.get_hash_id_for_unique_value('second')
+        rejected = []
+        writer = coll5.buffered_writer(
+            max_items=10, max_latency_ms=10,
+            on_error=lambda record, e: rejected.append(record)
+        )
+        writer.update(hash_id, x=8)
+        writer.update(other_id, name='changed')
+        writer.close()
+        assert writer.metrics['written'] == 1
+        assert writer.metrics['errors'] == 1
+        assert rejected == [{'name': 'changed', '_id': other_id}]
+
+        def raise_error(record, e):
+            raise e
+
+        writer = coll5.buffered_writer(max_queue_size=1, on_error=raise_error)
+        writer.update(hash_id, name='changed')
+        writer._thread.join(5)
+        writer.update(hash_id, x=9)
+        writer.flush()
+        assert writer.metrics['queue_depth'] == 1
+        writer.close()
+        assert not writer._thread.is_alive()
+
+    def test_ingest(self, coll1):
+        size = coll1.size
+        coll1.ingest_many(*[generate_coll1_data() for _ in range(5)])
+        data = generate_coll1_data()
+        entry_id = coll1.ingest(**data)
+        fields = rh.REDIS.xrange('test:coll1:_ingest', entry_id, entry_id)[0][1]
+        assert fields == {k.encode(): str(v).encode() for k, v in data.items()}
+        assert coll1.index_ingested(consumer='test', block_ms=10) == 6
+        assert coll1.index_ingested(consumer='test', block_ms=10) == 0
+        assert coll1.size == size + 6
+
+        # Delivered to 'test' but never acknowledged (the indexer crashed)
+        coll1.ingest(**generate_coll1_data())
+        rh.REDIS.xreadgroup('indexers', 'test', {'test:coll1:_ingest': '>'}, count=10)
+        assert coll1.index_ingested(consumer='test', block_ms=10) == 1
+        assert coll1.size == size + 7
+        ingest_info = rh.Collection.init_stats()['ingest'][coll1._base_key]
+        assert ingest_info['indexed'] == 7
+        assert ingest_info['lag'] == 0
+
+    def test_changes(self):
+        coll = rh.Collection('test', 'coll1', changelog_maxlen=100)
+        last = list(coll.changes())
+        since_id = last[-1]['_stream_id'] if last else '0'
+        hash_id = coll.add(**generate_coll1_data())
+        coll.update(hash_id, x=10)
+        coll.delete(hash_id)
+        events = list(coll.changes(since_id=since_id))
+        assert [e['op'] for e in events] == ['add', 'update', 'delete']
+        assert set(e['_id'] for e in events) == {hash_id}
+        assert events[0]['fields'] == ['x', 'y', 'z']
+        assert events[1]['fields'] == ['x']
+
+    def test_watch(self):
+        coll = rh.Collection('test', 'coll5', unique_field='name', index_fields='status',
+                             changelog_maxlen=100)
+        last = list(coll.changes())
+        since_id = last[-1]['_stream_id'] if last else '0'
+        coll.add(name='watched1', status='ok')
+        hash_id = coll.add(name='watched2', status='bad')
+        coll.update(hash_id, x=1)
+        coll.update(hash_id, status='ok')
+        watcher = coll.watch('status:ok', 'name', since_id=since_id, block=10)
+        assert [next(watcher)['name'] for _ in range(2)] == ['watched1', 'watched2']
+
+    def test_get_as_of_and_history(self, coll1):
+        data = {'x': 1, 'y': 100, 'z': 10000}
+        hash_id = coll1.add(**data)
+        sleep(0.01)
+        ts0 = coll1.now_utc_float
+        coll1.update(hash_id, x=2, w='new')
+        sleep(0.01)
+        ts1 = coll1.now_utc_float
+        coll1.update(hash_id, x=3)
+        assert coll1.get(hash_id, as_of=ts0) == data
+        assert coll1.get(hash_id, as_of=ts1) == dict(data, x=2, w='new')
+        assert coll1.get(hash_id, 'x', as_of=coll1.now_utc_float) == {'x': 3}
+        changes = coll1.history(start=ts0)[hash_id]
+        assert [change['old'] for change in changes] == [{'x': 1, 'w': None}, {'x': 2}]
+        assert len(coll1.old_data_for_hash_id(hash_id)) == 3
+
+    def test_incr(self, coll5):
+        hash_id = coll5.get_hash_id_for_unique_value('second')
+        assert coll5.incr(hash_id, 'x', 5) == 15
+        assert coll5.incr_by_unique_value('second', 'x', -3) == 12
+        assert coll5.incr_float(hash_id, 'y', 0.5) == 100.5
+        assert coll5.get(hash_id, 'x,y') == {'x': 12, 'y': 100.5}
+        assert coll5.incr_by_unique_value('nope', 'x') is None
+        counter = rh.Collection('test', 'coll5', unique_field='name', index_fields='status, visits')
+        assert counter.incr(hash_id, 'visits', change_history=True) == 1
+        assert counter.find('visits:1', item_format='{_id}') == [hash_id]
+        big = 10**15
+        assert counter.incr(hash_id, 'visits', big) == big + 1
+        assert counter.find('visits:{}'.format(big + 1), item_format='{_id}') == [hash_id]
+        counter._lock()
+        try:
+            thread = threading.Thread(target=counter.incr, args=(hash_id, 'visits', -big))
+            thread.start()
+            sleep(0.2)
+            assert counter.get(hash_id, 'visits') == {'visits': big + 1}
+        finally:
+            counter._unlock()
+        thread.join()
+        assert counter.get(hash_id, 'visits') == {'visits': 1}
+
+    def test_upsert(self, coll5):
+        hash_id = coll5.get_hash_id_for_unique_value('second')
+        results = coll5.upsert_many(
+            {'name': 'second', 'x': 12, 'status': 'ok'},
+            {'name': 'fifth', 'x': 1, 'status': 'new'},
+            {'name': 'second', 'x': 20, 'status': 'done'},
+        )
+        new_id = results[1][0]
+        assert results == [(hash_id, 'unchanged'), (new_id, 'inserted'), (hash_id, 'updated')]
+        assert coll5.get(hash_id, 'x,status') == {'x': 20, 'status': 'done'}
+        assert coll5.find('status:done', item_format='{_id}') == [hash_id]
+        assert coll5.upsert(name='fifth', x=2) == (new_id, 'updated')
+        assert coll5.old_data_for_unique_value('fifth')[0]['value'] == '1'
+        rh.REDIS.zrem('test:coll5:_ts', new_id)
+        assert coll5.upsert(name='fifth', x=3) == (new_id, 'updated')
+        history = rh.REDIS.xrange(new_id + ':_history')
+        assert float(history[-1][1][b'_ts']) == float(history[-1][1][b'_new_ts'])
+        assert isinstance(coll5.get(new_id, as_of=float(history[-1][1][b'_new_ts']) - 0.001), dict)
+
+        coded = rh.Collection('test', 'coll5', unique_field='name', index_fields='status',
+                              multi_index_fields='codes')
+        coded_id = coded.add(name='coded', codes=[1.0, 2])
+        assert coded.find('codes:1', item_format='{_id}') == [coded_id]
+        assert coded.upsert_many({'name': 'coded', 'codes': [2, 3.0]}) == [(coded_id, 'updated')]
+        assert rh.REDIS.scard('test:coll5:codes:1') == 0
+        assert coded.find('codes:3', item_format='{_id}') == [coded_id]
+
+        coded._lock()
+        try:
+            thread = threading.Thread(target=coded.upsert, kwargs={'name': 'coded', 'codes': [4]})
+            thread.start()
+            sleep(0.2)
+            assert coded.get(coded_id, 'codes') == {'codes': [2, 3.0]}
+        finally:
+            coded._unlock()
+        thread.join()
+        assert coded.get(coded_id, 'codes') == {'codes': [4]}
+        coded.delete(coded_id)
+
+    def test_find_through_reference(self, coll5):
+        joined = rh.Collection('test', 'coll6', reference_fields='thing--test:coll5', index_fields='z, thing')
+        joined.reindex()
+        assert set(joined.find('thing.status:ok', item_format='{z}')) == {'100', '300'}
+        ok_names = {d['name'] for d in coll5.find('status:ok', get_fields='name', limit=None)}
+        expected = {
+            d['_id'] for d in joined.find(get_fields='thing', limit=None)
+            if d.get('thing') in ok_names
+        }
+        assert set(joined.find('thing.status:ok', item_format='{_id}', limit=None)) == expected
+        size = joined._semi_join('test:coll6:_semi', 'thing.status', ['thing.status:ok'], batch_size=1)
+        assert size == len(expected)
+        assert {m.decode() for m in rh.REDIS.smembers('test:coll6:_semi')} == expected
+        rh.REDIS.delete('test:coll6:_semi')
+        assert joined.find('thing.status:ok, thing.status:done', count=True) == 3
+        assert joined.find('thing.status:ok, z:100', count=True) == 1
+        plan = joined.explain('thing.status:ok, z:100')
+        assert [step['op'] for step in plan['steps']] == ['set', 'semi-join']
+        assert plan['max_results'] == 1
+
+    def test_reindex_online(self, coll5):
+        statuses = coll5.top_values_for_index('status', 10)
+        hash_id = coll5.get_hash_id_for_unique_value('second')
+        with_x = rh.Collection('test', 'coll5', unique_field='name', index_fields='status, x')
+        status = with_x.reindex_online('x', max_seconds=0)
+        assert status['fields'] == ['x'] and status['done'] == 0
+        coll5.update(hash_id, x=777)
+        reports = []
+        assert with_x.reindex_online('x', batch_size=2, progress=reports.append) is None
+        assert reports[-1]['done'] >= coll5.size
+        assert with_x.reindex_status() is None
+        assert with_x.find('x:777', item_format='{_id}') == [hash_id]
+        assert sum(count for _, count in with_x.top_values_for_index('x', 100)) == coll5.size
+        assert with_x.top_values_for_index('status', 10) == statuses
+
+    def test_reindex_with_prefixed_index_field(self, coll3):
+        both = rh.Collection('test', 'coll3', index_fields='a, ab', json_fields='data')
+        hash_id = both.add(**dict(generate_coll23_data(), ab='yes'))
+        coll3.reindex()
+        assert both.find('ab:yes', item_format='{_id}') == [hash_id]
+        assert coll3.find('a:{}'.format(both.get(hash_id, 'a')['a']), count=True) >= 1
+
+    def test_parallel_reindex_and_export(self, coll5, tmpdir):
+        statuses = sorted(item for item in coll5.top_values_for_index('status', 10) if item[1])
+        report = coll5.reindex(workers=2, chunk_size=2)
+        assert report['items'] == coll5.size
+        assert sum(worker['items'] for worker in report['workers'].values()) == coll5.size
+        assert sorted(coll5.top_values_for_index('status', 10)) == statuses
+        report = coll5.verify(workers=2, chunk_size=2)
+        assert report['issues'] == {}
+        assert report['checked']['ts'] == coll5.size
+        assert coll5.verify(repair=True, workers=2, chunk_size=2)['issues'] == {}
+        assert coll5.is_locked is False
+        path = str(tmpdir.join('coll5.jsonl'))
+        assert coll5.export(path, 'name', workers=2, chunk_size=2)['items'] == coll5.size
+        with open(path) as fp:
+            assert len(fp.readlines()) == coll5.size
+
+    def test_verify(self, coll5):
+        assert coll5.verify()['issues'] == {}
+        hash_id = coll5.get_hash_id_for_unique_value('second')
+        status = coll5.get(hash_id, 'status')['status']
+        rh.REDIS.srem('test:coll5:status:{}'.format(status), hash_id)
+        rh.REDIS.zincrby('test:coll5:status', 5, status)
+        rh.REDIS.sadd('test:coll5:status:gone', 'test:coll5:999')
+        report = coll5.verify(repair=True, batch_size=2)
+        assert report['issues'] == {'index_missing': 1, 'index_stale': 1, 'count_drift': 1}
+        assert coll5.verify()['issues'] == {}
+        assert coll5.find('status:{}'.format(status), item_format='{_id}').count(hash_id) == 1
+        padded_id = coll5.add(name='padded', status='1.50')
+        rh.REDIS.srem('test:coll5:status:1.50', padded_id)
+        assert coll5.verify(repair=True)['issues'] == {'index_missing': 1}
+        assert coll5.find('status:1.50', item_format='{_id}') == [padded_id]
+        assert rh.REDIS.scard('test:coll5:status:1.5') == 0
+        coll5.delete(padded_id)
+
+    def test_multi_index_fields(self, coll2):
+        tagged = rh.Collection('test', 'coll2', json_fields='data', multi_index_fields='tags')
+        first = tagged.add(tags=['redis', 'python', 'redis'])
+        second = tagged.add(tags={'python'})
+        assert tagged.get(first, 'tags')['tags'] == ['redis', 'python', 'redis']
+        assert tagged.find('tags:python', item_format='{_id}', desc=False) == [first, second]
+        tagged.update(first, tags=['redis', 'lua'])
+        assert tagged.find('tags:python', item_format='{_id}') == [second]
+        assert tagged.find('tags:lua, tags:python', count=True) == 2
+        assert dict(tagged.top_values_for_index('tags', 10)) == {'redis': 1, 'lua': 1, 'python': 1}
+        assert tagged.verify()['issues'] == {}
+        tagged.delete(first)
+        assert tagged.find('tags:redis', count=True) == 0
+        counts = dict(tagged.top_values_for_index('tags', 10))
+        assert {value: count for value, count in counts.items() if count} == {'python': 1}
+
+    def test_composite_indexes(self, coll1):
+        logs = rh.Collection('test', 'coll1', index_fields='host, uri, status',
+                             composite_indexes='host+uri')
+        first = logs.add(host='a', uri='/x', status=200)
+        second = logs.add(host='a', uri='/y', status=200)
+        third = logs.add(host='b', uri='/x', status=404)
+        assert logs.explain('host:a, uri:/x')['steps'][0]['op'] == 'composite'
+        assert logs.find('host:a, uri:/x', item_format='{_id}') == [first]
+        assert logs.find('host:a, uri:/x, status:200', count=True) == 1
+        logs.update(second, uri='/x')
+        assert sorted(logs.find('host:a, uri:/x', item_format='{_id}')) == sorted([first, second])
+        assert logs.top_values_for_index('host+uri', 1) == [(('a', '/x'), 2)]
+        logs.delete(first)
+        assert logs.find('host:a, uri:/x', item_format='{_id}') == [second]
+        assert logs.find('host:b, uri:/x', item_format='{_id}') == [third]
+
+    def test_json_path_index_fields(self, coll2):
+        paths = rh.Collection('test', 'coll2', json_fields='data', index_fields='data.x, data.deep.name')
+        paths.reindex()
+        assert sum(count for _, count in paths.top_values_for_index('data.x', 20)) == paths.size
+        hash_id = paths.add(data={'x': 42, 'deep': {'name': 'bob'}})
+        assert paths.find('data.x:42', item_format='{_id}') == [hash_id]
+        assert paths.find('data.deep.name:bob, data.x:42', item_format='{_id}') == [hash_id]
+        paths.update(hash_id, data={'x': 43})
+        assert paths.find('data.x:42', count=True) == 0
+        assert paths.find('data.x:43', item_format='{_id}') == [hash_id]
+        assert paths.find('data.deep.name:bob', count=True) == 0
+        float_id = paths.add(data={'x': 7777.0})
+        assert paths.find('data.x:7777', item_format='{_id}') == [float_id]
+        assert paths.verify()['issues'] == {}
+        with pytest.raises(AssertionError):
+            paths.add(**{'data.x': 1})
+        paths.delete(hash_id)
+        assert paths.find('data.x:43', count=True) == 0
+
+    def test_text_fields(self, coll1):
+        texts = rh.Collection(
+            'test', 'coll1', text_fields='error', text_stemming=True,
+            text_stop_words='english'
+        )
+        texts.reindex()
+        id1 = texts.add(error='Connection refused by the server')
+        id2 = texts.add(error='Query failed terribly; connections reset')
+        assert sorted(texts.find('error~connection', item_format='{_id}')) == sorted([id1, id2])
+        assert texts.find('error~terrible', item_format='{_id}') == [id2]
+        assert texts.find('error~refusing server', item_format='{_id}') == [id1]
+        assert texts.find('error^conn*', count=True) == 2
+        assert texts.find('error^que*, error~reset', item_format='{_id}') == [id2]
+        assert texts.explain('error~the server')['steps'][0]['op'] == 'text'
+        assert texts.find('error~the', count=True) == 0
+        assert texts.find('error~', count=True) == 0
+        assert texts.explain('error~the')['max_results'] == 0
+        assert texts.find('error^Queries*', item_format='{_id}') == [id2]
+        assert texts.find('error^*', count=True) == 0
+        rh.REDIS.srem('test:coll1:_text:error:connection', id1)
+        rh.REDIS.sadd('test:coll1:_text:error:bogus', id2)
+        rh.REDIS.zrem('test:coll1:_text:error', 'fail')
+        issues = texts.verify(repair=True)['issues']
+        assert issues == {'text_missing': 1, 'text_stale': 1, 'vocabulary_missing': 1}
+        assert texts.verify()['issues'] == {}
+        texts.update(id1, error='Timed out')
+        assert texts.find('error~server', count=True) == 0
+        assert texts.find('error~time', item_format='{_id}') == [id1]
+        with pytest.raises(AssertionError):
+            texts.incr(id1, 'error')
+        texts.delete(id1)
+        texts.delete(id2)
+        assert texts.find('error^conn*', count=True) == 0
+
+    def test_expiring(self, coll1):
+        sessions = rh.Collection('test', 'coll1', expiring=True)
+        size = sessions.size
+        short_id = sessions.add(_ttl=1, x=1)
+        long_id = sessions.add(_ttl=60, x=2, ttl=5)
+        assert 0 < sessions.ttl(short_id) <= 1
+        assert sessions.ttl(coll1.find(limit=1, desc=False, item_format='{_id}')[0]) is None
+        sleep(1.1)
+        assert sessions.get(short_id) == {}
+        assert sessions.get([short_id, long_id], 'x') == [{}, {'x': 2}]
+        assert sessions.get(long_id, 'ttl') == {'ttl': 5}
+        assert sessions.find(count=True) == size + 1
+        assert short_id not in sessions.find(limit=None, item_format='{_id}')
+        assert sessions.trim()['deleted'] == 1
+        assert sessions.size == size + 1
+        assert sessions.expire(long_id, None) is True
+        assert sessions.ttl(long_id) is None
+
+    def test_expired_items_are_unindexed(self, coll5):
+        sessions = rh.Collection('test', 'coll5', unique_field='name', index_fields='status',
+                                 expiring=True, default_ttl=1)
+        [(hash_id, status)] = sessions.upsert_many({'name': 'tmp_exp', 'status': 'expiring'})
+        assert status == 'inserted'
+        assert 0 < sessions.ttl(hash_id) <= 1
+        other_id = sessions.add(name='tmp_exp2', status='expiring')
+        gone = rh.Collection('test', 'coll7', expiring=True, default_ttl=1)
+        gone.add(x=1)
+        sleep(1.1)
+        assert gone.random() == {}
+        gone.clear_keyspace()
+
+        sessions.reindex()
+        assert rh.REDIS.scard('test:coll5:status:expiring') == 2
+        assert rh.REDIS.scard('test:coll5:status:None') == 0
+        sessions.delete(hash_id)
+        sessions.delete(other_id)
+        assert rh.REDIS.scard('test:coll5:status:expiring') == 0
+        assert not rh.REDIS.zscore('test:coll5:status', 'expiring')
+
     def test_find(self, coll4):
         coll4.add(a='red', b='circle', c='striped')
         coll4.add(a='red', b='square', c='plain')
@@ -145,6 +628,13 @@ class TestCollection:
         assert coll4.find('b:triangle, b:square, c:striped, c:plain', count=True) == 4
         assert coll4.find('a:red, b:triangle, b:square, c:spotted, c:plain', count=True) == 3
 
+    def test_init_stats(self, coll4):
+        s = rh.Collection.init_stats(limit=None)
+        assert s['sizes']['test:coll4'] == coll4.size == 10
+        assert 'test:coll4' in s['timestamps']
+        assert coll4.last_update == s['timestamps']['test:coll4'][0]
+        assert rh.REDIS.hget('_REDIS_HELPER_COLLECTION', 'test:coll4--last_size') is None
+
     def test_delete(self, coll4):
         reds = coll4.find('a:red')
         assert coll4.size == 10
@@ -214,6 +704,33 @@ class TestCollection:
         one_data = coll4.get(one_id)
         assert one_data == {}
         assert coll4.size == 2
+        assert sum(count for _, count in coll4.top_values_for_index('a', 10)) == 2
+
+    def test_delete_many_report(self, coll5):
+        names = rh.Collection('test', 'coll5', unique_field='name')
+        hash_ids = [names.add(name='tmp{}'.format(i)) for i in range(3)]
+        rh.REDIS.delete(hash_ids[0])
+        reports = []
+        report = names.delete_many(*hash_ids, chunk_size=2, progress=reports.append)
+        assert report['deleted'] == 3
+        assert [r['deleted'] for r in reports] == [2, 3]
+        assert names.get_hash_id_for_unique_value('tmp0') is None
+        assert names.get_hash_id_for_unique_value('tmp1') is None
+
+    def test_trim(self, coll4):
+        newest_id = coll4.find(limit=1, item_format='{_id}')[0]
+        capped = rh.Collection('test', 'coll4', index_fields='a, b, c', max_items=1)
+        assert capped.has_retention
+        report = capped.trim(max_busy_ratio=1)
+        assert report['deleted'] == 1
+        assert capped.find(item_format='{_id}') == [newest_id]
+        assert capped.trim()['deleted'] == 0
+        with pytest.raises(AssertionError):
+            capped.trim(max_busy_ratio=0)
+        with pytest.raises(AssertionError):
+            capped.start_trimmer(max_busy_ratio=0)
+        with pytest.raises(AssertionError):
+            capped.verify(max_busy_ratio=0)
 
     def test_base_key(self, coll1, coll2, coll3, coll4, coll5, coll6):
         coll1._base_key == 'test:coll1'